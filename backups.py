@@ -0,0 +1,117 @@
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+from datetime import datetime
+from config import BACKUP_SETTINGS
+from database_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+class BackupManager:
+    """Онлайн-бэкапы базы через sqlite3 backup API.
+    
+    Копия снимается порциями страниц с паузами между шагами, чтобы бот не
+    ждал блокировок; затем проверяется integrity_check и старые копии ротируются.
+    Все тяжелые операции выполняются в рабочем потоке со своими соединениями.
+    """
+    
+    def __init__(self, db, directory=None, keep=None):
+        self.db = db
+        self.directory = directory or BACKUP_SETTINGS["directory"]
+        self.keep = keep or BACKUP_SETTINGS["keep"]
+        self.last_result = None
+        self._lock = asyncio.Lock()
+    
+    def list_snapshots(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith("roleplay_bot-") and name.endswith(".db")
+        )
+        return [os.path.join(self.directory, name) for name in reversed(names)]
+    
+    def backup(self, path):
+        """Снять копию базы в path. Возвращает сводку о копии."""
+        started = time.monotonic()
+        source = self.db.open_reader()
+        source.isolation_level = None
+        target = sqlite3.connect(path)
+        steps = 0
+        
+        def pause_between_steps(status, remaining, total):
+            nonlocal steps
+            steps += 1
+            time.sleep(BACKUP_SETTINGS["step_sleep"])
+        
+        try:
+            # Открытая транзакция чтения фиксирует снимок WAL - копия не перезапускается из-за записей бота
+            source.execute('BEGIN')
+            source.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone()
+            source.backup(target, pages=BACKUP_SETTINGS["pages_per_step"], progress=pause_between_steps)
+            source.execute('COMMIT')
+            integrity = target.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        
+        return {
+            "path": path,
+            "size": os.path.getsize(path),
+            "duration": time.monotonic() - started,
+            "steps": steps,
+            "integrity": integrity,
+            "finished_at": datetime.now(),
+        }
+    
+    def run_backup(self):
+        """Снять очередную копию в каталог бэкапов, проверить и ротировать старые"""
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"roleplay_bot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+        path = os.path.join(self.directory, name)
+        temp_path = path + ".tmp"
+        
+        try:
+            result = self.backup(temp_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        
+        if result["integrity"] != "ok":
+            os.remove(temp_path)
+            logger.error(f"❌ Копия базы не прошла integrity_check: {result['integrity']}")
+            return result
+        
+        os.replace(temp_path, path)
+        result["path"] = path
+        
+        for old_path in self.list_snapshots()[self.keep:]:
+            os.remove(old_path)
+            logger.info(f"🗑️ Старая копия удалена: {old_path}")
+        
+        logger.info(
+            f"💾 Копия базы {path}: {result['size'] // 1024} КБ за {result['duration']:.2f} с"
+        )
+        return result
+    
+    async def run_backup_async(self):
+        async with self._lock:
+            self.db.flush()
+            try:
+                result = await asyncio.to_thread(self.run_backup)
+            except Exception as e:
+                logger.error(f"Error running backup: {e}")
+                result = {"error": str(e), "finished_at": datetime.now()}
+            self.last_result = result
+            return result
+    
+    async def run_schedule(self):
+        """Фоновая задача: копия раз в BACKUP_SETTINGS['interval'] секунд"""
+        while True:
+            await asyncio.sleep(BACKUP_SETTINGS["interval"])
+            await self.run_backup_async()
+
+backup_manager = BackupManager(db_manager)
@@ -0,0 +1,95 @@
+"""Память и время горячих путей для 10k ролевых сессий: словари против Session/Player.
+
+    python bench_sessions.py
+    python bench_sessions.py --sessions 50000 --players 6
+"""
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+from roleplay_models import Session, Player, SessionStatus, CHARACTER_NAMES
+
+SCENE = "🎸 **FNF БАНДА В СБОРЕ**\nвся банда собрались на заброшенной сцене."
+
+def make_dict_sessions(count, players):
+    """Прежний формат: словари со строковыми ключами и ISO-временем"""
+    sessions = {}
+    for index in range(count):
+        session_id = f"session_{-1000000 - index}_20260101_120000"
+        session = {
+            "id": session_id,
+            "chat_id": -1000000 - index,
+            "creator": index,
+            "theme": "🎭 Свободная ролевая",
+            "mode": "free",
+            "players": {},
+            "status": "active",
+            "created_at": datetime.now().isoformat(),
+            "current_scene": SCENE,
+            "story_arc": [SCENE],
+            "current_scene_index": 0,
+            "pinned_message_id": None,
+            "new_achievements": {},
+        }
+        for user_id in range(players):
+            session["players"][index * players + user_id] = {
+                "character": CHARACTER_NAMES[user_id],
+                "username": f"user{user_id}",
+                "first_name": "Игрок",
+                "joined_at": datetime.now().isoformat(),
+                "messages_count": 0,
+            }
+        sessions[session_id] = session
+    return sessions
+
+def make_slot_sessions(count, players):
+    sessions = {}
+    for index in range(count):
+        session_id = f"session_{-1000000 - index}_20260101_120000"
+        session = Session(session_id, -1000000 - index, index, "🎭 Свободная ролевая", "free")
+        session.status = SessionStatus.ACTIVE
+        session.story_arc = [SCENE]
+        for user_id in range(players):
+            player_id = index * players + user_id
+            session.players[player_id] = Player(player_id, user_id, f"user{user_id}", "Игрок")
+        sessions[session_id] = session
+    return sessions
+
+def measure(build, count, players):
+    tracemalloc.start()
+    sessions = build(count, players)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return sessions, size
+
+def time_elapsed(sessions, dict_layout):
+    """Горячий путь join_roleplay/end_session: сколько прошло с создания сессии"""
+    started = time.perf_counter()
+    for session in sessions.values():
+        if dict_layout:
+            (datetime.now() - datetime.fromisoformat(session["created_at"])).seconds
+        else:
+            session.elapsed()
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--players", type=int, default=4)
+    args = parser.parse_args()
+    
+    dict_sessions, dict_size = measure(make_dict_sessions, args.sessions, args.players)
+    slot_sessions, slot_size = measure(make_slot_sessions, args.sessions, args.players)
+    
+    print(f"Сессий: {args.sessions}, игроков в каждой: {args.players}")
+    print(f"{'':12}{'всего, МБ':>12}{'на сессию, Б':>15}{'elapsed, мс':>14}")
+    for title, size, sessions, dict_layout in (
+        ("dict", dict_size, dict_sessions, True),
+        ("__slots__", slot_size, slot_sessions, False),
+    ):
+        duration = time_elapsed(sessions, dict_layout) * 1000
+        print(f"{title:12}{size / 1024 / 1024:>12.2f}{size // args.sessions:>15}{duration:>14.1f}")
+    print(f"Экономия памяти: {100 - slot_size * 100 / dict_size:.0f}%")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,52 @@
 import asyncio
 import logging
-import sqlite3
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
+import os
+from datetime import datetime, timedelta
+from aiogram import Bot, Dispatcher, Router, types, F
 from aiogram.filters import Command, CommandObject
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 
-from config import BOT_TOKEN, ADMIN_ID, CHARACTERS, ROLEPLAY_SETTINGS, ROLEPLAY_MODES, USER_CHARACTER_MAPPING, MODERATORS, ACHIEVEMENTS
+from config import BOT_TOKEN, ADMIN_ID, CHARACTERS, ROLEPLAY_SETTINGS, ROLEPLAY_MODES, USER_CHARACTER_MAPPING, MODERATORS, ACHIEVEMENTS, DATABASE_SETTINGS, RECORDER_SETTINGS
+from flood_control import flood_control
 from roleplay_manager import roleplay_manager
+from roleplay_models import CHARACTER_IDS, CHARACTER_NAMES, SessionStatus
 from database_manager import db_manager
+from render_cache import render_cache
+from backups import backup_manager
+from maintenance import maintenance_scheduler
+from entity_directory import entity_directory
+from broadcasts import broadcast_manager
+from chat_capabilities import chat_capabilities
+from update_recorder import update_recorder
+from update_dedup import update_deduplicator
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+router = Router()
 
-def is_moderator(user_id):
-    return user_id == ADMIN_ID or db_manager.is_moderator(user_id)
+async def is_moderator(user_id):
+    return user_id == ADMIN_ID or await db_manager.call("is_moderator", user_id)
 
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
+CHATS_PAGE_SIZE = 10
+
+TIER_TITLES = {
+    "admin": "👑 Главный администратор",
+    "moderator": "🔧 Модератор",
+    "player": "👤 Игрок",
+}
+
+async def get_user_tier(user_id):
+    if is_admin(user_id):
+        return "admin"
+    if await is_moderator(user_id):
+        return "moderator"
+    return "player"
+
 def get_character_for_user(user_id, username, first_name):
     if username:
         username_with_at = f"@{username}"
@@ -37,30 +60,29 @@ def get_character_for_user(user_id, username, first_name):
     
     return None
 
-def can_user_join_with_character(session, user_id, character_name):
-    if user_id in session["players"]:
+def can_user_join_with_character(session, user_id, character_id):
+    if user_id in session.players:
         return False, "Вы уже в ролевой!"
     
-    for player_id, player_data in session["players"].items():
-        if player_data["character"] == character_name and player_id != user_id:
-            return False, "Эта роль уже занята!"
+    owner_id = session.character_owner(character_id)
+    if owner_id is not None and owner_id != user_id:
+        return False, "Эта роль уже занята!"
     
     return True, "Можно присоединиться"
 
 def create_join_keyboard(session):
     keyboard_buttons = []
     
-    for character_name, character_data in CHARACTERS.items():
-        role_taken = False
-        for player_data in session["players"].values():
-            if player_data["character"] == character_name:
-                role_taken = True
-                break
+    taken = {player.character_id for player in session.players.values()}
+    
+    for character_id, character_name in enumerate(CHARACTER_NAMES):
+        character_data = CHARACTERS[character_name]
+        role_taken = character_id in taken
         
         if not role_taken:
             button_text = f"🎭 {character_name} - {character_data['role']}"
             keyboard_buttons.append([
-                InlineKeyboardButton(text=button_text, callback_data=f"join_{character_name}")
+                InlineKeyboardButton(text=button_text, callback_data=f"join_{character_id}")
             ])
         else:
             button_text = f"❌ {character_name} - Занята"
@@ -75,7 +97,107 @@ def create_join_keyboard(session):
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
-async def set_bot_commands():
+def achievement_lines(players, new_achievements):
+    lines = []
+    for user_id, achievement_ids in new_achievements.items():
+        player = players.get(user_id)
+        name = (player and (player.first_name or player.character)) or f"Игрок {user_id}"
+        for achievement_id in achievement_ids:
+            lines.append(f"🏆 **{ACHIEVEMENTS[achievement_id]['name']}** - {name}")
+    return lines
+
+async def announce_new_achievements(bot, chat_id, players, new_achievements):
+    """Одно сообщение со всеми достижениями, полученными за старт или завершение сессии"""
+    lines = achievement_lines(players, new_achievements)
+    if lines:
+        await bot.send_message(chat_id, "🎉 **НОВЫЕ ДОСТИЖЕНИЯ!** 🎉\n\n" + "\n".join(lines))
+
+def fit_chats_prefix(title_prefix):
+    """Обрезать фильтр так, чтобы курсор страницы поместился в 64 байта callback_data"""
+    while len(f"chats|prev|{'0' * 19}|-1000000000000|{title_prefix}".encode()) > 64:
+        title_prefix = title_prefix[:-1]
+    return title_prefix.replace("|", "")
+
+def render_chats_page(chats, title_prefix, has_prev, has_next):
+    """Текст страницы /chats и кнопки листания с ключом (added_at, chat_id) в callback_data"""
+    capabilities = chat_capabilities.get_cached([chat['chat_id'] for chat in chats])
+    chats_list = []
+    for chat in chats:
+        chat_info = f"• {chat['chat_title']} ({chat['chat_type']})"
+        chat_info += f"\n   ID: `{chat['chat_id']}`"
+        chat_info += f"\n   🤖 {format_capability(capabilities.get(chat['chat_id']))}"
+        chats_list.append(chat_info)
+    
+    header = "📋 **ЧАТЫ С БОТОМ:**"
+    if title_prefix:
+        header = f"📋 **ЧАТЫ С БОТОМ** (название начинается с «{title_prefix}»):"
+    chats_text = header + "\n\n" + "\n\n".join(chats_list)
+    chats_text += "\n\n💡 Используйте /выйти ID для выхода"
+    
+    buttons = []
+    if has_prev:
+        first = chats[0]
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Назад",
+            callback_data=f"chats|prev|{first['added_at']}|{first['chat_id']}|{title_prefix}"
+        ))
+    if has_next:
+        last = chats[-1]
+        buttons.append(InlineKeyboardButton(
+            text="Вперед ➡️",
+            callback_data=f"chats|next|{last['added_at']}|{last['chat_id']}|{title_prefix}"
+        ))
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return chats_text, keyboard
+
+async def pin_message(bot, chat_id, message_id):
+    """Закрепить, если у бота есть право; заведомо безуспешный запрос не отправляем"""
+    if not await chat_capabilities.can_pin(bot, chat_id):
+        return False
+    try:
+        await bot.pin_chat_message(chat_id, message_id)
+        return True
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        chat_capabilities.deny_pin(chat_id)
+        logger.warning(f"Не удалось закрепить сообщение: {e}")
+    except Exception as e:
+        logger.warning(f"Не удалось закрепить сообщение: {e}")
+    return False
+
+async def unpin_message(bot, chat_id, message_id):
+    if not await chat_capabilities.can_pin(bot, chat_id):
+        return False
+    try:
+        await bot.unpin_chat_message(chat_id, message_id)
+        return True
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        chat_capabilities.deny_pin(chat_id)
+        logger.warning(f"Не удалось открепить сообщение: {e}")
+    except Exception as e:
+        logger.warning(f"Не удалось открепить сообщение: {e}")
+    return False
+
+def format_capability(capability):
+    if capability is None:
+        return "права неизвестны"
+    if not capability.is_member:
+        return "🚫 бота нет в чате"
+    marks = {True: "✅", False: "❌", None: "❔"}
+    role = "админ" if capability.status in ("administrator", "creator") else "участник"
+    return f"{role}, закреп {marks[capability.can_pin]}, удаление {marks[capability.can_delete]}"
+
+async def resolve_user(bot, query):
+    """Пользователь по @username или ID: сначала из справочника, get_chat - только если бот его не встречал"""
+    user = entity_directory.resolve_user(query)
+    if user is None:
+        user = await bot.get_chat(query)
+        # Тот же юзернейм может быть у канала или группы - модератором они стать не должны
+        if user.type != "private":
+            raise ValueError(f"{query} - не пользователь, а {user.type}")
+    return user
+
+async def set_bot_commands(bot):
     """Установка команд меню бота"""
     commands = [
         types.BotCommand(command="help", description="📖 Помощь"),
@@ -84,6 +206,8 @@ async def set_bot_commands():
         types.BotCommand(command="achievements", description="🏆 Достижения"),
         types.BotCommand(command="top", description="🏅 Топ игроков"),
         types.BotCommand(command="roles", description="👥 Все роли"),
+        types.BotCommand(command="search", description="🔎 Поиск по ролевым"),
+        types.BotCommand(command="session_stats", description="📈 Активность ролевой"),
         types.BotCommand(command="start_rp", description="🎬 Начать ролевую"),
         types.BotCommand(command="force_start", description="⚡ Принудительный старт"),
         types.BotCommand(command="stop_rp", description="🛑 Завершить ролевую"),
@@ -93,26 +217,15 @@ async def set_bot_commands():
     await bot.set_my_commands(commands)
     logger.info("✅ Команды бота установлены в меню")
 
-@dp.message(Command("help"))
-async def help_cmd(message: types.Message):
-    if message.chat.type == "private":
-        await message.answer("❌ Бот работает только в группах и чатах! Добавьте меня в группу для использования.")
-        return
-    
-    user_status = ""
-    if message.from_user.id == ADMIN_ID:
-        user_status = "👑 Главный администратор"
-    elif is_moderator(message.from_user.id):
-        user_status = "🔧 Модератор"
-    else:
-        user_status = "👤 Игрок"
+def render_help_text(tier):
+    user_status = TIER_TITLES[tier]
     
     help_text = (
         f"🎭 **Ролевой бот Пико Пиковича - Справка**\n\n"
         f"🔑 **Ваш статус:** {user_status}\n\n"
     )
     
-    if message.from_user.id == ADMIN_ID:
+    if tier == "admin":
         help_text += (
             "**👑 Команды администратора:**\n"
             "• /moderators - 📋 Список модераторов\n"
@@ -120,10 +233,12 @@ async def help_cmd(message: types.Message):
             "• /add_moderator_id ID - ➕ Добавить модератора по ID\n"
             "• /remove_moderator @юзернейм - ➖ Удалить модератора\n"
             "• /chats - 💬 Список всех чатов\n"
+            "• /export ID - 📜 Выгрузить историю ролевой\n"
+            "• /backup [now] - 💾 Резервные копии базы\n"
             "• /выйти ID - 🚪 Выйти из чата\n\n"
         )
     
-    if is_moderator(message.from_user.id):
+    if tier in ("admin", "moderator"):
         help_text += (
             "**⚡ Команды модератора:**\n"
             "• /start_rp - 🎬 Начать ролевую\n"
@@ -136,8 +251,10 @@ async def help_cmd(message: types.Message):
         "• /role - 🎭 Узнать свою роль\n"
         "• /stats - 📊 Моя статистика\n"
         "• /achievements - 🏆 Мои достижения\n"
-        "• /top - 🏅 Топ игроков\n"
-        "• /roles - 👥 Все роли\n\n"
+        "• /top [week|month|chat] - 🏅 Топ игроков\n"
+        "• /roles - 👥 Все роли\n"
+        "• /search текст - 🔎 Поиск по истории ролевых\n"
+        "• /session_stats - 📈 Активность текущей ролевой\n\n"
         "💡 **Как играть:**\n"
         "1. Модератор запускает /start_rp\n"
         "2. Игроки присоединяются к своим ролям\n"
@@ -146,35 +263,50 @@ async def help_cmd(message: types.Message):
         "5. Модератор завершает /stop_rp\n\n"
         "📞 **Поддержка:** @PicoFromTheVoid"
     )
+    return help_text
+
+@router.message(Command("help"))
+async def help_cmd(message: types.Message):
+    if message.chat.type == "private":
+        await message.answer("❌ Бот работает только в группах и чатах! Добавьте меня в группу для использования.")
+        return
+    
+    tier = await get_user_tier(message.from_user.id)
+    help_text = render_cache.get("help", tier, (), lambda: render_help_text(tier))
     
     await message.answer(help_text)
 
 # АДМИНИСТРАТИВНЫЕ КОМАНДЫ
-@dp.message(Command("moderators"))
+@router.message(Command("moderators"))
 async def moderators_cmd(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ Только главный администратор может просматривать модераторов!")
         return
     
-    moderators = db_manager.get_moderators()
-    
-    if not moderators:
-        moderators_text = "📋 **Список модераторов:**\n\n• Вы (Главный администратор)"
-    else:
-        moderators_list = ["• Вы (Главный администратор)"]
-        for mod in moderators:
-            added_by = f" (добавил @{mod['added_by_username']})" if mod['added_by_username'] else ""
-            mod_info = f"• {mod['first_name']}"
-            if mod['username']:
-                mod_info += f" (@{mod['username']})"
-            mod_info += f" - ID: {mod['user_id']}{added_by}"
-            moderators_list.append(mod_info)
-        
-        moderators_text = "📋 **Список модераторов:**\n\n" + "\n".join(moderators_list)
+    # Список могли изменить другой шард или manage.py - версию ведет база, а не этот процесс
+    render_cache.sync("moderators", await db_manager.call("moderators_version"))
+    moderators_text = await render_cache.get_async("moderators", "admin", ("moderators",), render_moderators_text)
     
     await message.answer(moderators_text)
 
-@dp.message(Command("add_moderator"))
+async def render_moderators_text():
+    moderators = await db_manager.call("get_moderators")
+    
+    if not moderators:
+        return "📋 **Список модераторов:**\n\n• Вы (Главный администратор)"
+    
+    moderators_list = ["• Вы (Главный администратор)"]
+    for mod in moderators:
+        added_by = f" (добавил @{mod['added_by_username']})" if mod['added_by_username'] else ""
+        mod_info = f"• {mod['first_name']}"
+        if mod['username']:
+            mod_info += f" (@{mod['username']})"
+        mod_info += f" - ID: {mod['user_id']}{added_by}"
+        moderators_list.append(mod_info)
+    
+    return "📋 **Список модераторов:**\n\n" + "\n".join(moderators_list)
+
+@router.message(Command("add_moderator"))
 async def add_moderator_cmd(message: types.Message, command: CommandObject):
     if not is_admin(message.from_user.id):
         await message.answer("❌ Только главный администратор может добавлять модераторов!")
@@ -189,13 +321,14 @@ async def add_moderator_cmd(message: types.Message, command: CommandObject):
         username = f"@{username}"
     
     try:
-        user = await bot.get_chat(username)
+        user = await resolve_user(message.bot, username)
         
         if user.id == ADMIN_ID:
             await message.answer("❌ Этот пользователь уже главный администратор!")
             return
         
-        success = db_manager.add_moderator(
+        success = await db_manager.call(
+            "add_moderator",
             user.id, 
             user.username or "", 
             user.first_name or "Пользователь", 
@@ -211,7 +344,7 @@ async def add_moderator_cmd(message: types.Message, command: CommandObject):
             )
             
             try:
-                await bot.send_message(
+                await message.bot.send_message(
                     user.id,
                     "🎉 **Вас назначили модератором ролевого бота!**\n\n"
                     "Теперь вы можете:\n"
@@ -237,7 +370,7 @@ async def add_moderator_cmd(message: types.Message, command: CommandObject):
             "💡 **Решение:** Попросите пользователя написать боту в ЛС команду /start"
         )
 
-@dp.message(Command("add_moderator_id"))
+@router.message(Command("add_moderator_id"))
 async def add_moderator_id_cmd(message: types.Message, command: CommandObject):
     if not is_admin(message.from_user.id):
         await message.answer("❌ Только главный администратор может добавлять модераторов!")
@@ -255,9 +388,10 @@ async def add_moderator_id_cmd(message: types.Message, command: CommandObject):
             return
         
         try:
-            user = await bot.get_chat(user_id)
+            user = await resolve_user(message.bot, user_id)
             
-            success = db_manager.add_moderator(
+            success = await db_manager.call(
+                "add_moderator",
                 user.id, 
                 user.username or "", 
                 user.first_name or "Пользователь", 
@@ -273,7 +407,7 @@ async def add_moderator_id_cmd(message: types.Message, command: CommandObject):
                 )
                 
                 try:
-                    await bot.send_message(
+                    await message.bot.send_message(
                         user.id,
                         "🎉 **Вас назначили модератором ролевого бота!**\n\n"
                         "Теперь вы можете:\n"
@@ -293,7 +427,7 @@ async def add_moderator_id_cmd(message: types.Message, command: CommandObject):
     except ValueError:
         await message.answer("❌ Неверный ID! ID должен быть числом.")
 
-@dp.message(Command("remove_moderator"))
+@router.message(Command("remove_moderator"))
 async def remove_moderator_cmd(message: types.Message, command: CommandObject):
     if not is_admin(message.from_user.id):
         await message.answer("❌ Только главный администратор может удалять модераторов!")
@@ -308,7 +442,7 @@ async def remove_moderator_cmd(message: types.Message, command: CommandObject):
         username = f"@{username}"
     
     try:
-        moderators = db_manager.get_moderators()
+        moderators = await db_manager.call("get_moderators")
         moderator_to_remove = None
         
         for mod in moderators:
@@ -320,7 +454,7 @@ async def remove_moderator_cmd(message: types.Message, command: CommandObject):
             await message.answer(f"❌ Модератор с юзернеймом {username} не найден!")
             return
         
-        success = db_manager.remove_moderator(moderator_to_remove['user_id'])
+        success = await db_manager.call("remove_moderator", moderator_to_remove['user_id'])
         
         if success:
             await message.answer(f"✅ Модератор {username} удален!")
@@ -330,33 +464,52 @@ async def remove_moderator_cmd(message: types.Message, command: CommandObject):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-@dp.message(Command("chats"))
-async def my_chats_cmd(message: types.Message):
-    """Список чатов с ботом (только для админа)"""
+@router.message(Command("chats"))
+async def my_chats_cmd(message: types.Message, command: CommandObject):
+    """Список чатов с ботом (только для админа); /chats префикс - фильтр по началу названия"""
     logger.info(f"💬 Команда /chats от {message.from_user.id}")
     
     if not is_admin(message.from_user.id):
         await message.answer("❌ Только главный администратор может просматривать чаты!")
         return
     
-    chats = db_manager.get_all_chats()
+    title_prefix = fit_chats_prefix((command.args or "").strip())
+    chats, has_next = await db_manager.call("get_chats_page", title_prefix=title_prefix, limit=CHATS_PAGE_SIZE)
     
     if not chats:
-        await message.answer("📋 Бот пока не добавлен ни в один чат")
+        if title_prefix:
+            await message.answer(f"📋 Нет чатов, название которых начинается с «{title_prefix}»")
+        else:
+            await message.answer("📋 Бот пока не добавлен ни в один чат")
         return
     
-    chats_list = []
-    for i, chat in enumerate(chats, 1):
-        chat_info = f"{i}. {chat['chat_title']} ({chat['chat_type']})"
-        chat_info += f"\n   ID: `{chat['chat_id']}`"
-        chats_list.append(chat_info)
+    text, keyboard = render_chats_page(chats, title_prefix, has_prev=False, has_next=has_next)
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith("chats|"))
+async def chats_page_callback(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Только главный администратор может просматривать чаты!")
+        return
     
-    chats_text = "📋 **ЧАТЫ С БОТОМ:**\n\n" + "\n\n".join(chats_list)
-    chats_text += "\n\n💡 Используйте /выйти ID для выхода"
+    _, direction, added_at, chat_id, title_prefix = callback.data.split("|", 4)
+    cursor = (added_at, int(chat_id))
+    if direction == "next":
+        chats, has_next = await db_manager.call("get_chats_page", after=cursor, title_prefix=title_prefix, limit=CHATS_PAGE_SIZE)
+        has_prev = True
+    else:
+        chats, has_prev = await db_manager.call("get_chats_page", before=cursor, title_prefix=title_prefix, limit=CHATS_PAGE_SIZE)
+        has_next = True
     
-    await message.answer(chats_text)
+    if not chats:
+        await callback.answer("📋 Больше чатов нет")
+        return
+    
+    text, keyboard = render_chats_page(chats, title_prefix, has_prev, has_next)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
-@dp.message(Command("выйти"))
+@router.message(Command("выйти"))
 async def leave_chat_cmd(message: types.Message, command: CommandObject):
     """Выйти из чата (только для админа)"""
     logger.info(f"🚪 Команда /выйти от {message.from_user.id}")
@@ -373,8 +526,8 @@ async def leave_chat_cmd(message: types.Message, command: CommandObject):
         chat_id = int(command.args)
         
         try:
-            await bot.leave_chat(chat_id)
-            db_manager.remove_chat(chat_id)
+            await message.bot.leave_chat(chat_id)
+            await db_manager.call("remove_chat", chat_id)
             await message.answer(f"✅ Бот вышел из чата {chat_id}")
         except Exception as e:
             await message.answer(f"❌ Не удалось выйти из чата {chat_id}: {e}")
@@ -382,8 +535,129 @@ async def leave_chat_cmd(message: types.Message, command: CommandObject):
     except ValueError:
         await message.answer("❌ Неверный ID чата! ID должен быть числом.")
 
+@router.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message, command: CommandObject):
+    """Разослать сообщение во все чаты с ботом (только для админа)"""
+    logger.info(f"📣 Команда /broadcast от {message.from_user.id}")
+    
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Только главный администратор может делать рассылки!")
+        return
+    
+    if not command.args:
+        text = "❌ Укажите текст: `/broadcast Текст объявления`"
+        broadcast_id = broadcast_manager.get_last_broadcast_id()
+        progress = broadcast_manager.get_progress(broadcast_id) if broadcast_id else None
+        if progress:
+            counts = progress["counts"]
+            status = "идет" if progress["status"] == "running" else "завершена"
+            text += (
+                f"\n\n📣 **Последняя рассылка #{broadcast_id}** ({status})\n"
+                f"✅ Доставлено: {counts.get('sent', 0)} из {progress['total']}\n"
+                f"⏳ В очереди: {counts.get('pending', 0) + counts.get('sending', 0)}\n"
+                f"🚫 Чат недоступен: {counts.get('rejected', 0)}\n"
+                f"❌ Ошибки: {counts.get('failed', 0)}"
+            )
+        await message.answer(text)
+        return
+    
+    broadcast_id, total = await broadcast_manager.create(command.args, message.from_user.id)
+    if broadcast_id is None:
+        await message.answer("❌ Ошибка при создании рассылки")
+        return
+    if total == 0:
+        await message.answer("📋 Бот пока не добавлен ни в один чат")
+        return
+    
+    broadcast_manager.start(message.bot, broadcast_id)
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена: {total} чатов. Итог пришлю в ЛС.")
+
+@router.message(Command("export"))
+async def export_cmd(message: types.Message, command: CommandObject):
+    """Выгрузить историю завершенной ролевой файлом (только для админа)"""
+    logger.info(f"📜 Команда /export от {message.from_user.id}")
+    
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Только главный администратор может выгружать ролевые!")
+        return
+    
+    if not command.args:
+        sessions = roleplay_manager.transcripts.get_recent_sessions(message.chat.id)
+        if not sessions:
+            await message.answer("📜 В этом чате еще нет завершенных ролевых")
+            return
+        
+        sessions_list = [
+            f"• `{session['session_id']}`\n   {session['theme']} - {session['ended_at']}, сообщений: {session['messages_count']}"
+            for session in sessions
+        ]
+        await message.answer(
+            "📜 **ЗАВЕРШЕННЫЕ РОЛЕВЫЕ:**\n\n" + "\n\n".join(sessions_list) +
+            "\n\n💡 Используйте /export ID для выгрузки"
+        )
+        return
+    
+    session = roleplay_manager.transcripts.get_session(command.args.strip())
+    if not session:
+        await message.answer("❌ Ролевая с таким ID не найдена!")
+        return
+    
+    db_manager.flush()
+    path = await asyncio.to_thread(roleplay_manager.transcripts.export_to_file, session)
+    try:
+        await message.answer_document(
+            FSInputFile(path, filename=f"{session['session_id']}.txt"),
+            caption=f"📜 {session['theme']} - {session['messages_count']} сообщений"
+        )
+    finally:
+        os.remove(path)
+
+def format_backup_result(result):
+    if "error" in result:
+        return f"❌ Ошибка: {result['error']}"
+    return (
+        f"📁 {os.path.basename(result['path'])}\n"
+        f"📦 Размер: {result['size'] // 1024} КБ\n"
+        f"⏱️ Длительность: {result['duration']:.2f} с\n"
+        f"🩺 Проверка: {result['integrity']}"
+    )
+
+@router.message(Command("backup"))
+async def backup_cmd(message: types.Message, command: CommandObject):
+    """Резервные копии базы (только для админа)"""
+    logger.info(f"💾 Команда /backup от {message.from_user.id}")
+    
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Только главный администратор может управлять копиями!")
+        return
+    
+    if command.args and command.args.strip() in ("now", "сейчас"):
+        await message.answer("⏳ Снимаю копию базы...")
+        result = await backup_manager.run_backup_async()
+        await message.answer("💾 **КОПИЯ БАЗЫ**\n\n" + format_backup_result(result))
+        return
+    
+    last_text = "Копий с момента запуска еще не было"
+    if backup_manager.last_result:
+        last_text = (
+            f"🕒 {backup_manager.last_result['finished_at'].strftime('%d.%m.%Y %H:%M')}\n"
+            + format_backup_result(backup_manager.last_result)
+        )
+    
+    snapshots = backup_manager.list_snapshots()
+    snapshots_text = "\n".join([
+        f"• {os.path.basename(path)} - {os.path.getsize(path) // 1024} КБ" for path in snapshots
+    ]) or "• Нет сохраненных копий"
+    
+    await message.answer(
+        f"💾 **РЕЗЕРВНЫЕ КОПИИ**\n\n"
+        f"**Последняя копия:**\n{last_text}\n\n"
+        f"**На диске ({len(snapshots)}):**\n{snapshots_text}\n\n"
+        f"💡 Используйте /backup now для копии прямо сейчас"
+    )
+
 # ОСНОВНЫЕ КОМАНДЫ ПОЛЬЗОВАТЕЛЯ
-@dp.message(Command("role"))
+@router.message(Command("role"))
 async def my_role_cmd(message: types.Message):
     """Показать роль пользователя"""
     logger.info(f"🎭 Команда /role от {message.from_user.id}")
@@ -412,7 +686,7 @@ async def my_role_cmd(message: types.Message):
             "📞 Обратитесь к @PicoFromTheVoid для получения роли"
         )
 
-@dp.message(Command("stats"))
+@router.message(Command("stats"))
 async def user_stats(message: types.Message):
     """Статистика пользователя"""
     logger.info(f"📊 Команда /stats от {message.from_user.id}")
@@ -426,7 +700,7 @@ async def user_stats(message: types.Message):
         )
         
         user_id = message.from_user.id
-        stats = db_manager.get_user_stats(user_id)
+        stats = await db_manager.call("get_user_profile", user_id)
         
         user_role = get_character_for_user(
             user_id, 
@@ -435,8 +709,14 @@ async def user_stats(message: types.Message):
         )
         
         if stats:
-            achievements = db_manager.get_user_achievements(user_id)
-            achievements_count = db_manager.get_achievements_count(user_id)
+            recent_text = ""
+            recent_names = [
+                ACHIEVEMENTS[ach['achievement_id']]['name']
+                for ach in stats['recent_achievements']
+                if ach['achievement_id'] in ACHIEVEMENTS
+            ]
+            if recent_names:
+                recent_text = f"🆕 **Последние:** {', '.join(recent_names)}\n"
             
             stats_text = (
                 f"📊 **ВАША СТАТИСТИКА** 📊\n\n"
@@ -447,7 +727,8 @@ async def user_stats(message: types.Message):
                 f"💭 **Ответов отправлено:** {stats['total_responses']}\n"
                 f"🕹️ **Сессий сыграно:** {stats['sessions_played']}\n"
                 f"📨 **Всего сообщений:** {stats['total_messages']}\n"
-                f"🏆 **Достижений:** {achievements_count}\n\n"
+                f"🏆 **Достижений:** {stats['achievements_count']}\n"
+                f"{recent_text}\n"
                 f"💡 Используйте /achievements чтобы посмотреть свои достижения"
             )
         else:
@@ -462,14 +743,14 @@ async def user_stats(message: types.Message):
         logger.error(f"Error in user_stats: {e}")
         await message.answer("❌ Ошибка при получении статистики")
 
-@dp.message(Command("achievements"))
+@router.message(Command("achievements"))
 async def achievements_cmd(message: types.Message):
     """Мои достижения"""
     logger.info(f"🏆 Команда /achievements от {message.from_user.id}")
     
     try:
         user_id = message.from_user.id
-        achievements = db_manager.get_user_achievements(user_id)
+        achievements = await db_manager.call("get_user_achievements", user_id)
         
         if achievements:
             achievements_list = []
@@ -495,13 +776,34 @@ async def achievements_cmd(message: types.Message):
         logger.error(f"Error in achievements: {e}")
         await message.answer("❌ Ошибка при получении достижений")
 
-@dp.message(Command("top"))
-async def top_cmd(message: types.Message):
-    """Топ игроков"""
+@router.message(Command("top"))
+async def top_cmd(message: types.Message, command: CommandObject):
+    """Топ игроков: за все время, за неделю, за месяц или за свой период"""
     logger.info(f"🏅 Команда /top от {message.from_user.id}")
     
     try:
-        top_players = db_manager.get_top_players(10)
+        period = parse_top_period(command.args)
+    except ValueError:
+        await message.answer(
+            "❌ Неизвестный период! Используйте:\n"
+            "`/top` - за все время\n"
+            "`/top week` - за 7 дней\n"
+            "`/top month` - за 30 дней\n"
+            "`/top chat` - топ этого чата\n"
+            "`/top 2024-01-01 2024-01-31` - за свой период"
+        )
+        return
+    
+    try:
+        if period == "chat":
+            title = "ТОП ИГРОКОВ ЧАТА"
+            top_players = await db_manager.call("get_chat_top_players", message.chat.id, 10)
+        elif period:
+            title, start_day, end_day = period
+            top_players = await db_manager.call("get_top_players_for_period", start_day, end_day, 10)
+        else:
+            title = "ТОП ИГРОКОВ"
+            top_players = await db_manager.call("get_top_players", 10)
         
         if top_players:
             top_list = []
@@ -510,7 +812,7 @@ async def top_cmd(message: types.Message):
                 name = player['first_name'] or player['username'] or f"Игрок {player['user_id']}"
                 top_list.append(f"{medal} **{name}** - {player['total_responses']} ответов, {player['sessions_played']} сессий")
             
-            top_text = "🏆 **ТОП ИГРОКОВ** 🏆\n\n" + "\n".join(top_list)
+            top_text = f"🏆 **{title}** 🏆\n\n" + "\n".join(top_list)
         else:
             top_text = (
                 "🏆 **Пока нет статистики игроков.**\n\n"
@@ -523,32 +825,97 @@ async def top_cmd(message: types.Message):
         logger.error(f"Error in top: {e}")
         await message.answer("❌ Ошибка при получении топа")
 
-@dp.message(Command("roles"))
+def parse_top_period(args):
+    """(заголовок, первый день, последний день) для /top, "chat" для топа чата или None для топа за все время"""
+    if not args:
+        return None
+    
+    parts = args.split()
+    today = datetime.now()
+    
+    if parts[0] in ("chat", "чат"):
+        return "chat"
+    
+    if parts[0] in ("week", "неделя"):
+        start = today - timedelta(days=6)
+        return "ТОП ЗА НЕДЕЛЮ", start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+    
+    if parts[0] in ("month", "месяц"):
+        start = today - timedelta(days=29)
+        return "ТОП ЗА МЕСЯЦ", start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+    
+    if len(parts) == 2:
+        start = datetime.strptime(parts[0], '%Y-%m-%d')
+        end = datetime.strptime(parts[1], '%Y-%m-%d')
+        if start > end:
+            raise ValueError("start after end")
+        return f"ТОП С {start.strftime('%d.%m.%Y')} ПО {end.strftime('%d.%m.%Y')}", parts[0], parts[1]
+    
+    raise ValueError(f"unknown period: {args}")
+
+def render_roles_text():
+    owners = {}
+    for username, char in USER_CHARACTER_MAPPING.items():
+        owners.setdefault(char, username)
+    
+    roles_text = "🎭 **ВСЕ РОЛИ И ИХ ВЛАДЕЛЬЦЫ** 🎭\n\n"
+    
+    for character, data in CHARACTERS.items():
+        owner = owners.get(character)
+        
+        if owner:
+            roles_text += f"• **{character}** - {data['role']}\n  👤 **Владелец:** {owner}\n\n"
+        else:
+            roles_text += f"• **{character}** - {data['role']}\n  🤖 **Свободная роль**\n\n"
+    
+    return roles_text
+
+def render_modes_text():
+    modes_list = "\n".join([f"`{mode_id}` - {data['name']}" for mode_id, data in ROLEPLAY_MODES.items()])
+    return (
+        f"❌ Неизвестный режим! Доступные режимы:\n{modes_list}\n\n"
+        f"Пример: `/start_rp battle`"
+    )
+
+@router.message(Command("roles"))
 async def all_roles_cmd(message: types.Message):
     """Показывает все роли и их владельцев"""
     logger.info(f"👥 Команда /roles от {message.from_user.id}")
     
     try:
-        roles_text = "🎭 **ВСЕ РОЛИ И ИХ ВЛАДЕЛЬЦЫ** 🎭\n\n"
-        
-        for character, data in CHARACTERS.items():
-            owner = None
-            for username, char in USER_CHARACTER_MAPPING.items():
-                if char == character:
-                    owner = username
-                    break
-            
-            if owner:
-                roles_text += f"• **{character}** - {data['role']}\n  👤 **Владелец:** {owner}\n\n"
-            else:
-                roles_text += f"• **{character}** - {data['role']}\n  🤖 **Свободная роль**\n\n"
-        
+        roles_text = render_cache.get("roles", "all", (), render_roles_text)
         await message.answer(roles_text)
     except Exception as e:
         logger.error(f"Error in all_roles: {e}")
         await message.answer("❌ Ошибка при получении списка ролей")
 
-@dp.message(Command("start"))
+@router.message(Command("search"))
+async def search_cmd(message: types.Message, command: CommandObject):
+    """Поиск реплик по истории ролевых этого чата"""
+    logger.info(f"🔎 Команда /search от {message.from_user.id}")
+    
+    if not command.args:
+        await message.answer("❌ Укажите что искать: `/search микрофон`")
+        return
+    
+    try:
+        db_manager.flush()
+        results = roleplay_manager.transcripts.search(message.chat.id, command.args)
+        
+        if not results:
+            await message.answer(f"🔎 По запросу «{command.args}» ничего не найдено")
+            return
+        
+        results_list = [
+            f"• **{result['character']}** ({result['sent_at']}):\n  {result['snippet']}"
+            for result in results
+        ]
+        await message.answer(f"🔎 **НАЙДЕНО ({len(results)}):**\n\n" + "\n\n".join(results_list))
+    except Exception as e:
+        logger.error(f"Error in search: {e}")
+        await message.answer("❌ Ошибка при поиске")
+
+@router.message(Command("start"))
 async def start_cmd(message: types.Message):
     logger.info(f"✅ Команда /start от {message.from_user.id}")
     
@@ -588,7 +955,7 @@ async def start_cmd(message: types.Message):
     user_status = ""
     if message.from_user.id == ADMIN_ID:
         user_status = "👑 Главный администратор"
-    elif is_moderator(message.from_user.id):
+    elif await is_moderator(message.from_user.id):
         user_status = "🔧 Модератор"
     else:
         user_status = "👤 Игрок"
@@ -609,7 +976,7 @@ async def start_cmd(message: types.Message):
     await message.answer(start_text)
 
 # РОЛЕВЫЕ КОМАНДЫ
-@dp.message(Command("start_rp"))
+@router.message(Command("start_rp"))
 async def start_roleplay_with_mode(message: types.Message, command: CommandObject):
     logger.info(f"🎭 Команда /start_rp от {message.from_user.id}")
     
@@ -617,7 +984,7 @@ async def start_roleplay_with_mode(message: types.Message, command: CommandObjec
         await message.answer("❌ Ролевые нельзя запускать в ЛС! Добавьте бота в группу.")
         return
     
-    if not is_moderator(message.from_user.id):
+    if not await is_moderator(message.from_user.id):
         await message.answer("❌ Только модераторы могут запускать ролевые!")
         return
     
@@ -631,11 +998,7 @@ async def start_roleplay_with_mode(message: types.Message, command: CommandObjec
     mode = command.args or "free"
     
     if mode not in ROLEPLAY_MODES:
-        modes_list = "\n".join([f"`{mode_id}` - {data['name']}" for mode_id, data in ROLEPLAY_MODES.items()])
-        await message.answer(
-            f"❌ Неизвестный режим! Доступные режимы:\n{modes_list}\n\n"
-            f"Пример: `/start_rp battle`"
-        )
+        await message.answer(render_cache.get("modes", "moderator", (), render_modes_text))
         return
     
     theme = ROLEPLAY_MODES[mode]["name"]
@@ -654,7 +1017,7 @@ async def start_roleplay_with_mode(message: types.Message, command: CommandObjec
     success, message_text = roleplay_manager.add_player(
         session_id,
         message.from_user.id,
-        creator_character,
+        CHARACTER_IDS[creator_character],
         message.from_user.username,
         message.from_user.first_name,
         message.from_user.last_name
@@ -675,23 +1038,20 @@ async def start_roleplay_with_mode(message: types.Message, command: CommandObjec
         reply_markup=create_join_keyboard(session)
     )
     
-    session["pinned_message_id"] = start_message.message_id
+    session.pinned_message_id = start_message.message_id
     
-    try:
-        if message.chat.type != "private":
-            await bot.pin_chat_message(chat_id, start_message.message_id)
-    except Exception as e:
-        logger.warning(f"Не удалось закрепить сообщение: {e}")
+    if message.chat.type != "private":
+        await pin_message(message.bot, chat_id, start_message.message_id)
     
-    asyncio.create_task(wait_for_players(session_id, chat_id))
+    asyncio.create_task(wait_for_players(message.bot, session_id, chat_id))
     await message.answer(f"✅ **Ролевая создана!** Вы добавлены как **{creator_character}**")
 
-@dp.message(Command("force_start"))
+@router.message(Command("force_start"))
 async def force_start_cmd(message: types.Message):
     """Принудительно начать ролевую не дожидаясь минуты"""
     logger.info(f"⚡ Команда /force_start от {message.from_user.id}")
     
-    if not is_moderator(message.from_user.id):
+    if not await is_moderator(message.from_user.id):
         await message.answer("❌ Только модераторы могут использовать принудительный старт!")
         return
     
@@ -699,14 +1059,14 @@ async def force_start_cmd(message: types.Message):
     
     session_id, session = roleplay_manager.get_session_by_chat(chat_id)
     
-    if not session or session["status"] != "waiting":
+    if not session or session.status is not SessionStatus.WAITING:
         await message.answer("❌ Нет активных ролевых в режиме ожидания!")
         return
     
-    success, initial_scene = roleplay_manager.force_start_session(session_id)
+    success, initial_scene = await roleplay_manager.force_start_session(session_id)
     
     if success:
-        players_list = "\n".join([f"• {data['character']} 👤" for data in session["players"].values()])
+        players_list = "\n".join([f"• {player.character} 👤" for player in session.players.values()])
         
         await message.answer(
             f"⚡ **РОЛЕВАЯ ЗАПУЩЕНА ПРИНУДИТЕЛЬНО!**\n\n"
@@ -715,23 +1075,21 @@ async def force_start_cmd(message: types.Message):
             f"💬 **Пишите сообщения от имени своих персонажей!**\n"
             f"🎬 **Когда история завершится, используйте /stop_rp**"
         )
+        await announce_new_achievements(message.bot, chat_id, session.players, session.new_achievements)
         
         # Открепляем сообщение с выбором ролей
-        try:
-            if session.get("pinned_message_id"):
-                await bot.unpin_chat_message(chat_id, session["pinned_message_id"])
-        except Exception as e:
-            logger.warning(f"Не удалось открепить сообщение: {e}")
+        if session.pinned_message_id:
+            await unpin_message(message.bot, chat_id, session.pinned_message_id)
             
     else:
         await message.answer(f"❌ Ошибка: {initial_scene}")
 
-@dp.message(Command("stop_rp"))
+@router.message(Command("stop_rp"))
 async def stop_roleplay(message: types.Message):
     """Завершить ролевую и показать статистику"""
     logger.info(f"🛑 Команда /stop_rp от {message.from_user.id}")
     
-    if not is_moderator(message.from_user.id):
+    if not await is_moderator(message.from_user.id):
         await message.answer("❌ Только модераторы могут останавливать ролевые!")
         return
     
@@ -740,46 +1098,76 @@ async def stop_roleplay(message: types.Message):
     session_id, session = roleplay_manager.get_session_by_chat(chat_id)
     
     if session:
-        success, stats = roleplay_manager.end_session(session_id)
+        success, stats = await roleplay_manager.end_session(session_id)
         
         if success:
-            players_list = "\n".join([f"• {data['character']}" for data in session["players"].values()])
-            
-            top_players_text = ""
-            if stats["top_players"]:
-                top_players_text = "\n🏆 **Топ активных игроков:**\n"
-                for i, player in enumerate(stats["top_players"], 1):
-                    medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉"
-                    top_players_text += f"{medal} {player['character']} ({player['first_name']}) - {player['messages_count']} сообщ.\n"
-            
             await message.answer(
                 f"🎬 **РОЛЕВАЯ ЗАВЕРШЕНА!** 🎬\n\n"
-                f"👥 **Участники:**\n{players_list}\n\n"
-                f"📊 **Статистика сессии:**\n"
-                f"• 👤 Игроков: {stats['total_players']}\n"
-                f"• 💬 Сообщений: {stats['total_messages']}\n"
-                f"• ⏱️ Длительность: {stats['session_duration'].seconds // 60} мин.\n"
-                f"{top_players_text}\n"
+                f"{render_session_results(session, stats)}\n"
                 f"🙏 **ОГРОМНОЕ СПАСИБО ВСЕМ ЗА УЧАСТИЕ!**\n"
                 f"💫 **Вы были прекрасны в своих ролях!**\n\n"
                 f"До следующих приключений! 👋"
             )
+            await announce_new_achievements(message.bot, chat_id, session.players, stats["new_achievements"])
             
-            try:
-                if message.chat.type != "private" and session.get("pinned_message_id"):
-                    await bot.unpin_chat_message(chat_id, session["pinned_message_id"])
-            except Exception as e:
-                logger.warning(f"Не удалось открепить сообщение: {e}")
+            if message.chat.type != "private" and session.pinned_message_id:
+                await unpin_message(message.bot, chat_id, session.pinned_message_id)
                 
         else:
             await message.answer("❌ Ошибка при завершении ролевой!")
     else:
         await message.answer("❌ Нет активных ролевых для остановки!")
 
+@router.message(Command("session_stats"))
+async def session_stats_cmd(message: types.Message):
+    """Живая статистика текущей ролевой"""
+    logger.info(f"📈 Команда /session_stats от {message.from_user.id}")
+    
+    session_id, session = roleplay_manager.get_session_by_chat(message.chat.id)
+    
+    if not session or session.status is not SessionStatus.ACTIVE:
+        await message.answer("❌ Сейчас в этом чате нет идущей ролевой!")
+        return
+    
+    players = session.players
+    activity = roleplay_manager.analytics.snapshot(session_id, players)
+    rate_minutes = ROLEPLAY_SETTINGS["activity_rate_minutes"]
+    
+    top_text = "\n".join([
+        f"• {players[user_id].character} - {recent} за {rate_minutes} мин. (всего {total})"
+        for user_id, recent, total in activity["top_players"]
+        if user_id in players
+    ]) or "• Пока никто не писал"
+    
+    idle_text = "\n".join([
+        f"• {players[user_id].character}" for user_id in activity["idle_players"]
+    ]) or "• Все в игре 🔥"
+    
+    await message.answer(
+        f"📈 **АКТИВНОСТЬ РОЛЕВОЙ** 📈\n\n"
+        f"💬 **Сообщений:** {activity['total_messages']}\n"
+        f"⚡ **Темп:** {activity['per_minute']:.1f} сообщ./мин\n\n"
+        f"🔥 **Самые активные:**\n{top_text}\n\n"
+        f"😴 **Молчат {ROLEPLAY_SETTINGS['idle_player_minutes']}+ мин.:**\n{idle_text}"
+    )
+
 # CALLBACK HANDLERS
-@dp.callback_query(F.data.startswith("join_"))
+@router.my_chat_member()
+async def bot_membership_changed(event: types.ChatMemberUpdated):
+    """Права бота в чате изменились - обновляем кэш возможностей"""
+    capability = chat_capabilities.update(event.chat.id, event.new_chat_member)
+    logger.info(f"🤖 Права бота в чате {event.chat.id}: {format_capability(capability)}")
+    # Запрет ставится, когда бот не может писать в чат; если он снова участник, запрет снимаем
+    db_manager.set_chat_allowed(event.chat.id, capability.is_member)
+
+@router.callback_query(F.data.startswith("join_"))
 async def join_roleplay(callback: types.CallbackQuery):
     character = callback.data.replace("join_", "")
+    # Кнопки, отправленные до перехода на номера персонажей, несут имя
+    character_id = int(character) if character.isdigit() else CHARACTER_IDS.get(character)
+    if character_id is None or character_id >= len(CHARACTER_NAMES):
+        await callback.answer("❌ Такой роли нет!")
+        return
     
     active_session_id, active_session = roleplay_manager.get_session_by_chat(callback.message.chat.id)
     
@@ -789,7 +1177,7 @@ async def join_roleplay(callback: types.CallbackQuery):
     
     session_id, session = active_session_id, active_session
     
-    can_join, reason = can_user_join_with_character(session, callback.from_user.id, character)
+    can_join, reason = can_user_join_with_character(session, callback.from_user.id, character_id)
     if not can_join:
         await callback.answer(f"❌ {reason}")
         return
@@ -797,7 +1185,7 @@ async def join_roleplay(callback: types.CallbackQuery):
     success, message_text = roleplay_manager.add_player(
         session_id, 
         callback.from_user.id,
-        character,
+        character_id,
         callback.from_user.username,
         callback.from_user.first_name,
         callback.from_user.last_name
@@ -807,16 +1195,15 @@ async def join_roleplay(callback: types.CallbackQuery):
         await callback.answer(f"✅ {message_text}")
         
         players_list = "\n".join([
-            f"• {data['character']} 👤" 
-            for data in session["players"].values()
+            f"• {player.character} 👤" 
+            for player in session.players.values()
         ]) or "• Пока никто не присоединился"
         
-        time_left = ROLEPLAY_SETTINGS["max_wait_time"] - (datetime.now() - datetime.fromisoformat(session["created_at"])).seconds
-        time_left = max(0, time_left)
+        time_left = max(0, ROLEPLAY_SETTINGS["max_wait_time"] - int(session.elapsed()))
         
         await callback.message.edit_text(
             f"🎭 **РОЛЕВАЯ НАЧИНАЕТСЯ!**\n\n"
-            f"📝 **Режим:** {session['theme']}\n"
+            f"📝 **Режим:** {session.theme}\n"
             f"⏰ **Осталось времени:** {time_left} сек\n"
             f"👥 **Участники:**\n{players_list}\n\n"
             f"**🎯 Выберите роль из списка ниже:**",
@@ -825,15 +1212,15 @@ async def join_roleplay(callback: types.CallbackQuery):
     else:
         await callback.answer(f"❌ {message_text}")
 
-@dp.callback_query(F.data == "role_taken")
+@router.callback_query(F.data == "role_taken")
 async def handle_role_taken(callback: types.CallbackQuery):
     await callback.answer("❌ Эта роль уже занята!")
 
-@dp.callback_query(F.data == "all_roles_taken")
+@router.callback_query(F.data == "all_roles_taken")
 async def handle_all_roles_taken(callback: types.CallbackQuery):
     await callback.answer("❌ Все роли заняты!")
 
-@dp.message()
+@router.message()
 async def handle_all_messages(message: types.Message):
     if message.text and message.text.startswith('/'):
         return
@@ -843,42 +1230,58 @@ async def handle_all_messages(message: types.Message):
     
     active_session_id, active_session = roleplay_manager.get_session_by_chat(chat_id)
     
-    if not active_session or active_session["status"] != "active":
+    if not active_session or active_session.status is not SessionStatus.ACTIVE:
         return
     
     session_id, session = active_session_id, active_session
     
-    if user_id in session["players"]:
-        character = session["players"][user_id]["character"]
+    player = session.players.get(user_id)
+    if player is not None:
+        character = player.character
         response_text = message.text or (message.caption if message.caption else "")
         
         if response_text:
             logger.info(f"💬 {character}: {response_text}")
+            roleplay_manager.transcripts.append(session_id, chat_id, user_id, character, response_text)
+            roleplay_manager.analytics.record(session_id, user_id)
             
-            session["players"][user_id]["messages_count"] = session["players"][user_id].get("messages_count", 0) + 1
+            player.messages_count += 1
+            session.touch()
             
-            db_manager.update_user_stats(user_id, responses_delta=1, messages_delta=1)
+            if not flood_control.allow(session_id, user_id):
+                # Сообщение остается в сессии, статистика уйдет одним обновлением со следующим или в конце сессии
+                player.deferred_messages += 1
+                if flood_control.should_notify(user_id):
+                    await notify_moderators_about_flood(message.bot, message, player)
+                return
             
-            new_achievements = db_manager.check_achievements(user_id)
-            if new_achievements:
-                for achievement_id in new_achievements:
-                    achievement = ACHIEVEMENTS[achievement_id]
-                    await message.answer(
-                        f"🎉 **НОВОЕ ДОСТИЖЕНИЕ!** 🎉\n\n"
-                        f"🏆 **{achievement['name']}**\n"
-                        f"📖 {achievement['desc']}\n\n"
-                        f"✨ Поздравляем, {message.from_user.first_name}!"
-                    )
+            # Запишется пачкой при следующем сбросе, достижения за реплики объявит flush_pending_writes
+            db_manager.count_messages(user_id, chat_id, 1 + player.deferred_messages)
+            player.deferred_messages = 0
+
+async def notify_moderators_about_flood(bot, message, player):
+    name = player.first_name or player.character
+    text = (
+        f"🌊 **Флуд в ролевой**\n\n"
+        f"👤 {name} (ID: {player.user_id}) в чате «{message.chat.title or message.chat.id}» пишет сверх лимита.\n"
+        f"Сообщения остаются в ролевой, статистика за них засчитается позже одним обновлением."
+    )
+    # Список из базы, а не MODERATORS: в многопроцессном режиме он есть только у фронта
+    for moderator_id in {ADMIN_ID, *(moderator['user_id'] for moderator in await db_manager.call("get_moderators"))}:
+        try:
+            await bot.send_message(moderator_id, text)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить модератора {moderator_id} о флуде: {e}")
 
-async def wait_for_players(session_id, chat_id):
+async def wait_for_players(bot, session_id, chat_id):
     await asyncio.sleep(ROLEPLAY_SETTINGS["max_wait_time"])
     
     session = roleplay_manager.get_session(session_id)
-    if session and session["status"] == "waiting":
+    if session and session.status is SessionStatus.WAITING:
         success, initial_scene = await roleplay_manager.start_session(session_id)
         
         if success:
-            players_list = "\n".join([f"• {data['character']} 👤" for data in session["players"].values()])
+            players_list = "\n".join([f"• {player.character} 👤" for player in session.players.values()])
             
             await bot.send_message(
                 chat_id,
@@ -888,41 +1291,133 @@ async def wait_for_players(session_id, chat_id):
                 f"💬 **Теперь просто пишите сообщения от имени своих персонажей!**\n"
                 f"🎬 **Когда история завершится, модератор использует /stop_rp**"
             )
+            await announce_new_achievements(bot, chat_id, session.players, session.new_achievements)
             
             # Открепляем сообщение с выбором ролей
-            try:
-                if session.get("pinned_message_id"):
-                    await bot.unpin_chat_message(chat_id, session["pinned_message_id"])
-            except Exception as e:
-                logger.warning(f"Не удалось открепить сообщение: {e}")
+            if session.pinned_message_id:
+                await unpin_message(bot, chat_id, session.pinned_message_id)
                 
         else:
             await bot.send_message(chat_id, f"❌ {initial_scene}")
-            roleplay_manager.end_session(session_id)
-
-def check_database():
-    import os
-    if os.path.exists('roleplay_bot.db'):
-        print("✅ База данных roleplay_bot.db существует!")
-        conn = sqlite3.connect('roleplay_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        print(f"✅ Создано таблиц: {len(tables)}")
-        for table in tables:
-            print(f"   - {table[0]}")
-        conn.close()
-    else:
-        print("❌ База данных еще не создана. Запустите бота один раз!")
+            await roleplay_manager.end_session(session_id)
 
-check_database()
+def render_session_results(session, stats):
+    """Участники, статистика и топ завершенной сессии"""
+    players_list = "\n".join([f"• {player.character}" for player in session.players.values()])
+    
+    top_players_text = ""
+    if stats["top_players"]:
+        top_players_text = "\n🏆 **Топ активных игроков:**\n"
+        for i, player in enumerate(stats["top_players"], 1):
+            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉"
+            top_players_text += f"{medal} {player.character} ({player.first_name}) - {player.messages_count} сообщ.\n"
+    
+    return (
+        f"👥 **Участники:**\n{players_list}\n\n"
+        f"📊 **Статистика сессии:**\n"
+        f"• 👤 Игроков: {stats['total_players']}\n"
+        f"• 💬 Сообщений: {stats['total_messages']}\n"
+        f"• ⏱️ Длительность: {int(stats['session_duration'] // 60)} мин.\n"
+        f"{top_players_text}"
+    )
+
+async def reap_idle_sessions(bot):
+    """Завершает ролевые, в которых давно никто не пишет, обычным путем end_session"""
+    idle_minutes = ROLEPLAY_SETTINGS["idle_session_minutes"]
+    while True:
+        await asyncio.sleep(ROLEPLAY_SETTINGS["reap_interval"])
+        session_ids = roleplay_manager.find_idle_sessions(idle_minutes * 60, ROLEPLAY_SETTINGS["reap_batch_size"])
+        for session_id in session_ids:
+            session = roleplay_manager.get_session(session_id)
+            if session is None or session.idle_for() < idle_minutes * 60:
+                continue
+            
+            success, stats = await roleplay_manager.end_session(session_id)
+            if not success:
+                continue
+            logger.info(f"⏰ Сессия {session_id} завершена по таймауту")
+            
+            summary = (
+                f"⏰ **РОЛЕВАЯ ЗАВЕРШЕНА АВТОМАТИЧЕСКИ**\n"
+                f"Никто не писал больше {idle_minutes} мин.\n\n"
+                f"{render_session_results(session, stats)}"
+            )
+            lines = achievement_lines(session.players, stats["new_achievements"])
+            if lines:
+                summary += "\n🎉 **НОВЫЕ ДОСТИЖЕНИЯ!**\n" + "\n".join(lines)
+            
+            try:
+                await bot.send_message(session.chat_id, summary)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить итог ролевой в чат {session.chat_id}: {e}")
+            if session.pinned_message_id and session.status is SessionStatus.WAITING:
+                await unpin_message(bot, session.chat_id, session.pinned_message_id)
+            # Отдаем цикл обработчикам между сессиями пачки
+            await asyncio.sleep(0)
+
+async def announce_chat_achievements(bot, chat_id, new_achievements):
+    """Достижения за реплики; имена игроков берем из ролевой чата, если она еще идет"""
+    _, session = roleplay_manager.get_session_by_chat(chat_id)
+    try:
+        await announce_new_achievements(bot, chat_id, session.players if session else {}, new_achievements)
+    except Exception as e:
+        logger.warning(f"Не удалось объявить достижения в чате {chat_id}: {e}")
+
+async def flush_pending_writes(bot):
+    """Периодически сбрасывает отложенные записи в базу и буфер записи апдейтов"""
+    while True:
+        await asyncio.sleep(DATABASE_SETTINGS["flush_interval"])
+        for chat_id, new_achievements in db_manager.apply_message_stats().items():
+            await announce_chat_achievements(bot, chat_id, new_achievements)
+        db_manager.flush()
+        update_recorder.flush()
+
+async def track_activity(handler, event, data):
+    """Внешний middleware: отмечает активность, чтобы обслуживание базы ждало затишья"""
+    maintenance_scheduler.touch()
+    return await handler(event, data)
+
+async def record_entities(handler, event, data):
+    """Внешний middleware: запоминает пользователей и чаты из апдейта в справочнике"""
+    entity_directory.remember_user(data.get("event_from_user"))
+    entity_directory.remember_chat(data.get("event_chat"))
+    message = event.message
+    if message is not None:
+        if message.reply_to_message is not None:
+            entity_directory.remember_user(message.reply_to_message.from_user)
+        for member in message.new_chat_members or ():
+            entity_directory.remember_user(member)
+    return await handler(event, data)
+
+def create_app(session=None, deduplicate=True):
+    """Собрать бота и диспетчер; до вызова модуль не делает ни сетевых, ни дисковых операций.
+    
+    session - своя сессия Bot API, например заглушка replay.py;
+    deduplicate=False - повторы уже отброшены раньше (воркеры sharding.py).
+    """
+    bot = Bot(token=BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=MemoryStorage())
+    if RECORDER_SETTINGS["enabled"]:
+        # Первым, чтобы в запись попадали все апдейты, даже отброшенные дальше
+        dp.update.outer_middleware(update_recorder.middleware)
+    if deduplicate:
+        dp.update.outer_middleware(update_deduplicator.middleware)
+    dp.update.outer_middleware(track_activity)
+    dp.update.outer_middleware(record_entities)
+    dp.include_router(router)
+    return bot, dp
 
 async def main():
+    logging.basicConfig(level=logging.INFO)
     logger.info("🎭 Бот запускается...")
     logger.info("💾 Инициализируем базу данных...")
     
+    bot, dp = create_app()
+    tables = db_manager.list_tables()
+    logger.info(f"✅ Таблиц в базе: {len(tables)}")
+    
     # Устанавливаем команды меню
-    await set_bot_commands()
+    await set_bot_commands(bot)
     
     db_manager.add_user(ADMIN_ID, "PicoFromTheVoid", "Главный", "Администратор")
     
@@ -933,7 +1428,25 @@ async def main():
     logger.info("✅ Бот готов к работе!")
     logger.info(f"👑 Главный администратор: {ADMIN_ID}")
     logger.info(f"🔧 Модераторов: {len(MODERATORS)}")
-    await dp.start_polling(bot)
+    
+    resumed = broadcast_manager.resume(bot)
+    if resumed:
+        logger.info(f"📣 Продолжаем прерванные рассылки: {resumed}")
+    
+    background_tasks = [
+        asyncio.create_task(flush_pending_writes(bot)),
+        asyncio.create_task(maintenance_scheduler.run()),
+        asyncio.create_task(reap_idle_sessions(bot)),
+        asyncio.create_task(backup_manager.run_schedule()),
+    ]
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        db_manager.apply_message_stats()
+        db_manager.flush()
+        update_recorder.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+from collections import deque
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramMigrateToChat,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+from config import BROADCAST_SETTINGS
+from database_manager import db_manager
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Ответы Telegram, после которых писать в чат бессмысленно
+REJECTED_ERRORS = ("chat not found", "have no rights", "not enough rights", "chat_write_forbidden", "bot was kicked")
+
+class BroadcastManager:
+    """Рассылка сообщения во все разрешенные чаты.
+    
+    Список адресатов фиксируется в базе при создании рассылки. Перед отправкой
+    чаты отмечаются как "sending" пачками по checkpoint_size одним commit, итоги
+    доставок пишутся такими же пачками вместе с остальными отложенными записями. После перезапуска
+    рассылка продолжается с неотправленных чатов; чат, застрявший в "sending",
+    второй раз не получает сообщение - лучше пропустить, чем повторить.
+    Несколько воркеров делят одно ведро токенов на весь бот.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._results = []
+        self._tasks = {}
+        # Одно ведро на все рассылки: общий лимит бота, а не каждой рассылки
+        self.bucket = TokenBucket(BROADCAST_SETTINGS["rate"], BROADCAST_SETTINGS["burst"])
+        db.register_migration("broadcasts_0001_tables", self._create_tables)
+        db.register_pending_writer(self._write_results, self._results.clear)
+    
+    def _create_tables(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                broadcast_id INTEGER PRIMARY KEY,
+                text TEXT,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                status TEXT DEFAULT 'running'
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id INTEGER,
+                chat_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                error TEXT,
+                PRIMARY KEY (broadcast_id, chat_id)
+            ) WITHOUT ROWID
+        ''')
+    
+    async def create(self, text, created_by):
+        """Создать рассылку по всем разрешенным чатам. Возвращает (ID, число адресатов) или (None, 0)"""
+        cursor = self.db.conn.cursor()
+        try:
+            # Адресаты берутся через хранилище: чаты могут лежать не в этой базе (MemoryStorage, писатель sharding.py)
+            chat_ids = [chat['chat_id'] for chat in await self.db.call("get_all_chats")]
+            cursor.execute('INSERT INTO broadcasts (text, created_by) VALUES (?, ?)', (text, created_by))
+            broadcast_id = cursor.lastrowid
+            cursor.executemany('''
+                INSERT INTO broadcast_deliveries (broadcast_id, chat_id)
+                VALUES (?, ?)
+            ''', [(broadcast_id, chat_id) for chat_id in chat_ids])
+            total = len(chat_ids)
+            self.db.conn.commit()
+            return broadcast_id, total
+        except Exception as e:
+            self.db.conn.rollback()
+            logger.error(f"Error creating broadcast: {e}")
+            return None, 0
+    
+    def get_progress(self, broadcast_id):
+        cursor = self.db.conn.cursor()
+        cursor.execute('SELECT * FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+        broadcast = cursor.fetchone()
+        if not broadcast:
+            return None
+        
+        cursor.execute('''
+            SELECT status, COUNT(*) as count
+            FROM broadcast_deliveries
+            WHERE broadcast_id = ?
+            GROUP BY status
+        ''', (broadcast_id,))
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        # Еще не записанные итоги тоже учитываем: в базе эти чаты пока "sending"
+        for result_id, _, status, _ in self._results:
+            if result_id == broadcast_id:
+                counts["sending"] = counts.get("sending", 0) - 1
+                counts[status] = counts.get(status, 0) + 1
+        
+        progress = dict(broadcast)
+        progress["counts"] = counts
+        progress["total"] = sum(counts.values())
+        return progress
+    
+    def get_last_broadcast_id(self):
+        cursor = self.db.conn.cursor()
+        cursor.execute('SELECT MAX(broadcast_id) FROM broadcasts')
+        return cursor.fetchone()[0]
+    
+    def _record(self, broadcast_id, chat_id, status, error=None):
+        self._results.append((broadcast_id, chat_id, status, error))
+        if len(self._results) >= BROADCAST_SETTINGS["checkpoint_size"]:
+            self.db.flush()
+    
+    def _mark_sending(self, broadcast_id, chat_ids):
+        # Отметка коммитится до отправки: после падения эти чаты не получат сообщение дважды
+        self.db.conn.executemany('''
+            UPDATE broadcast_deliveries SET status = 'sending'
+            WHERE broadcast_id = ? AND chat_id = ?
+        ''', [(broadcast_id, chat_id) for chat_id in chat_ids])
+        self.db.conn.commit()
+    
+    def _claim(self, broadcast_id, queue, claimed):
+        """Следующий чат для отправки; отмечает "sending" сразу пачку чатов из очереди"""
+        if not claimed:
+            chunk = []
+            while len(chunk) < BROADCAST_SETTINGS["checkpoint_size"] and not queue.empty():
+                chunk.append(queue.get_nowait())
+            if not chunk:
+                return None
+            self._mark_sending(broadcast_id, chunk)
+            claimed.extend(chunk)
+        return claimed.popleft()
+    
+    def _write_results(self, cursor):
+        if not self._results:
+            return
+        
+        cursor.executemany('''
+            UPDATE broadcast_deliveries SET status = ?, error = ?
+            WHERE broadcast_id = ? AND chat_id = ?
+        ''', [(status, error, broadcast_id, chat_id) for broadcast_id, chat_id, status, error in self._results])
+    
+    async def _deliver(self, bot, bucket, broadcast_id, chat_id, text):
+        target_id = chat_id
+        attempts = 0
+        waited = 0
+        while attempts < BROADCAST_SETTINGS["max_attempts"]:
+            await bucket.acquire()
+            try:
+                await bot.send_message(target_id, text)
+                self._record(broadcast_id, chat_id, "sent")
+                return
+            except TelegramRetryAfter as e:
+                # Флуд-контроль - не ошибка отправки: попытку не тратит, но ждать бесконечно не будем
+                waited += e.retry_after
+                if waited > BROADCAST_SETTINGS["max_retry_wait"]:
+                    self._record(broadcast_id, chat_id, "failed", "retry after limit")
+                    return
+                # Ждет только этот чат, остальные воркеры продолжают рассылку
+                logger.warning(f"⏳ Рассылка #{broadcast_id}: чат {target_id} просит подождать {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramMigrateToChat as e:
+                target_id = e.migrate_to_chat_id
+                # Иначе каждая следующая рассылка снова упрется в старый ID
+                await self.db.call("migrate_chat", chat_id, target_id)
+                logger.info(f"🔀 Чат {chat_id} стал супергруппой {target_id}")
+            except (TelegramForbiddenError, TelegramNotFound) as e:
+                self._reject(broadcast_id, chat_id, e)
+                return
+            except TelegramBadRequest as e:
+                if any(reason in str(e).lower() for reason in REJECTED_ERRORS):
+                    self._reject(broadcast_id, chat_id, e)
+                else:
+                    self._record(broadcast_id, chat_id, "failed", str(e))
+                return
+            except Exception as e:
+                logger.warning(f"Рассылка #{broadcast_id}: ошибка отправки в чат {chat_id}: {e}")
+                await asyncio.sleep(1)
+            attempts += 1
+        
+        self._record(broadcast_id, chat_id, "failed", "too many attempts")
+    
+    def _reject(self, broadcast_id, chat_id, error):
+        logger.info(f"🚫 Чат {chat_id} отклонил рассылку ({error}) - отмечен как запрещенный")
+        self._record(broadcast_id, chat_id, "rejected", str(error))
+        self.db.set_chat_allowed(chat_id, False)
+    
+    async def _worker(self, bot, bucket, broadcast_id, text, queue, claimed):
+        while True:
+            chat_id = self._claim(broadcast_id, queue, claimed)
+            if chat_id is None:
+                return
+            await self._deliver(bot, bucket, broadcast_id, chat_id, text)
+    
+    async def run(self, bot, broadcast_id):
+        """Разослать сообщение по еще не обработанным чатам рассылки"""
+        self.db.flush()
+        cursor = self.db.conn.cursor()
+        cursor.execute('SELECT text, created_by FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,))
+        broadcast = cursor.fetchone()
+        # Отправка в эти чаты прервалась на полпути: дошло ли сообщение, неизвестно
+        cursor.execute('''
+            UPDATE broadcast_deliveries SET status = 'failed', error = 'interrupted'
+            WHERE broadcast_id = ? AND status = 'sending'
+        ''', (broadcast_id,))
+        if cursor.rowcount:
+            logger.warning(f"Рассылка #{broadcast_id}: {cursor.rowcount} чатов прерваны при отправке, повторять не будем")
+        self.db.conn.commit()
+        cursor.execute('''
+            SELECT chat_id FROM broadcast_deliveries
+            WHERE broadcast_id = ? AND status = 'pending'
+        ''', (broadcast_id,))
+        queue = asyncio.Queue()
+        for row in cursor.fetchall():
+            queue.put_nowait(row['chat_id'])
+        # Уже отмеченные "sending", но еще не взятые воркерами чаты
+        claimed = deque()
+        
+        logger.info(f"📣 Рассылка #{broadcast_id}: осталось {queue.qsize()} чатов")
+        try:
+            await asyncio.gather(*(
+                self._worker(bot, self.bucket, broadcast_id, broadcast['text'], queue, claimed)
+                for _ in range(BROADCAST_SETTINGS["workers"])
+            ))
+            self.db.conn.execute('''
+                UPDATE broadcasts SET status = 'finished', finished_at = CURRENT_TIMESTAMP
+                WHERE broadcast_id = ?
+            ''', (broadcast_id,))
+        finally:
+            self.db.flush()
+        
+        progress = self.get_progress(broadcast_id)
+        counts = progress["counts"]
+        logger.info(f"✅ Рассылка #{broadcast_id} завершена: {counts}")
+        try:
+            await bot.send_message(
+                broadcast['created_by'],
+                f"📣 **Рассылка #{broadcast_id} завершена**\n\n"
+                f"✅ Доставлено: {counts.get('sent', 0)}\n"
+                f"🚫 Чат недоступен: {counts.get('rejected', 0)}\n"
+                f"❌ Ошибки: {counts.get('failed', 0)}"
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить итог рассылки: {e}")
+    
+    def start(self, bot, broadcast_id):
+        task = asyncio.create_task(self.run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+        return task
+    
+    def resume(self, bot):
+        """Продолжить рассылки, прерванные остановкой бота. Возвращает их число"""
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'")
+        broadcast_ids = [row['broadcast_id'] for row in cursor.fetchall()]
+        for broadcast_id in broadcast_ids:
+            if broadcast_id not in self._tasks:
+                self.start(bot, broadcast_id)
+        return len(broadcast_ids)
+
+broadcast_manager = BroadcastManager(db_manager)
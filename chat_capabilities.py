@@ -0,0 +1,117 @@
+import time
+import logging
+from config import DATABASE_SETTINGS
+from database_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+class Capability:
+    __slots__ = ("status", "can_pin", "can_delete", "updated_at")
+    
+    def __init__(self, status, can_pin, can_delete, updated_at):
+        self.status = status
+        self.can_pin = can_pin
+        self.can_delete = can_delete
+        self.updated_at = updated_at
+    
+    @property
+    def is_member(self):
+        return self.status not in ("left", "kicked")
+
+class ChatCapabilities:
+    """Права бота в чатах: что он может, а что заведомо получит отказ.
+    
+    Заполняется из get_chat_member для самого бота и обновляется апдейтами
+    my_chat_member; хранится в памяти и в базе. None в праве - неизвестно,
+    такой вызов пробуем и запоминаем результат.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._cache = {}
+        db.register_migration("capabilities_0001_table", self._create_table)
+    
+    def _create_table(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_capabilities (
+                chat_id INTEGER PRIMARY KEY,
+                status TEXT,
+                can_pin INTEGER,
+                can_delete INTEGER,
+                updated_at REAL
+            )
+        ''')
+    
+    def _load(self, chat_ids):
+        missing = [chat_id for chat_id in chat_ids if chat_id not in self._cache]
+        if not missing:
+            return
+        cursor = self.db.conn.cursor()
+        cursor.execute(f'''
+            SELECT chat_id, status, can_pin, can_delete, updated_at
+            FROM chat_capabilities
+            WHERE chat_id IN ({", ".join("?" for _ in missing)})
+        ''', missing)
+        for row in cursor.fetchall():
+            self._cache[row['chat_id']] = Capability(
+                row['status'],
+                None if row['can_pin'] is None else bool(row['can_pin']),
+                None if row['can_delete'] is None else bool(row['can_delete']),
+                row['updated_at']
+            )
+    
+    def _save(self, chat_id, capability):
+        self._cache[chat_id] = capability
+        cursor = self.db.conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO chat_capabilities (chat_id, status, can_pin, can_delete, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, capability.status, capability.can_pin, capability.can_delete, capability.updated_at))
+            self.db.conn.commit()
+        except Exception as e:
+            logger.error(f"Error saving chat capabilities: {e}")
+    
+    def update(self, chat_id, member):
+        """Запомнить права бота по объекту ChatMember (из get_chat_member или my_chat_member)"""
+        status = member.status.value if hasattr(member.status, "value") else member.status
+        if status in ("left", "kicked"):
+            can_pin = can_delete = False
+        elif status == "creator":
+            can_pin = can_delete = True
+        else:
+            # У обычного участника закреп зависит от настроек чата - узнаем при первой попытке
+            can_pin = getattr(member, "can_pin_messages", None)
+            can_delete = getattr(member, "can_delete_messages", None)
+        capability = Capability(status, can_pin, can_delete, time.time())
+        self._save(chat_id, capability)
+        return capability
+    
+    def get_cached(self, chat_ids):
+        """Известные права для списка чатов без обращений к Telegram"""
+        self._load(chat_ids)
+        return {chat_id: self._cache[chat_id] for chat_id in chat_ids if chat_id in self._cache}
+    
+    async def get(self, bot, chat_id):
+        self._load([chat_id])
+        capability = self._cache.get(chat_id)
+        if capability is not None and time.time() - capability.updated_at < DATABASE_SETTINGS["capability_ttl"]:
+            return capability
+        try:
+            member = await bot.get_chat_member(chat_id, bot.id)
+        except Exception as e:
+            logger.warning(f"Не удалось получить права бота в чате {chat_id}: {e}")
+            return capability
+        return self.update(chat_id, member)
+    
+    async def can_pin(self, bot, chat_id):
+        capability = await self.get(bot, chat_id)
+        return capability is None or capability.can_pin is not False
+    
+    def deny_pin(self, chat_id):
+        """Telegram отказал в закрепе - больше не пробуем до обновления прав"""
+        capability = self._cache.get(chat_id) or Capability("member", None, None, time.time())
+        capability.can_pin = False
+        self._save(chat_id, capability)
+
+chat_capabilities = ChatCapabilities(db_manager)
@@ -55,6 +55,100 @@ ROLEPLAY_SETTINGS = {
     "max_wait_time": 60,
     "min_players": 1,
     "max_players": 21,
+    "activity_window_minutes": 60,
+    "activity_rate_minutes": 5,
+    "idle_player_minutes": 10,
+    "idle_session_minutes": 60,
+    "reap_interval": 60,
+    "reap_batch_size": 20,
+}
+
+DATABASE_SETTINGS = {
+    # "sqlite" - файл path; "memory" - все в памяти процесса, для бенчмарков и проверок;
+    # "shard" ставит sharding.py своим воркерам
+    "backend": "sqlite",
+    "path": "roleplay_bot.db",
+    "busy_timeout": 5,
+    "profile_cache_size": 1024,
+    "identity_cache_size": 4096,
+    "write_batch_size": 200,
+    "flush_interval": 5,
+    "export_fetch_size": 500,
+    "import_batch_size": 5000,
+    "daily_stats_retention_days": 90,
+    "rollup_compaction_interval": 24 * 60 * 60,
+    "chat_top_size": 10,
+    "chat_top_cache_size": 256,
+    "capability_ttl": 6 * 60 * 60,
+}
+
+BACKUP_SETTINGS = {
+    "directory": "backups",
+    "interval": 6 * 60 * 60,
+    "keep": 7,
+    "pages_per_step": 256,
+    "step_sleep": 0.01,
+}
+
+BROADCAST_SETTINGS = {
+    "rate": 25,
+    "burst": 25,
+    "workers": 8,
+    "max_attempts": 5,
+    # Ожидание по RetryAfter не тратит попытки, но суммарно ограничено (секунды на чат)
+    "max_retry_wait": 600,
+    "checkpoint_size": 20,
+}
+
+MAINTENANCE_SETTINGS = {
+    "check_interval": 60,
+    "quiet_seconds": 120,
+    "slice_seconds": 0.05,
+    "slice_pause": 0.5,
+    "optimize_interval": 6 * 60 * 60,
+    "analysis_limit": 400,
+    "vacuum_interval": 60 * 60,
+    "vacuum_pages_per_step": 64,
+    "retention_interval": 24 * 60 * 60,
+    "retention_batch_size": 500,
+    "stale_chat_days": 30,
+    "transcript_retention_days": 180,
+}
+
+# Лимит сообщений ролевой: сверх него сообщения остаются в сессии, а статистика копится
+# и уходит одним обновлением; rate - сообщений в секунду, burst - разовый запас
+FLOOD_SETTINGS = {
+    "user_rate": 0.5,
+    "user_burst": 5,
+    "session_rate": 3,
+    "session_burst": 20,
+    "notify_moderators": False,
+    "notice_cooldown": 10 * 60,
+    "sweep_interval": 60,
+}
+
+# Сколько последних update_id помнить, чтобы отбросить повторную доставку после перезапуска
+DEDUP_SETTINGS = {
+    "window_size": 4096,
+}
+
+# Многопроцессный режим (sharding.py): воркеры по chat_id и один процесс-писатель
+SHARDING_SETTINGS = {
+    "workers": 4,
+    "storage_timeout": 10,
+    # Как часто писатель применяет статистику реплик, присланную воркерами без ожидания ответа
+    "stats_interval": 1,
+}
+
+# Запись входящих апдейтов для replay.py; включается только явно
+RECORDER_SETTINGS = {
+    "enabled": False,
+    "directory": "captures",
+    "max_bytes": 64 * 1024 * 1024,
+    "keep": 20,
+    "compress_level": 6,
+    "pseudonymize": True,
+    "salt": "",
 }
 
 ROLEPLAY_MODES = {
@@ -0,0 +1,123 @@
+import csv
+import json
+import logging
+from itertools import islice
+from config import DATABASE_SETTINGS
+from database_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+# Таблицы в порядке импорта: сначала те, на которые ссылаются другие
+TABLES = {
+    "users": ("user_id", "username", "first_name", "last_name", "joined_at",
+              "total_responses", "sessions_played", "total_messages"),
+    "user_achievements": ("user_id", "achievement_id", "unlocked_at"),
+    "chats": ("chat_id", "chat_title", "chat_type", "added_by", "added_at", "is_allowed", "status_changed_at"),
+    "moderators": ("user_id", "username", "first_name", "added_by", "added_at"),
+}
+
+FORMATS = ("jsonl", "csv")
+
+class DataTransfer:
+    """Потоковая выгрузка и загрузка таблиц в JSONL/CSV.
+    
+    Выгрузка читает отдельным соединением порциями через fetchmany, загрузка
+    пишет пачками executemany в одной транзакции и проверяет внешние ключи
+    только в конце - память не зависит от размера таблицы.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+    
+    def iter_rows(self, conn, table):
+        columns = ", ".join(TABLES[table])
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {columns} FROM {table} ORDER BY rowid')
+        while True:
+            rows = cursor.fetchmany(DATABASE_SETTINGS["export_fetch_size"])
+            if not rows:
+                break
+            yield from rows
+    
+    def export_table(self, table, output, fmt="jsonl"):
+        """Записать таблицу в открытый текстовый файл output. Возвращает число строк"""
+        columns = TABLES[table]
+        self.db.flush()
+        conn = self.db.open_reader()
+        try:
+            rows = self.iter_rows(conn, table)
+            if fmt == "csv":
+                writer = csv.writer(output)
+                writer.writerow(columns)
+                count = 0
+                for row in rows:
+                    writer.writerow(tuple(row))
+                    count += 1
+                return count
+            
+            count = 0
+            for row in rows:
+                output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                output.write("\n")
+                count += 1
+            return count
+        finally:
+            conn.close()
+    
+    def read_records(self, table, source, fmt="jsonl"):
+        """Кортежи значений в порядке колонок таблицы из открытого файла source.
+        
+        Отсутствующая колонка дает None - import_table подставит вместо него значение по умолчанию.
+        """
+        columns = TABLES[table]
+        if fmt == "csv":
+            # В CSV нет NULL - пустая ячейка считается отсутствующим значением
+            for record in csv.DictReader(source):
+                yield tuple(record.get(column) or None for column in columns)
+            return
+        
+        for line in source:
+            if line.strip():
+                record = json.loads(line)
+                yield tuple(record.get(column) for column in columns)
+    
+    def import_table(self, table, records, batch_size=None):
+        """Загрузить записи в таблицу (существующие строки заменяются). Возвращает число строк"""
+        batch_size = batch_size or DATABASE_SETTINGS["import_batch_size"]
+        columns = TABLES[table]
+        records = iter(records)
+        
+        self.db.flush()
+        conn = self.db.conn
+        cursor = conn.cursor()
+        # Явный NULL вместо DEFAULT оставил бы счетчики NULL навсегда (total_responses + ? = NULL),
+        # а чат без added_at выпал бы из постраничного списка
+        defaults = {row['name']: row['dflt_value'] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        placeholders = ", ".join(
+            "?" if defaults.get(column) is None else f"COALESCE(?, {defaults[column]})"
+            for column in columns
+        )
+        sql = f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) VALUES ({placeholders})'
+        count = 0
+        try:
+            cursor.execute('BEGIN')
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                cursor.executemany(sql, batch)
+                count += len(batch)
+            
+            violations = cursor.execute(f'PRAGMA foreign_key_check({table})').fetchall()
+            if violations:
+                raise ValueError(f"{len(violations)} строк ссылаются на несуществующие записи")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        self.db.reset_caches()
+        logger.info(f"📥 Загружено строк в {table}: {count}")
+        return count
+
+data_transfer = DataTransfer(db_manager)
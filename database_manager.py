@@ -1,19 +1,224 @@
 import sqlite3
+import json
 import logging
-from datetime import datetime
-from config import ACHIEVEMENTS
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from config import ACHIEVEMENTS, DATABASE_SETTINGS
+from storage import Storage
 
 logger = logging.getLogger(__name__)
 
-class DatabaseManager:
-    def __init__(self):
-        self.conn = sqlite3.connect('roleplay_bot.db', check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
-        self.create_tables()
+# Кэшируется только профиль с этим числом последних достижений (его показывает /stats):
+# ключ кэша - user_id, и сбрасывается он одним pop
+CACHED_PROFILE_RECENT_LIMIT = 3
+
+class LRUCache:
+    """Простой LRU-кэш фиксированного размера"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+    
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+    
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        return self._data.pop(key, None)
+    
+    def values(self):
+        return self._data.values()
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteDatabase:
+    """Файл SQLite со схемой из миграций и общей транзакцией отложенных записей.
+    
+    Соединение открывается лениво при первом обращении к conn, тогда же
+    применяются еще не примененные миграции схемы (каждая ровно один раз).
+    Модули со своими таблицами (стенограммы, рассылки и т.п.) работают с
+    хранилищем только через этот интерфейс, какое бы хранилище ни было.
+    """
+    def __init__(self, path=None):
+        self.path = path or DATABASE_SETTINGS["path"]
+        self._conn = None
+        # Отложенные записи: (запись в открытую транзакцию, сброс буфера после commit)
+        self._pending_writers = []
+        self._migrations = []
     
-    def create_tables(self):
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._connect()
+        return self._conn
+    
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DATABASE_SETTINGS["busy_timeout"], uri=True)
+        self._conn.row_factory = sqlite3.Row
+        # lower() в SQLite понимает только ASCII, а названия чатов в основном кириллические
+        self._conn.create_function("casefold", 1, lambda value: value.casefold() if value else value, deterministic=True)
+        # Новая база сразу создается с инкрементальным вакуумом; старая перейдет на него после vacuum()
+        self._conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL: читатели (CLI, выгрузки, бэкапы) не блокируют бота и наоборот
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self.migrate()
+        logger.info("✅ База данных инициализирована")
+    
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+    
+    def register_migration(self, name, migration):
+        """Добавить миграцию схемы; migration(cursor) выполняется один раз за всю жизнь базы"""
+        self._migrations.append((name, migration))
+        if self._conn is not None:
+            self.migrate()
+    
+    def migrate(self):
         cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('SELECT name FROM schema_migrations')
+        applied = {row['name'] for row in cursor.fetchall()}
         
+        for name, migration in self._migrations:
+            if name in applied:
+                continue
+            try:
+                migration(cursor)
+                cursor.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            applied.add(name)
+            logger.info(f"🧱 Миграция {name} применена")
+    
+    def get_applied_migrations(self):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT name, applied_at FROM schema_migrations ORDER BY applied_at, name')
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def get_table_schema(self, table):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,))
+        result = cursor.fetchone()
+        return result['sql'] if result else None
+    
+    def list_tables(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+        return [row['name'] for row in cursor.fetchall()]
+    
+    def vacuum(self):
+        """Полная пересборка файла базы; на время работы блокирует запись"""
+        self.flush()
+        self.conn.execute('VACUUM')
+    
+    def incremental_vacuum(self, pages):
+        """Вернуть системе до pages свободных страниц. Возвращает, сколько свободных страниц осталось"""
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        self.flush()
+        self.conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        return self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+    
+    def optimize(self, analysis_limit):
+        """Обновить статистику планировщика там, где она устарела; analysis_limit ограничивает ANALYZE"""
+        self.conn.execute(f'PRAGMA analysis_limit = {int(analysis_limit)}')
+        self.conn.execute('PRAGMA optimize')
+    
+    def register_pending_writer(self, write, reset):
+        """Подключить буфер отложенных записей к общей транзакции flush()"""
+        self._pending_writers.append((write, reset))
+    
+    def _write_pending(self, cursor):
+        for write, _ in self._pending_writers:
+            write(cursor)
+    
+    def _pending_committed(self):
+        for _, reset in self._pending_writers:
+            reset()
+    
+    def flush(self):
+        """Записать все отложенные изменения одной транзакцией"""
+        cursor = self.conn.cursor()
+        try:
+            self._write_pending(cursor)
+            self.conn.commit()
+            self._pending_committed()
+            return True
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error flushing pending writes: {e}")
+            return False
+    
+    def open_reader(self):
+        """Отдельное read-only соединение для тяжелых чтений вне основного потока"""
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+class DatabaseManager(SQLiteDatabase, Storage):
+    """Хранилище бота в SQLite"""
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._moderator_ids = None
+        self._moderator_ids_version = None
+        self._profiles = LRUCache(DATABASE_SETTINGS["profile_cache_size"])
+        self._identities = LRUCache(DATABASE_SETTINGS["identity_cache_size"])
+        self._chat_tops = LRUCache(DATABASE_SETTINGS["chat_top_cache_size"])
+        self._message_stats = {}  # chat_id -> {user_id: реплик}, см. count_messages
+        self._pending_identities = {}
+        self._pending_writers.append((self._write_identities, self._pending_identities.clear))
+        self._migrations += [
+            ("0001_base_tables", self._create_base_tables),
+            ("0002_cleanup_duplicate_achievements", self._cleanup_duplicate_achievements),
+            ("0003_user_daily_stats", self._create_daily_stats_table),
+            ("0004_chat_user_stats", self._create_chat_stats_table),
+            ("0005_chats_status_changed_at", self._add_chat_status_changed_at),
+            ("0006_chats_added_at_index", self._create_chats_page_index),
+            ("0007_moderators_version", self._create_moderators_version),
+        ]
+    
+    def iter_user_stats(self, batch_size=500):
+        """Статистика всех игроков порциями через fetchmany"""
+        self._flush_identities()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT user_id, username, first_name, last_name, joined_at, 
+                   total_responses, sessions_played, total_messages
+            FROM users
+            ORDER BY user_id
+        ''')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    
+    def _create_base_tables(self, cursor):
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chats (
                 chat_id INTEGER PRIMARY KEY,
@@ -58,16 +263,62 @@ class DatabaseManager:
                 UNIQUE(user_id, achievement_id)
             )
         ''')
-        
-        self.conn.commit()
-        logger.info("✅ База данных инициализирована")
+    
+    def _create_daily_stats_table(self, cursor):
+        # Дневные корзины статистики для недельных/месячных топов;
+        # responses - очки рейтинга, по ним индекс (day, responses)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_daily_stats (
+                day TEXT,
+                user_id INTEGER,
+                responses INTEGER DEFAULT 0,
+                sessions INTEGER DEFAULT 0,
+                messages INTEGER DEFAULT 0,
+                PRIMARY KEY (day, user_id)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_daily_stats_day_score ON user_daily_stats (day, responses)')
+    
+    def _create_chat_stats_table(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_user_stats (
+                chat_id INTEGER,
+                user_id INTEGER,
+                total_responses INTEGER DEFAULT 0,
+                sessions_played INTEGER DEFAULT 0,
+                total_messages INTEGER DEFAULT 0,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_stats_responses ON chat_user_stats (chat_id, total_responses)')
+    
+    def _add_chat_status_changed_at(self, cursor):
+        # Когда чат последний раз разрешили/запретили - от этой даты считается срок хранения
+        cursor.execute('ALTER TABLE chats ADD COLUMN status_changed_at TIMESTAMP')
+        cursor.execute('UPDATE chats SET status_changed_at = added_at')
+    
+    def _create_chats_page_index(self, cursor):
+        # Постраничный /chats: ключ страницы (added_at, chat_id) среди разрешенных чатов
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_allowed_added ON chats (is_allowed, added_at, chat_id)')
+    
+    def _create_moderators_version(self, cursor):
+        # Номер версии списка модераторов ведут триггеры: его видят все процессы,
+        # как бы список ни изменили (бот, другой шард, manage.py, импорт)
+        cursor.execute('CREATE TABLE IF NOT EXISTS moderators_version (version INTEGER NOT NULL)')
+        cursor.execute('INSERT INTO moderators_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM moderators_version)')
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS moderators_version_{event.lower()} AFTER {event} ON moderators BEGIN
+                    UPDATE moderators_version SET version = version + 1;
+                END
+            ''')
     
     def add_chat(self, chat_id, chat_title, chat_type, added_by):
         cursor = self.conn.cursor()
         try:
             cursor.execute('''
-                INSERT OR REPLACE INTO chats (chat_id, chat_title, chat_type, added_by, is_allowed)
-                VALUES (?, ?, ?, ?, 1)
+                INSERT OR REPLACE INTO chats (chat_id, chat_title, chat_type, added_by, is_allowed, status_changed_at)
+                VALUES (?, ?, ?, ?, 1, CURRENT_TIMESTAMP)
             ''', (chat_id, chat_title, chat_type, added_by))
             self.conn.commit()
             return True
@@ -77,10 +328,46 @@ class DatabaseManager:
     
     def get_all_chats(self):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT chat_id, chat_title, chat_type, added_at FROM chats WHERE is_allowed = 1 ORDER BY added_at DESC')
+        cursor.execute('SELECT chat_id, chat_title, chat_type, added_at FROM chats WHERE is_allowed = 1 ORDER BY added_at DESC, chat_id DESC')
         results = cursor.fetchall()
         return [dict(row) for row in results]
     
+    def get_chats_page(self, after=None, before=None, title_prefix=None, limit=10):
+        """Страница разрешенных чатов, новые первыми.
+        
+        after / before - ключ (added_at, chat_id) последнего / первого чата соседней страницы.
+        Возвращает (чаты, есть_еще): есть_еще относится к направлению листания.
+        """
+        conditions = ['is_allowed = 1']
+        params = []
+        if after is not None:
+            conditions.append('(added_at, chat_id) < (?, ?)')
+            params.extend(after)
+        elif before is not None:
+            conditions.append('(added_at, chat_id) > (?, ?)')
+            params.extend(before)
+        if title_prefix:
+            escaped = title_prefix.casefold().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            conditions.append("casefold(chat_title) LIKE ? ESCAPE '\\'")
+            params.append(escaped + '%')
+        
+        order = 'ASC' if before is not None else 'DESC'
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT chat_id, chat_title, chat_type, added_at
+            FROM chats
+            WHERE {' AND '.join(conditions)}
+            ORDER BY added_at {order}, chat_id {order}
+            LIMIT ?
+        ''', (*params, limit + 1))
+        results = [dict(row) for row in cursor.fetchall()]
+        
+        has_more = len(results) > limit
+        results = results[:limit]
+        if before is not None:
+            results.reverse()
+        return results, has_more
+    
     def remove_chat(self, chat_id):
         cursor = self.conn.cursor()
         try:
@@ -91,42 +378,204 @@ class DatabaseManager:
             logger.error(f"Error removing chat: {e}")
             return False
     
-    def add_user(self, user_id, username, first_name, last_name):
+    def set_chat_allowed(self, chat_id, allowed):
         cursor = self.conn.cursor()
         try:
             cursor.execute('''
-                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            
-            cursor.execute('''
-                UPDATE users SET username = ?, first_name = ?, last_name = ?
-                WHERE user_id = ?
-            ''', (username, first_name, last_name, user_id))
-            
+                UPDATE chats SET is_allowed = ?, status_changed_at = CURRENT_TIMESTAMP
+                WHERE chat_id = ? AND is_allowed != ?
+            ''', (int(allowed), chat_id, int(allowed)))
             self.conn.commit()
-            return True
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error updating chat: {e}")
+            return False
+    
+    def migrate_chat(self, old_chat_id, new_chat_id):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('UPDATE OR IGNORE chats SET chat_id = ? WHERE chat_id = ?', (new_chat_id, old_chat_id))
+            migrated = cursor.rowcount > 0
+            cursor.execute('DELETE FROM chats WHERE chat_id = ?', (old_chat_id,))
+            self.conn.commit()
+            return migrated
         except Exception as e:
-            logger.error(f"Error adding user: {e}")
+            self.conn.rollback()
+            logger.error(f"Error migrating chat: {e}")
             return False
     
-    def update_user_stats(self, user_id, responses_delta=0, sessions_delta=0, messages_delta=0):
+    def prune_stale_chats(self, retention_days, limit=500):
+        """Удалить до limit чатов, запрещенных дольше retention_days дней. Возвращает число удаленных"""
         cursor = self.conn.cursor()
         try:
             cursor.execute('''
-                UPDATE users 
-                SET total_responses = total_responses + ?,
-                    sessions_played = sessions_played + ?,
-                    total_messages = total_messages + ?
-                WHERE user_id = ?
-            ''', (responses_delta, sessions_delta, messages_delta, user_id))
+                DELETE FROM chats WHERE chat_id IN (
+                    SELECT chat_id FROM chats
+                    WHERE is_allowed = 0 AND COALESCE(status_changed_at, added_at) < datetime('now', ?)
+                    LIMIT ?
+                )
+            ''', (f"-{int(retention_days)} days", limit))
             self.conn.commit()
+            return cursor.rowcount
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error pruning chats: {e}")
+            return 0
+    
+    def add_user(self, user_id, username, first_name, last_name):
+        """Запомнить имя пользователя; в базу попадают только реальные изменения"""
+        identity = (username, first_name, last_name)
+        if self._identities.get(user_id) == identity:
+            return True
+        
+        self._identities.put(user_id, identity)
+        self._pending_identities[user_id] = identity
+        self._profiles.pop(user_id)
+        self._rename_in_chat_tops(user_id, username, first_name)
+        
+        if len(self._pending_identities) >= DATABASE_SETTINGS["write_batch_size"]:
+            return self.flush()
+        return True
+    
+    def _write_identities(self, cursor):
+        if not self._pending_identities:
+            return
+        
+        cursor.executemany('''
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name
+            WHERE username IS NOT excluded.username
+               OR first_name IS NOT excluded.first_name
+               OR last_name IS NOT excluded.last_name
+        ''', [(user_id, *identity) for user_id, identity in self._pending_identities.items()])
+        
+        for user_id in self._pending_identities:
+            self._profiles.pop(user_id)
+    
+    def _rename_in_chat_tops(self, user_id, username, first_name):
+        """Поправить имя игрока в закэшированных топах чатов (топ хранит его копию)"""
+        for top in self._chat_tops.values():
+            for row in top:
+                if row['user_id'] == user_id:
+                    row['username'] = username
+                    row['first_name'] = first_name
+                    break
+    
+    def reset_caches(self):
+        """Сбросить кэши после массового изменения таблиц в обход методов менеджера"""
+        self._profiles.clear()
+        self._identities.clear()
+        self._chat_tops.clear()
+        self._moderator_ids = None
+    
+    def _flush_identities(self):
+        """Дописать отложенные имена перед запросами, которые соединяют таблицы с users"""
+        if self._pending_identities:
+            self.flush()
+    
+    def _apply_stat_deltas(self, cursor, deltas, chat_id=None):
+        """Общий путь записи статистики: итоги в users, дневные корзины и счетчики чата.
+        
+        Возвращает свежие строки чата для закэшированного топа (или None) -
+        их нужно передать в _merge_chat_top после commit.
+        """
+        cursor.executemany('''
+            UPDATE users 
+            SET total_responses = total_responses + ?,
+                sessions_played = sessions_played + ?,
+                total_messages = total_messages + ?
+            WHERE user_id = ?
+        ''', [(responses, sessions, messages, user_id) for user_id, responses, sessions, messages in deltas])
+        
+        day = datetime.now().strftime('%Y-%m-%d')
+        cursor.executemany('''
+            INSERT INTO user_daily_stats (day, user_id, responses, sessions, messages)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(day, user_id) DO UPDATE SET
+                responses = responses + excluded.responses,
+                sessions = sessions + excluded.sessions,
+                messages = messages + excluded.messages
+        ''', [(day, user_id, responses, sessions, messages) for user_id, responses, sessions, messages in deltas])
+        
+        if chat_id is None:
+            return None
+        
+        cursor.executemany('''
+            INSERT INTO chat_user_stats (chat_id, user_id, total_responses, sessions_played, total_messages)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                total_responses = total_responses + excluded.total_responses,
+                sessions_played = sessions_played + excluded.sessions_played,
+                total_messages = total_messages + excluded.total_messages
+        ''', [(chat_id, user_id, responses, sessions, messages) for user_id, responses, sessions, messages in deltas])
+        
+        if chat_id not in self._chat_tops:
+            return None
+        
+        user_ids = list(dict.fromkeys(delta[0] for delta in deltas))
+        placeholders = ", ".join("?" * len(user_ids))
+        cursor.execute(f'''
+            SELECT c.user_id, u.username, u.first_name, c.total_responses, c.sessions_played, c.total_messages
+            FROM chat_user_stats c
+            LEFT JOIN users u ON u.user_id = c.user_id
+            WHERE c.chat_id = ? AND c.user_id IN ({placeholders})
+        ''', [chat_id, *user_ids])
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def _merge_chat_top(self, chat_id, rows):
+        """Обновить закэшированный топ чата строками изменившихся игроков.
+        
+        Счетчики только растут, поэтому игрок вне топа может попасть в него
+        лишь через собственное изменение - слияния достаточно для точного топа.
+        """
+        top = self._chat_tops.get(chat_id)
+        if top is None or not rows:
+            return
+        
+        updated = {row['user_id']: row for row in rows}
+        merged = [row for row in top if row['user_id'] not in updated] + list(updated.values())
+        merged.sort(key=lambda row: (-row['total_responses'], -row['sessions_played'], row['user_id']))
+        self._chat_tops.put(chat_id, merged[:DATABASE_SETTINGS["chat_top_size"]])
+    
+    def get_chat_top_players(self, chat_id, limit=10):
+        top = self._chat_tops.get(chat_id)
+        if top is None:
+            self._flush_identities()
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                SELECT c.user_id, u.username, u.first_name, c.total_responses, c.sessions_played, c.total_messages
+                FROM chat_user_stats c
+                LEFT JOIN users u ON u.user_id = c.user_id
+                WHERE c.chat_id = ?
+                ORDER BY c.total_responses DESC, c.sessions_played DESC, c.user_id
+                LIMIT ?
+            ''', (chat_id, DATABASE_SETTINGS["chat_top_size"]))
+            top = [dict(row) for row in cursor.fetchall()]
+            self._chat_tops.put(chat_id, top)
+        return [row for row in top[:limit] if row['total_responses'] > 0 or row['sessions_played'] > 0]
+    
+    def update_user_stats(self, user_id, responses_delta=0, sessions_delta=0, messages_delta=0, chat_id=None):
+        cursor = self.conn.cursor()
+        try:
+            self._write_pending(cursor)
+            chat_rows = self._apply_stat_deltas(cursor, [(user_id, responses_delta, sessions_delta, messages_delta)], chat_id)
+            self.conn.commit()
+            self._pending_committed()
+            self._profiles.pop(user_id)
+            self._merge_chat_top(chat_id, chat_rows)
             return True
         except Exception as e:
+            self.conn.rollback()
             logger.error(f"Error updating user stats: {e}")
             return False
     
     def get_user_stats(self, user_id):
+        if user_id in self._pending_identities:
+            self.flush()
         cursor = self.conn.cursor()
         cursor.execute('SELECT username, first_name, total_responses, sessions_played, total_messages FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
@@ -134,6 +583,44 @@ class DatabaseManager:
             return dict(result)
         return None
     
+    def get_user_profile(self, user_id, recent_limit=3):
+        """Статистика, число достижений и последние разблокировки одним запросом"""
+        cacheable = recent_limit == CACHED_PROFILE_RECENT_LIMIT
+        profile = self._profiles.get(user_id) if cacheable else None
+        if profile is not None:
+            return profile
+        
+        if user_id in self._pending_identities:
+            self.flush()
+        
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT 
+                u.username, 
+                u.first_name, 
+                u.total_responses, 
+                u.sessions_played, 
+                u.total_messages,
+                (SELECT COUNT(*) FROM user_achievements ua WHERE ua.user_id = u.user_id) as achievements_count,
+                (SELECT json_group_array(json_object('achievement_id', achievement_id, 'unlocked_at', unlocked_at))
+                 FROM (SELECT achievement_id, unlocked_at 
+                       FROM user_achievements ua 
+                       WHERE ua.user_id = u.user_id 
+                       ORDER BY unlocked_at DESC, id DESC 
+                       LIMIT ?)) as recent_achievements
+            FROM users u
+            WHERE u.user_id = ?
+        ''', (recent_limit, user_id))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        
+        profile = dict(result)
+        profile['recent_achievements'] = json.loads(profile['recent_achievements'])
+        if cacheable:
+            self._profiles.put(user_id, profile)
+        return profile
+    
     def add_moderator(self, user_id, username, first_name, added_by):
         cursor = self.conn.cursor()
         try:
@@ -142,6 +629,7 @@ class DatabaseManager:
                 VALUES (?, ?, ?, ?)
             ''', (user_id, username, first_name, added_by))
             self.conn.commit()
+            self._moderator_ids = None
             return True
         except Exception as e:
             logger.error(f"Error adding moderator: {e}")
@@ -152,27 +640,37 @@ class DatabaseManager:
         try:
             cursor.execute('DELETE FROM moderators WHERE user_id = ?', (user_id,))
             self.conn.commit()
+            self._moderator_ids = None
             return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Error removing moderator: {e}")
             return False
     
     def get_moderators(self):
+        self._flush_identities()
         cursor = self.conn.cursor()
         cursor.execute('''
             SELECT m.user_id, m.username, m.first_name, m.added_at,
                    u.username as added_by_username
             FROM moderators m
             LEFT JOIN users u ON m.added_by = u.user_id
-            ORDER BY m.added_at
+            ORDER BY m.added_at, m.user_id
         ''')
         results = cursor.fetchall()
         return [dict(row) for row in results]
     
+    def moderators_version(self):
+        return self.conn.execute('SELECT version FROM moderators_version').fetchone()[0]
+    
     def is_moderator(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT 1 FROM moderators WHERE user_id = ?', (user_id,))
-        return cursor.fetchone() is not None
+        # Версия меняется, только когда меняется сам список, в том числе из другого процесса (manage.py)
+        version = self.moderators_version()
+        if self._moderator_ids is None or version != self._moderator_ids_version:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT user_id FROM moderators')
+            self._moderator_ids = {row['user_id'] for row in cursor.fetchall()}
+            self._moderator_ids_version = version
+        return user_id in self._moderator_ids
     
     def unlock_achievement(self, user_id, achievement_id):
         cursor = self.conn.cursor()
@@ -185,6 +683,7 @@ class DatabaseManager:
             
             if cursor.rowcount > 0:
                 self.conn.commit()
+                self._profiles.pop(user_id)
                 logger.info(f"✅ Достижение {achievement_id} разблокировано для пользователя {user_id}")
                 return True
             else:
@@ -201,7 +700,7 @@ class DatabaseManager:
             SELECT achievement_id, unlocked_at 
             FROM user_achievements 
             WHERE user_id = ? 
-            ORDER BY unlocked_at DESC
+            ORDER BY unlocked_at DESC, id DESC
         ''', (user_id,))
         results = cursor.fetchall()
         return [dict(row) for row in results]
@@ -211,29 +710,61 @@ class DatabaseManager:
         cursor.execute('SELECT 1 FROM user_achievements WHERE user_id = ? AND achievement_id = ?', (user_id, achievement_id))
         return cursor.fetchone() is not None
     
-    def check_achievements(self, user_id):
-        stats = self.get_user_stats(user_id)
-        if not stats:
-            return []
-        
-        new_achievements = []
+    def apply_stats_batch(self, deltas, chat_id=None):
+        """Применить изменения статистики нескольких игроков и проверить их достижения одной транзакцией.
         
-        # Проверяем и разблокируем достижения
-        achievements_to_check = [
-            ("first_roleplay", stats['sessions_played'] >= 1),
-            ("active_participant", stats['total_responses'] >= 10),
-            ("veteran", stats['sessions_played'] >= 5),
-            ("word_master", stats['total_messages'] >= 50),
-            ("social_butterfly", stats['sessions_played'] >= 10)
-        ]
+        deltas - список (user_id, responses_delta, sessions_delta, messages_delta);
+        chat_id - чат, в счетчики которого дополнительно идут изменения.
+        Возвращает {user_id: [новые достижения]}.
+        """
+        deltas = [delta for delta in deltas if any(delta[1:])]
+        if not deltas:
+            self.flush()
+            return {}
         
-        for achievement_id, condition in achievements_to_check:
-            if condition and not self.has_achievement(user_id, achievement_id):
-                if self.unlock_achievement(user_id, achievement_id):
-                    new_achievements.append(achievement_id)
-                    logger.info(f"🎉 Новое достижение {achievement_id} для пользователя {user_id}")
-        
-        return new_achievements
+        user_ids = list(dict.fromkeys(delta[0] for delta in deltas))
+        placeholders = ", ".join("?" * len(user_ids))
+        cursor = self.conn.cursor()
+        try:
+            self._write_pending(cursor)
+            chat_rows = self._apply_stat_deltas(cursor, deltas, chat_id)
+            
+            cursor.execute(f'''
+                SELECT user_id, total_responses, sessions_played, total_messages 
+                FROM users WHERE user_id IN ({placeholders})
+            ''', user_ids)
+            earned = {row['user_id']: self._earned_achievements(row) for row in cursor.fetchall()}
+            
+            cursor.execute(f'''
+                SELECT user_id, achievement_id FROM user_achievements 
+                WHERE user_id IN ({placeholders})
+            ''', user_ids)
+            unlocked = {(row['user_id'], row['achievement_id']) for row in cursor.fetchall()}
+            
+            new_achievements = {}
+            for user_id, achievement_ids in earned.items():
+                fresh = [achievement_id for achievement_id in achievement_ids if (user_id, achievement_id) not in unlocked]
+                if fresh:
+                    new_achievements[user_id] = fresh
+            
+            cursor.executemany('''
+                INSERT OR IGNORE INTO user_achievements (user_id, achievement_id) 
+                VALUES (?, ?)
+            ''', [(user_id, achievement_id) for user_id, fresh in new_achievements.items() for achievement_id in fresh])
+            
+            self.conn.commit()
+            self._pending_committed()
+            for user_id in user_ids:
+                self._profiles.pop(user_id)
+            self._merge_chat_top(chat_id, chat_rows)
+            
+            for user_id, fresh in new_achievements.items():
+                logger.info(f"🎉 Новые достижения {', '.join(fresh)} для пользователя {user_id}")
+            return new_achievements
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error applying stats batch: {e}")
+            return {}
     
     def get_achievements_count(self, user_id):
         """Получить точное количество достижений пользователя"""
@@ -243,6 +774,7 @@ class DatabaseManager:
         return result['count'] if result else 0
     
     def get_top_players(self, limit=10):
+        self._flush_identities()
         cursor = self.conn.cursor()
         cursor.execute('''
             SELECT 
@@ -255,35 +787,114 @@ class DatabaseManager:
                 (SELECT COUNT(*) FROM user_achievements ua WHERE ua.user_id = u.user_id) as achievements_count
             FROM users u
             WHERE u.total_responses > 0 OR u.sessions_played > 0
-            ORDER BY u.total_responses DESC, u.sessions_played DESC
+            ORDER BY u.total_responses DESC, u.sessions_played DESC, u.user_id
             LIMIT ?
         ''', (limit,))
         results = cursor.fetchall()
         return [dict(row) for row in results]
     
-    def cleanup_duplicate_achievements(self):
-        """Очистка дубликатов достижений (для исправления проблемы)"""
+    def get_top_players_for_period(self, start_day, end_day, limit=10):
+        """Топ за период по дневным корзинам; дни в формате YYYY-MM-DD, включительно"""
+        self._flush_identities()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT 
+                d.user_id, 
+                u.username, 
+                u.first_name, 
+                d.total_responses, 
+                d.sessions_played, 
+                d.total_messages
+            FROM (
+                SELECT 
+                    user_id, 
+                    SUM(responses) as total_responses, 
+                    SUM(sessions) as sessions_played, 
+                    SUM(messages) as total_messages
+                FROM user_daily_stats
+                WHERE day BETWEEN ? AND ?
+                GROUP BY user_id
+            ) d
+            LEFT JOIN users u ON u.user_id = d.user_id
+            WHERE d.total_responses > 0 OR d.sessions_played > 0
+            ORDER BY d.total_responses DESC, d.sessions_played DESC, d.user_id
+            LIMIT ?
+        ''', (start_day, end_day, limit))
+        results = cursor.fetchall()
+        return [dict(row) for row in results]
+    
+    def compact_daily_stats(self, retention_days):
+        """Сжать дневные корзины старше retention_days в месячные (строка с днем YYYY-MM-01)"""
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-01')
         cursor = self.conn.cursor()
         try:
-            # Удаляем дубликаты достижений, оставляя только первую запись
             cursor.execute('''
-                DELETE FROM user_achievements 
-                WHERE id NOT IN (
-                    SELECT MIN(id) 
-                    FROM user_achievements 
-                    GROUP BY user_id, achievement_id
+                CREATE TEMP TABLE IF NOT EXISTS compacted_daily_stats (
+                    day TEXT, user_id INTEGER, responses INTEGER, sessions INTEGER, messages INTEGER
                 )
             ''')
+            cursor.execute('DELETE FROM compacted_daily_stats')
+            cursor.execute('''
+                INSERT INTO compacted_daily_stats
+                SELECT substr(day, 1, 7) || '-01', user_id, SUM(responses), SUM(sessions), SUM(messages)
+                FROM user_daily_stats
+                WHERE day < ?
+                GROUP BY substr(day, 1, 7), user_id
+            ''', (cutoff,))
+            cursor.execute('DELETE FROM user_daily_stats WHERE day < ?', (cutoff,))
             deleted_count = cursor.rowcount
+            cursor.execute('INSERT INTO user_daily_stats SELECT * FROM compacted_daily_stats')
+            compacted_count = cursor.rowcount
+            cursor.execute('DELETE FROM compacted_daily_stats')
+            self.conn.commit()
+            if deleted_count > compacted_count:
+                logger.info(f"🗜️ Дневная статистика сжата: {deleted_count} -> {compacted_count} строк")
+            return deleted_count - compacted_count
+        except Exception as e:
+            self.conn.rollback()
+            logger.error(f"Error compacting daily stats: {e}")
+            return 0
+    
+    def _cleanup_duplicate_achievements(self, cursor):
+        # Удаляем дубликаты достижений, оставляя только первую запись
+        cursor.execute('''
+            DELETE FROM user_achievements 
+            WHERE id NOT IN (
+                SELECT MIN(id) 
+                FROM user_achievements 
+                GROUP BY user_id, achievement_id
+            )
+        ''')
+        deleted_count = cursor.rowcount
+        if deleted_count > 0:
+            logger.info(f"🧹 Удалено {deleted_count} дубликатов достижений")
+        return deleted_count
+    
+    def cleanup_duplicate_achievements(self):
+        """Очистка дубликатов достижений (для исправления проблемы)"""
+        cursor = self.conn.cursor()
+        try:
+            deleted_count = self._cleanup_duplicate_achievements(cursor)
             self.conn.commit()
-            if deleted_count > 0:
-                logger.info(f"🧹 Удалено {deleted_count} дубликатов достижений")
+            self._profiles.clear()
             return deleted_count
         except Exception as e:
             logger.error(f"Error cleaning duplicate achievements: {e}")
             return 0
 
-db_manager = DatabaseManager()
+def create_storage(backend=None):
+    """Хранилище, выбранное в DATABASE_SETTINGS["backend"] ("sqlite", "memory" или "shard")"""
+    backend = backend or DATABASE_SETTINGS["backend"]
+    if backend == "memory":
+        from memory_storage import MemoryStorage
+        return MemoryStorage()
+    if backend == "shard":
+        # Воркер многопроцессного режима; к писателю его подключает sharding.py
+        from shard_storage import ShardStorage
+        return ShardStorage()
+    if backend != "sqlite":
+        raise ValueError(f"Неизвестное хранилище: {backend}")
+    return DatabaseManager()
 
-# При инициализации очистим возможные дубликаты
-db_manager.cleanup_duplicate_achievements()
\ No newline at end of file
+# Соединение с базой откроется при первом запросе, импорт модуля ничего не читает с диска
+db_manager = create_storage()
\ No newline at end of file
@@ -0,0 +1,134 @@
+from config import DATABASE_SETTINGS
+from database_manager import db_manager, LRUCache
+
+class Entity:
+    """Пользователь или чат из справочника; атрибуты совпадают с aiogram Chat"""
+    
+    __slots__ = ("id", "type", "username", "first_name", "last_name", "title")
+    
+    def __init__(self, id, type, username=None, first_name=None, last_name=None, title=None):
+        self.id = id
+        self.type = type
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.title = title
+    
+    def key(self):
+        return (self.type, self.username, self.first_name, self.last_name, self.title)
+
+class EntityDirectory:
+    """Справочник пользователей и чатов, встреченных в апдейтах.
+    
+    Заполняется пассивно из middleware; в базу уходят только изменения,
+    пачками вместе с остальными отложенными записями db_manager.
+    Позволяет находить @username и ID без сетевого get_chat.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._known = LRUCache(DATABASE_SETTINGS["identity_cache_size"])
+        self._pending = {}
+        db.register_migration("entities_0001_table", self._create_table)
+        db.register_pending_writer(self._write_pending, self._pending.clear)
+    
+    def _create_table(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                entity_id INTEGER PRIMARY KEY,
+                type TEXT,
+                username TEXT,
+                username_lower TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                title TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_entities_username ON entities (username_lower, updated_at)')
+    
+    def remember(self, entity):
+        if entity.id is None:
+            return
+        key = entity.key()
+        if self._known.get(entity.id) == key:
+            return
+        
+        self._known.put(entity.id, key)
+        self._pending[entity.id] = entity
+        if len(self._pending) >= DATABASE_SETTINGS["write_batch_size"]:
+            self.db.flush()
+    
+    def remember_user(self, user):
+        if user is not None:
+            self.remember(Entity(user.id, "private", user.username, user.first_name, user.last_name))
+    
+    def remember_chat(self, chat):
+        if chat is not None:
+            self.remember(Entity(chat.id, chat.type, chat.username, chat.first_name, chat.last_name, chat.title))
+    
+    def _write_pending(self, cursor):
+        if not self._pending:
+            return
+        
+        cursor.executemany('''
+            INSERT INTO entities (entity_id, type, username, username_lower, first_name, last_name, title)
+            VALUES (?, ?, ?, lower(?), ?, ?, ?)
+            ON CONFLICT(entity_id) DO UPDATE SET
+                type = excluded.type,
+                username = excluded.username,
+                username_lower = excluded.username_lower,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                title = excluded.title,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE username IS NOT excluded.username
+               OR first_name IS NOT excluded.first_name
+               OR last_name IS NOT excluded.last_name
+               OR title IS NOT excluded.title
+        ''', [
+            (e.id, e.type, e.username, e.username, e.first_name, e.last_name, e.title)
+            for e in self._pending.values()
+        ])
+    
+    def resolve(self, query, entity_type=None):
+        """Найти сущность по '@username', 'username' или числовому ID; None, если бот ее не встречал.
+        
+        entity_type ограничивает поиск одним типом ('private' - только пользователи):
+        юзернеймы у пользователей, каналов и групп общие.
+        """
+        query = str(query).strip()
+        username = query.lstrip("@")
+        if query.lstrip("-").isdigit():
+            entity_id = int(query)
+            pending = self._pending.get(entity_id)
+            if pending is not None:
+                return pending if entity_type in (None, pending.type) else None
+            where, values = "entity_id = ?", [entity_id]
+        else:
+            for entity in self._pending.values():
+                if entity.username and entity.username.lower() == username.lower() and entity_type in (None, entity.type):
+                    return entity
+            # Юзернейм мог перейти к другому владельцу - берем того, кого видели последним
+            where, values = "username_lower = lower(?)", [username]
+        
+        if entity_type is not None:
+            where += " AND type = ?"
+            values.append(entity_type)
+        
+        cursor = self.db.conn.cursor()
+        cursor.execute(f'''
+            SELECT entity_id, type, username, first_name, last_name, title
+            FROM entities
+            WHERE {where}
+            ORDER BY updated_at DESC
+            LIMIT 1
+        ''', values)
+        result = cursor.fetchone()
+        return Entity(*result) if result else None
+    
+    def resolve_user(self, query):
+        """Как resolve, но только среди пользователей"""
+        return self.resolve(query, "private")
+
+entity_directory = EntityDirectory(db_manager)
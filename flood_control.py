@@ -0,0 +1,71 @@
+import time
+from config import FLOOD_SETTINGS
+from rate_limit import TokenBucket
+
+class FloodControl:
+    """Лимит сообщений ролевой: ведро на игрока и ведро на сессию.
+    
+    Ведра создаются при первом сообщении и удаляются, когда успели бы наполниться
+    снова: полное ведро ничем не отличается от нового, поэтому удаление ничего не
+    меняет. Сообщение сверх лимита остается в сессии, а его статистику откладывает
+    вызывающий код.
+    """
+    
+    def __init__(self):
+        self._user_buckets = {}
+        self._session_buckets = {}
+        self._notified_at = {}
+        self._swept_at = time.monotonic()
+    
+    def allow(self, session_id, user_id, now=None):
+        """True - сообщение в пределах обоих лимитов, токены списаны"""
+        now = time.monotonic() if now is None else now
+        if now - self._swept_at >= FLOOD_SETTINGS["sweep_interval"]:
+            self.evict_idle(now)
+        
+        user_bucket = self._user_buckets.get(user_id)
+        if user_bucket is None:
+            user_bucket = self._user_buckets[user_id] = TokenBucket(
+                FLOOD_SETTINGS["user_rate"], FLOOD_SETTINGS["user_burst"], now
+            )
+        session_bucket = self._session_buckets.get(session_id)
+        if session_bucket is None:
+            session_bucket = self._session_buckets[session_id] = TokenBucket(
+                FLOOD_SETTINGS["session_rate"], FLOOD_SETTINGS["session_burst"], now
+            )
+        
+        # Списываем только если хватает обоим, иначе сессия теряла бы токены за чужой флуд
+        if user_bucket.delay(now) > 0 or session_bucket.delay(now) > 0:
+            return False
+        user_bucket.try_acquire(now)
+        session_bucket.try_acquire(now)
+        return True
+    
+    def should_notify(self, user_id, now=None):
+        """Сообщать ли модераторам о флуде игрока: не чаще раза в notice_cooldown"""
+        if not FLOOD_SETTINGS["notify_moderators"]:
+            return False
+        now = time.monotonic() if now is None else now
+        notified_at = self._notified_at.get(user_id)
+        if notified_at is not None and now - notified_at < FLOOD_SETTINGS["notice_cooldown"]:
+            return False
+        self._notified_at[user_id] = now
+        return True
+    
+    def evict_idle(self, now=None):
+        """Удалить ведра, которые уже наполнились бы до краев. Возвращает число удаленных"""
+        now = time.monotonic() if now is None else now
+        self._swept_at = now
+        evicted = 0
+        for buckets in (self._user_buckets, self._session_buckets):
+            idle = [key for key, bucket in buckets.items() if bucket.delay(now, bucket.capacity) == 0]
+            for key in idle:
+                del buckets[key]
+            evicted += len(idle)
+        
+        cooldown = FLOOD_SETTINGS["notice_cooldown"]
+        for user_id in [user_id for user_id, notified_at in self._notified_at.items() if now - notified_at >= cooldown]:
+            del self._notified_at[user_id]
+        return evicted
+
+flood_control = FloodControl()
@@ -0,0 +1,104 @@
+import time
+import asyncio
+import logging
+from config import DATABASE_SETTINGS, MAINTENANCE_SETTINGS
+from database_manager import db_manager
+from transcript_store import transcript_store
+
+logger = logging.getLogger(__name__)
+
+class MaintenanceJob:
+    __slots__ = ("name", "interval", "step", "next_run")
+    
+    def __init__(self, name, interval, step):
+        self.name = name
+        self.interval = interval
+        self.step = step
+        self.next_run = 0.0
+
+class MaintenanceScheduler:
+    """Фоновое обслуживание базы в тихие периоды.
+    
+    Работа режется на короткие порции (не дольше slice_seconds) с паузами
+    между ними; как только в бот приходит апдейт, задача откладывается
+    до следующего затишья и продолжается с того же места.
+    """
+    
+    def __init__(self, db, transcripts):
+        self.db = db
+        self.transcripts = transcripts
+        self.last_activity = time.monotonic()
+        self._jobs = []
+        
+        self.add_job("optimize", MAINTENANCE_SETTINGS["optimize_interval"], self._optimize_step)
+        self.add_job("rollups", DATABASE_SETTINGS["rollup_compaction_interval"], self._compact_rollups_step)
+        self.add_job("retention", MAINTENANCE_SETTINGS["retention_interval"], self._retention_step)
+        self.add_job("incremental_vacuum", MAINTENANCE_SETTINGS["vacuum_interval"], self._vacuum_step)
+    
+    def add_job(self, name, interval, step):
+        """step(deadline) делает порцию работы до deadline (time.monotonic) и возвращает True, когда все сделано"""
+        self._jobs.append(MaintenanceJob(name, interval, step))
+    
+    def touch(self):
+        self.last_activity = time.monotonic()
+    
+    def is_quiet(self):
+        return time.monotonic() - self.last_activity >= MAINTENANCE_SETTINGS["quiet_seconds"]
+    
+    def _optimize_step(self, deadline):
+        self.db.optimize(MAINTENANCE_SETTINGS["analysis_limit"])
+        return True
+    
+    def _compact_rollups_step(self, deadline):
+        self.db.compact_daily_stats(DATABASE_SETTINGS["daily_stats_retention_days"])
+        return True
+    
+    def _retention_step(self, deadline):
+        batch_size = MAINTENANCE_SETTINGS["retention_batch_size"]
+        while time.monotonic() < deadline:
+            chats = self.db.prune_stale_chats(MAINTENANCE_SETTINGS["stale_chat_days"], batch_size)
+            history = self.transcripts.prune_history(MAINTENANCE_SETTINGS["transcript_retention_days"], batch_size)
+            if chats or history:
+                logger.info(f"🧹 Удалено устаревших чатов: {chats}, строк истории: {history}")
+            if chats < batch_size and history < batch_size:
+                return True
+        return False
+    
+    def _vacuum_step(self, deadline):
+        while time.monotonic() < deadline:
+            if self.db.incremental_vacuum(MAINTENANCE_SETTINGS["vacuum_pages_per_step"]) == 0:
+                return True
+        return False
+    
+    async def _run_job(self, job):
+        """Прогнать задачу порциями; False - прервана активностью и будет продолжена позже"""
+        while self.is_quiet():
+            deadline = time.monotonic() + MAINTENANCE_SETTINGS["slice_seconds"]
+            try:
+                if job.step(deadline):
+                    return True
+            except Exception as e:
+                logger.error(f"Error running maintenance job {job.name}: {e}")
+                return True
+            await asyncio.sleep(MAINTENANCE_SETTINGS["slice_pause"])
+        return False
+    
+    async def run(self):
+        """Фоновая задача: раз в check_interval секунд запускает подошедшие задачи, если бот простаивает"""
+        while True:
+            await asyncio.sleep(MAINTENANCE_SETTINGS["check_interval"])
+            for job in self._jobs:
+                if time.monotonic() < job.next_run:
+                    continue
+                if not await self._run_job(job):
+                    break
+                job.next_run = time.monotonic() + job.interval
+    
+    def run_all(self):
+        """Выполнить все задачи целиком, без порций и ожидания затишья (для manage.py)"""
+        for job in self._jobs:
+            while not job.step(float("inf")):
+                pass
+            logger.info(f"🛠️ Обслуживание {job.name} выполнено")
+
+maintenance_scheduler = MaintenanceScheduler(db_manager, transcript_store)
@@ -0,0 +1,169 @@
+"""Обслуживание базы бота из командной строки.
+
+Не импортирует aiogram и не создает Bot - стартует мгновенно и может
+работать рядом с запущенным ботом (база в режиме WAL).
+
+    python manage.py schema
+    python manage.py chats
+    python manage.py moderators list
+    python manage.py moderators add 123456789 --username nick --first-name Имя
+    python manage.py moderators remove 123456789
+    python manage.py export-stats > stats.csv
+    python manage.py export users > users.jsonl
+    python manage.py export chats --format csv --output chats.csv
+    python manage.py import users users.jsonl
+    python manage.py backup
+    python manage.py backup /mnt/usb/roleplay_bot.db
+    python manage.py vacuum
+    python manage.py maintenance
+"""
+import sys
+import csv
+import argparse
+from config import ADMIN_ID
+from database_manager import db_manager
+from backups import backup_manager
+from maintenance import maintenance_scheduler
+from data_transfer import data_transfer, TABLES, FORMATS
+
+def schema_cmd(args):
+    tables = db_manager.list_tables()
+    print(f"✅ База данных: {db_manager.path}")
+    print(f"✅ Таблиц: {len(tables)}")
+    for table in tables:
+        print(f"   - {table}")
+        if args.sql:
+            print(f"     {db_manager.get_table_schema(table)}")
+    
+    print("\n🧱 Примененные миграции:")
+    for migration in db_manager.get_applied_migrations():
+        print(f"   - {migration['name']} ({migration['applied_at']})")
+
+def chats_cmd(args):
+    chats = db_manager.get_all_chats()
+    if not chats:
+        print("📋 Бот пока не добавлен ни в один чат")
+        return
+    
+    for chat in chats:
+        print(f"{chat['chat_id']}\t{chat['chat_type']}\t{chat['chat_title']}")
+
+def moderators_cmd(args):
+    if args.action == "list":
+        for mod in db_manager.get_moderators():
+            print(f"{mod['user_id']}\t@{mod['username'] or '-'}\t{mod['first_name']}\t{mod['added_at']}")
+        return
+    
+    if args.user_id is None:
+        sys.exit("❌ Укажите ID пользователя")
+    
+    if args.action == "add":
+        if args.user_id == ADMIN_ID:
+            sys.exit("❌ Этот пользователь уже главный администратор!")
+        if not db_manager.add_moderator(args.user_id, args.username or "", args.first_name or "Пользователь", ADMIN_ID):
+            sys.exit("❌ Ошибка при добавлении модератора")
+        print(f"✅ Модератор {args.user_id} добавлен")
+    else:
+        if not db_manager.remove_moderator(args.user_id):
+            sys.exit(f"❌ Модератор {args.user_id} не найден!")
+        print(f"✅ Модератор {args.user_id} удален")
+
+def export_stats_cmd(args):
+    columns = ["user_id", "username", "first_name", "last_name", "joined_at",
+               "total_responses", "sessions_played", "total_messages"]
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    for row in db_manager.iter_user_stats():
+        writer.writerow([row[column] for column in columns])
+
+def detect_format(args, path):
+    if args.format:
+        return args.format
+    return "csv" if path and path.endswith(".csv") else "jsonl"
+
+def export_cmd(args):
+    fmt = detect_format(args, args.output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as output:
+            count = data_transfer.export_table(args.table, output, fmt)
+        print(f"✅ Выгружено строк: {count} -> {args.output}", file=sys.stderr)
+    else:
+        data_transfer.export_table(args.table, sys.stdout, fmt)
+
+def import_cmd(args):
+    fmt = detect_format(args, args.path)
+    with open(args.path, encoding="utf-8", newline="") as source:
+        try:
+            count = data_transfer.import_table(args.table, data_transfer.read_records(args.table, source, fmt))
+        except Exception as e:
+            sys.exit(f"❌ Импорт отменен: {e}")
+    print(f"✅ Загружено строк в {args.table}: {count}")
+
+def backup_cmd(args):
+    db_manager.flush()
+    if args.path:
+        result = backup_manager.backup(args.path)
+    else:
+        result = backup_manager.run_backup()
+    
+    if result["integrity"] != "ok":
+        sys.exit(f"❌ Копия не прошла проверку целостности: {result['integrity']}")
+    print(f"✅ Резервная копия сохранена: {result['path']} ({result['size'] // 1024} КБ за {result['duration']:.2f} с)")
+
+def vacuum_cmd(args):
+    db_manager.vacuum()
+    print("✅ VACUUM выполнен")
+
+def maintenance_cmd(args):
+    maintenance_scheduler.run_all()
+    print("✅ Обслуживание базы выполнено")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Обслуживание базы ролевого бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    schema = commands.add_parser("schema", help="таблицы и миграции")
+    schema.add_argument("--sql", action="store_true", help="показать CREATE-выражения")
+    schema.set_defaults(handler=schema_cmd)
+    
+    commands.add_parser("chats", help="список чатов").set_defaults(handler=chats_cmd)
+    
+    moderators = commands.add_parser("moderators", help="управление модераторами")
+    moderators.add_argument("action", choices=["list", "add", "remove"])
+    moderators.add_argument("user_id", type=int, nargs="?")
+    moderators.add_argument("--username")
+    moderators.add_argument("--first-name")
+    moderators.set_defaults(handler=moderators_cmd)
+    
+    commands.add_parser("export-stats", help="статистика игроков в CSV на stdout").set_defaults(handler=export_stats_cmd)
+    
+    export = commands.add_parser("export", help="выгрузить таблицу в JSONL/CSV")
+    export.add_argument("table", choices=list(TABLES))
+    export.add_argument("--format", choices=FORMATS)
+    export.add_argument("--output", help="файл (по умолчанию stdout)")
+    export.set_defaults(handler=export_cmd)
+    
+    load = commands.add_parser("import", help="загрузить таблицу из JSONL/CSV")
+    load.add_argument("table", choices=list(TABLES))
+    load.add_argument("path")
+    load.add_argument("--format", choices=FORMATS)
+    load.set_defaults(handler=import_cmd)
+    
+    backup = commands.add_parser("backup", help="резервная копия базы (по умолчанию - в каталог бэкапов с ротацией)")
+    backup.add_argument("path", nargs="?")
+    backup.set_defaults(handler=backup_cmd)
+    
+    commands.add_parser("vacuum", help="пересобрать файл базы").set_defaults(handler=vacuum_cmd)
+    commands.add_parser("maintenance", help="ANALYZE, очистка устаревших данных и инкрементальный вакуум").set_defaults(handler=maintenance_cmd)
+    
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.handler(args)
+    finally:
+        db_manager.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+import heapq
+import bisect
+import sqlite3
+import logging
+import itertools
+from datetime import datetime, timedelta, timezone
+from config import DATABASE_SETTINGS
+from database_manager import SQLiteDatabase
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+STATS_COLUMNS = ("username", "first_name", "total_responses", "sessions_played", "total_messages")
+CHAT_COLUMNS = ("chat_id", "chat_title", "chat_type", "added_at")
+
+_database_ids = itertools.count(1)
+
+def _timestamp(days=0):
+    """Текущее время UTC в формате CURRENT_TIMESTAMP, со сдвигом на days дней"""
+    return (datetime.now(timezone.utc) + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def _add_counters(table, key, counters):
+    current = table.get(key)
+    if current is None:
+        table[key] = list(counters)
+    else:
+        for index, value in enumerate(counters):
+            current[index] += value
+
+class MemoryStorage(SQLiteDatabase, Storage):
+    """Хранилище бота в памяти процесса, без обращений к диску.
+    
+    Пользователи, статистика, достижения, модераторы и чаты лежат в словарях,
+    разрешенные чаты - еще и в отсортированном списке ключей (added_at, chat_id)
+    для постраничного /chats. Методы Storage реализованы здесь все до одного;
+    SQLite в памяти есть только для стенограмм, рассылок и прочих модулей со
+    своими таблицами. После перезапуска ничего не сохраняется;
+    выгрузка и импорт manage.py работают только с SQLite.
+    """
+    
+    def __init__(self):
+        super().__init__(f"file:memory_storage_{next(_database_ids)}?mode=memory&cache=shared")
+        self._users = {}
+        self._daily_stats = {}  # (day, user_id) -> [responses, sessions, messages]
+        self._chat_stats = {}  # chat_id -> {user_id: [responses, sessions, messages]}
+        self._message_stats = {}  # chat_id -> {user_id: реплик}, см. count_messages
+        self._achievements = {}  # user_id -> {achievement_id: unlocked_at} в порядке разблокировки
+        self._moderators = {}
+        self._moderators_version = 0
+        self._chats = {}
+        self._allowed_keys = []
+    
+    def open_reader(self):
+        self.conn  # общая база в памяти живет, пока открыто основное соединение
+        conn = sqlite3.connect(self.path, uri=True)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+    
+    # Пользователи
+    
+    def add_user(self, user_id, username, first_name, last_name):
+        user = self._users.get(user_id)
+        if user is None:
+            self._users[user_id] = {
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'joined_at': _timestamp(),
+                'total_responses': 0,
+                'sessions_played': 0,
+                'total_messages': 0,
+            }
+        else:
+            user.update(username=username, first_name=first_name, last_name=last_name)
+        return True
+    
+    def get_user_stats(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            return None
+        return {column: user[column] for column in STATS_COLUMNS}
+    
+    def get_user_profile(self, user_id, recent_limit=3):
+        profile = self.get_user_stats(user_id)
+        if profile is None:
+            return None
+        achievements = self.get_user_achievements(user_id)
+        profile['achievements_count'] = len(achievements)
+        profile['recent_achievements'] = achievements[:recent_limit]
+        return profile
+    
+    def iter_user_stats(self, batch_size=500):
+        for user_id in sorted(self._users):
+            yield dict(self._users[user_id])
+    
+    # Статистика
+    
+    def _apply_deltas(self, deltas, chat_id):
+        day = datetime.now().strftime('%Y-%m-%d')
+        chat_stats = None if chat_id is None else self._chat_stats.setdefault(chat_id, {})
+        for user_id, *counters in deltas:
+            user = self._users.get(user_id)
+            if user is not None:
+                user['total_responses'] += counters[0]
+                user['sessions_played'] += counters[1]
+                user['total_messages'] += counters[2]
+            _add_counters(self._daily_stats, (day, user_id), counters)
+            if chat_stats is not None:
+                _add_counters(chat_stats, user_id, counters)
+    
+    def update_user_stats(self, user_id, responses_delta=0, sessions_delta=0, messages_delta=0, chat_id=None):
+        self.flush()
+        self._apply_deltas([(user_id, responses_delta, sessions_delta, messages_delta)], chat_id)
+        return True
+    
+    def apply_stats_batch(self, deltas, chat_id=None):
+        deltas = [delta for delta in deltas if any(delta[1:])]
+        self.flush()
+        if not deltas:
+            return {}
+        
+        self._apply_deltas(deltas, chat_id)
+        new_achievements = {}
+        for user_id in dict.fromkeys(delta[0] for delta in deltas):
+            user = self._users.get(user_id)
+            if user is None:
+                continue
+            unlocked = self._achievements.setdefault(user_id, {})
+            fresh = [achievement_id for achievement_id in self._earned_achievements(user) if achievement_id not in unlocked]
+            if fresh:
+                unlocked_at = _timestamp()
+                for achievement_id in fresh:
+                    unlocked[achievement_id] = unlocked_at
+                new_achievements[user_id] = fresh
+                logger.info(f"🎉 Новые достижения {', '.join(fresh)} для пользователя {user_id}")
+        return new_achievements
+    
+    def _top_rows(self, totals, limit):
+        """Топ по {user_id: [responses, sessions, messages]} в порядке SQL-запросов топа"""
+        rows = heapq.nsmallest(
+            limit,
+            ((user_id, counters) for user_id, counters in totals.items() if counters[0] > 0 or counters[1] > 0),
+            key=lambda item: (-item[1][0], -item[1][1], item[0])
+        )
+        top = []
+        for user_id, (responses, sessions, messages) in rows:
+            user = self._users.get(user_id, {})
+            top.append({
+                'user_id': user_id,
+                'username': user.get('username'),
+                'first_name': user.get('first_name'),
+                'total_responses': responses,
+                'sessions_played': sessions,
+                'total_messages': messages,
+            })
+        return top
+    
+    def get_top_players(self, limit=10):
+        totals = {
+            user_id: (user['total_responses'], user['sessions_played'], user['total_messages'])
+            for user_id, user in self._users.items()
+        }
+        top = self._top_rows(totals, limit)
+        for row in top:
+            row['achievements_count'] = len(self._achievements.get(row['user_id'], ()))
+        return top
+    
+    def get_top_players_for_period(self, start_day, end_day, limit=10):
+        totals = {}
+        for (day, user_id), counters in self._daily_stats.items():
+            if start_day <= day <= end_day:
+                _add_counters(totals, user_id, counters)
+        return self._top_rows(totals, limit)
+    
+    def get_chat_top_players(self, chat_id, limit=10):
+        return self._top_rows(self._chat_stats.get(chat_id, {}), min(limit, DATABASE_SETTINGS["chat_top_size"]))
+    
+    def compact_daily_stats(self, retention_days):
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-01')
+        old_keys = [key for key in self._daily_stats if key[0] < cutoff]
+        compacted = {}
+        for day, user_id in old_keys:
+            _add_counters(compacted, (day[:7] + '-01', user_id), self._daily_stats.pop((day, user_id)))
+        self._daily_stats.update(compacted)
+        if len(old_keys) > len(compacted):
+            logger.info(f"🗜️ Дневная статистика сжата: {len(old_keys)} -> {len(compacted)} строк")
+        return len(old_keys) - len(compacted)
+    
+    # Достижения
+    
+    def unlock_achievement(self, user_id, achievement_id):
+        unlocked = self._achievements.setdefault(user_id, {})
+        if achievement_id in unlocked:
+            logger.info(f"ℹ️ Достижение {achievement_id} уже было разблокировано для пользователя {user_id}")
+            return False
+        unlocked[achievement_id] = _timestamp()
+        logger.info(f"✅ Достижение {achievement_id} разблокировано для пользователя {user_id}")
+        return True
+    
+    def has_achievement(self, user_id, achievement_id):
+        return achievement_id in self._achievements.get(user_id, ())
+    
+    def get_user_achievements(self, user_id):
+        unlocked = self._achievements.get(user_id, {})
+        # Сортировка устойчива: при равном времени новые остаются первыми
+        achievements = [
+            {'achievement_id': achievement_id, 'unlocked_at': unlocked_at}
+            for achievement_id, unlocked_at in reversed(unlocked.items())
+        ]
+        achievements.sort(key=lambda row: row['unlocked_at'], reverse=True)
+        return achievements
+    
+    def get_achievements_count(self, user_id):
+        return len(self._achievements.get(user_id, ()))
+    
+    # Модераторы
+    
+    def add_moderator(self, user_id, username, first_name, added_by):
+        # Как INSERT OR REPLACE: повторное назначение обновляет и дату
+        self._moderators.pop(user_id, None)
+        self._moderators[user_id] = {
+            'user_id': user_id,
+            'username': username,
+            'first_name': first_name,
+            'added_by': added_by,
+            'added_at': _timestamp(),
+        }
+        self._moderators_version += 1
+        return True
+    
+    def remove_moderator(self, user_id):
+        removed = self._moderators.pop(user_id, None) is not None
+        if removed:
+            self._moderators_version += 1
+        return removed
+    
+    def moderators_version(self):
+        return self._moderators_version
+    
+    def get_moderators(self):
+        moderators = sorted(self._moderators.values(), key=lambda moderator: (moderator['added_at'], moderator['user_id']))
+        return [{
+            'user_id': moderator['user_id'],
+            'username': moderator['username'],
+            'first_name': moderator['first_name'],
+            'added_at': moderator['added_at'],
+            'added_by_username': self._users.get(moderator['added_by'], {}).get('username'),
+        } for moderator in moderators]
+    
+    def is_moderator(self, user_id):
+        return user_id in self._moderators
+    
+    # Чаты
+    
+    def _index_chat(self, chat):
+        bisect.insort(self._allowed_keys, (chat['added_at'], chat['chat_id']))
+    
+    def _unindex_chat(self, chat):
+        key = (chat['added_at'], chat['chat_id'])
+        index = bisect.bisect_left(self._allowed_keys, key)
+        if index < len(self._allowed_keys) and self._allowed_keys[index] == key:
+            del self._allowed_keys[index]
+    
+    def add_chat(self, chat_id, chat_title, chat_type, added_by):
+        previous = self._chats.get(chat_id)
+        if previous is not None and previous['is_allowed']:
+            self._unindex_chat(previous)
+        now = _timestamp()
+        chat = {
+            'chat_id': chat_id,
+            'chat_title': chat_title,
+            'chat_type': chat_type,
+            'added_by': added_by,
+            'added_at': now,
+            'is_allowed': 1,
+            'status_changed_at': now,
+        }
+        self._chats[chat_id] = chat
+        self._index_chat(chat)
+        return True
+    
+    def get_all_chats(self):
+        return [
+            {column: self._chats[chat_id][column] for column in CHAT_COLUMNS}
+            for _, chat_id in reversed(self._allowed_keys)
+        ]
+    
+    def get_chats_page(self, after=None, before=None, title_prefix=None, limit=10):
+        keys = self._allowed_keys
+        if after is not None:
+            end = bisect.bisect_left(keys, (after[0], int(after[1])))
+            candidates = (keys[index] for index in range(end - 1, -1, -1))
+        elif before is not None:
+            start = bisect.bisect_right(keys, (before[0], int(before[1])))
+            candidates = (keys[index] for index in range(start, len(keys)))
+        else:
+            candidates = reversed(keys)
+        
+        prefix = title_prefix.casefold() if title_prefix else None
+        results = []
+        for _, chat_id in candidates:
+            chat = self._chats[chat_id]
+            if prefix is not None and not (chat['chat_title'] or '').casefold().startswith(prefix):
+                continue
+            results.append({column: chat[column] for column in CHAT_COLUMNS})
+            if len(results) > limit:
+                break
+        
+        has_more = len(results) > limit
+        results = results[:limit]
+        if before is not None:
+            results.reverse()
+        return results, has_more
+    
+    def remove_chat(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is None:
+            return False
+        if chat['is_allowed']:
+            self._unindex_chat(chat)
+        return True
+    
+    def set_chat_allowed(self, chat_id, allowed):
+        chat = self._chats.get(chat_id)
+        if chat is None or bool(chat['is_allowed']) == bool(allowed):
+            return False
+        chat['is_allowed'] = int(allowed)
+        chat['status_changed_at'] = _timestamp()
+        if allowed:
+            self._index_chat(chat)
+        else:
+            self._unindex_chat(chat)
+        return True
+    
+    def migrate_chat(self, old_chat_id, new_chat_id):
+        chat = self._chats.get(old_chat_id)
+        if chat is None:
+            return False
+        self.remove_chat(old_chat_id)
+        if new_chat_id in self._chats:
+            return False
+        chat['chat_id'] = new_chat_id
+        self._chats[new_chat_id] = chat
+        if chat['is_allowed']:
+            self._index_chat(chat)
+        return True
+    
+    def prune_stale_chats(self, retention_days, limit=500):
+        cutoff = _timestamp(-int(retention_days))
+        stale = [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat['is_allowed'] and (chat['status_changed_at'] or chat['added_at']) < cutoff
+        ][:limit]
+        for chat_id in stale:
+            del self._chats[chat_id]
+        return len(stale)
@@ -0,0 +1,36 @@
+import time
+import asyncio
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду, вмещает не больше capacity"""
+    
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+    
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic() if now is None else now
+    
+    def _refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+    
+    def try_acquire(self, now=None, tokens=1):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    def delay(self, now=None, tokens=1):
+        """Сколько секунд ждать, пока наберется tokens токенов"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return max(0.0, (tokens - self.tokens) / self.rate)
+    
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
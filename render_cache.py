@@ -0,0 +1,57 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RenderCache:
+    """Кэш готовых текстов ответов для статичных и полустатичных команд.
+    
+    Ключ записи - (команда, уровень доступа). Каждая запись помнит версии
+    данных, из которых она собрана (сейчас это только "moderators"), и
+    пересобирается только если одна из этих версий изменилась. Версию
+    "moderators" ведет хранилище (moderators_version), перед ответом ее
+    передают в sync - так ответ устаревает, кто бы ни изменил список. Ответы из
+    config.py (роли, режимы, справка) от версий не зависят: он не меняется
+    без перезапуска.
+    """
+    
+    def __init__(self):
+        self.versions = {"moderators": 0}
+        self._entries = {}
+    
+    def sync(self, source, version):
+        """Взять версию источника у того, кто ее ведет (хранилища): если она сменилась, зависящие ответы устареют"""
+        self.versions[source] = version
+    
+    def _lookup(self, command, tier, depends_on):
+        """Текущие версии источников и готовый текст, если он собран из них (иначе None)"""
+        stamp = tuple(self.versions.get(source, 0) for source in depends_on)
+        entry = self._entries.get((command, tier))
+        if entry is not None and entry[0] == stamp:
+            return stamp, entry[1]
+        return stamp, None
+    
+    def _store(self, command, tier, stamp, text):
+        self._entries[(command, tier)] = (stamp, text)
+        logger.debug(f"🧩 Ответ {command}/{tier} пересобран")
+        return text
+    
+    def get(self, command, tier, depends_on, render):
+        stamp, text = self._lookup(command, tier, depends_on)
+        if text is None:
+            text = self._store(command, tier, stamp, render())
+        return text
+    
+    async def get_async(self, command, tier, depends_on, render):
+        """Как get, но render - корутина: ответ собирается из запросов к хранилищу.
+        
+        Версии берутся до ожидания, поэтому изменение во время сборки не потеряется.
+        """
+        stamp, text = self._lookup(command, tier, depends_on)
+        if text is None:
+            text = self._store(command, tier, stamp, await render())
+        return text
+    
+    def clear(self):
+        self._entries.clear()
+
+render_cache = RenderCache()
@@ -0,0 +1,166 @@
+"""Воспроизведение записанных апдейтов через dp.feed_update с ботом-заглушкой.
+
+    python replay.py captures/updates-20261018-120000-000000.jsonl.gz
+    python replay.py captures/*.jsonl.gz --speed 10 --latency 0.05
+    python replay.py capture.jsonl.gz --speed 0 --storage sqlite --database replay.db
+
+--speed 1 - в исходном темпе, 10 - в десять раз быстрее, 0 - все сразу.
+По умолчанию бот работает с MemoryStorage и не трогает рабочую базу.
+"""
+import json
+import time
+import typing
+import asyncio
+import logging
+import argparse
+import itertools
+from collections import Counter
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, User, ChatMemberMember, Update
+import config
+from update_recorder import iter_capture
+
+logger = logging.getLogger(__name__)
+
+class StubSession(BaseSession):
+    """Сессия Bot API без сети: правдоподобные ответы и счетчик вызовов.
+    
+    Отправка и редактирование сообщений возвращают Message, методы-действия - True,
+    get_chat_member - обычного участника. На остальное - TelegramBadRequest.
+    """
+    
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+    
+    def _result(self, bot, method):
+        returning = method.__returning__
+        options = typing.get_args(returning) or (returning,)
+        me = {"id": bot.id, "is_bot": True, "first_name": "Replay"}
+        chat_id = getattr(method, "chat_id", None)
+        if Message in options and chat_id is not None:
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "supergroup"},
+                "from": me,
+                "text": getattr(method, "text", None) or "",
+            }
+        if bool in options:
+            return True
+        if User in options:
+            return me
+        if ChatMemberMember in options:
+            return {"status": "member", "user": me}
+        if typing.get_origin(returning) is list:
+            return []
+        return None
+    
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[method.__api_method__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(bot, method)
+        if result is None:
+            raise TelegramBadRequest(method=method, message="Bad Request: not supported by replay stub")
+        response = self.check_response(
+            bot=bot,
+            method=method,
+            status_code=200,
+            content=json.dumps({"ok": True, "result": result}),
+        )
+        return response.result
+    
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+    
+    async def close(self):
+        pass
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def replay(paths, speed=1.0, latency=0.0):
+    """Скормить апдейты диспетчеру с исходными интервалами, деленными на speed. Возвращает сводку"""
+    # Бот импортируется здесь: хранилище выбирается при импорте по уже измененному config
+    from bot import create_app
+    from database_manager import db_manager
+    
+    session = StubSession(latency)
+    bot, dp = create_app(session=session)
+    timings = []
+    failures = 0
+    
+    async def feed(update):
+        nonlocal failures
+        began = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            failures += 1
+            logger.warning(f"Апдейт {update.update_id} упал: {e}")
+        timings.append(time.perf_counter() - began)
+    
+    tasks = []
+    started = time.monotonic()
+    first_arrival = None
+    for path in paths:
+        for arrived_at, payload in iter_capture(path):
+            if first_arrival is None:
+                first_arrival = arrived_at
+            if speed > 0:
+                delay = (arrived_at - first_arrival) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update = Update.model_validate(payload, context={"bot": bot})
+            # Как при polling: апдейты обрабатываются параллельно, каждый своей задачей
+            tasks.append(asyncio.create_task(feed(update)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    db_manager.flush()
+    
+    timings.sort()
+    return {
+        "updates": len(timings),
+        "failures": failures,
+        "elapsed": elapsed,
+        "p50": percentile(timings, 0.5),
+        "p95": percentile(timings, 0.95),
+        "p99": percentile(timings, 0.99),
+        "max": timings[-1] if timings else 0.0,
+        "calls": session.calls,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="файлы записи .jsonl.gz")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение; 0 - без пауз")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--database", default="replay.db", help="файл базы для --storage sqlite")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.WARNING)
+    config.DATABASE_SETTINGS["backend"] = args.storage
+    config.DATABASE_SETTINGS["path"] = args.database
+    config.RECORDER_SETTINGS["enabled"] = False
+    
+    summary = asyncio.run(replay(sorted(args.paths), args.speed, args.latency))
+    print(f"Апдейтов: {summary['updates']}, упало: {summary['failures']}, за {summary['elapsed']:.2f} с")
+    if summary["elapsed"] > 0:
+        print(f"Пропускная способность: {summary['updates'] / summary['elapsed']:.1f} апдейтов/с")
+    print(
+        f"Обработка, мс: p50 {summary['p50'] * 1000:.1f}, p95 {summary['p95'] * 1000:.1f}, "
+        f"p99 {summary['p99'] * 1000:.1f}, max {summary['max'] * 1000:.1f}"
+    )
+    print("Вызовы Bot API:")
+    for method, count in summary["calls"].most_common():
+        print(f"  {method:24}{count:>8}")
+
+if __name__ == "__main__":
+    main()
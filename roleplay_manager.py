@@ -3,7 +3,10 @@ import logging
 import asyncio
 from datetime import datetime
 from config import CHARACTERS, ROLEPLAY_SETTINGS, ROLEPLAY_MODES
+from roleplay_models import Session, Player, SessionStatus
 from database_manager import db_manager
+from transcript_store import TranscriptStore, transcript_store
+from session_analytics import SessionAnalytics, session_analytics
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +34,7 @@ class StoryGenerator:
         template = random.choice(self.scene_templates)
         
         if characters and len(characters) > 0:
-            char_names = [char["character"] for char in characters]
+            char_names = [player.character for player in characters]
             if len(char_names) > 3:
                 char_text = f"{', '.join(char_names[:2])} и другие"
             else:
@@ -43,62 +46,82 @@ class StoryGenerator:
         return scene
 
 class RoleplayManager:
-    def __init__(self):
+    def __init__(self, storage=None):
+        # Хранилище можно подменить, например MemoryStorage для бенчмарков без диска;
+        # тогда и стенограммы пишутся в него, а живая статистика заводится своя
+        self.storage = storage or db_manager
+        if storage is None:
+            self.transcripts, self.analytics = transcript_store, session_analytics
+        else:
+            self.transcripts, self.analytics = TranscriptStore(storage), SessionAnalytics()
         self.active_sessions = {}
+        self.sessions_by_chat = {}
         self.story_gen = StoryGenerator()
     
     def create_session(self, creator_id, chat_id, theme="", mode="free"):
-        session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        self.active_sessions[session_id] = {
-            "id": session_id,
-            "chat_id": chat_id,
-            "creator": creator_id,
-            "theme": theme,
-            "mode": mode,
-            "players": {},
-            "status": "waiting",
-            "created_at": datetime.now().isoformat(),
-            "current_scene": "",
-            "story_arc": [],
-            "current_scene_index": 0,
-            "pinned_message_id": None
-        }
+        session_id = f"session_{chat_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        
+        self.active_sessions[session_id] = Session(session_id, chat_id, creator_id, theme, mode)
+        self.sessions_by_chat[chat_id] = session_id
         
         logger.info(f"🎭 Создана сессия: {session_id}")
         return session_id
     
-    def add_player(self, session_id, user_id, character_name, username="", first_name="", last_name=""):
+    def add_player(self, session_id, user_id, character_id, username="", first_name="", last_name=""):
         if session_id not in self.active_sessions:
             return False, "Сессия не найдена!"
         
         session = self.active_sessions[session_id]
         
-        for player_id, player_data in session["players"].items():
-            if player_data["character"] == character_name and player_id != user_id:
-                return False, "Персонаж уже занят!"
+        owner_id = session.character_owner(character_id)
+        if owner_id is not None and owner_id != user_id:
+            return False, "Персонаж уже занят!"
         
-        db_manager.add_user(user_id, username, first_name, last_name)
+        self.storage.add_user(user_id, username, first_name, last_name)
         
-        session["players"][user_id] = {
-            "character": character_name,
-            "username": username,
-            "first_name": first_name,
-            "joined_at": datetime.now().isoformat(),
-            "messages_count": 0
-        }
+        player = Player(user_id, character_id, username, first_name)
+        session.players[user_id] = player
+        session.touch(player.joined_at)
+        if session.status is SessionStatus.ACTIVE:
+            self.analytics.mark_present(session_id, user_id)
         
-        logger.info(f"👤 Игрок добавлен: {character_name} (ID: {user_id})")
-        return True, f"✅ Вы присоединились как {character_name}!"
+        logger.info(f"👤 Игрок добавлен: {player.character} (ID: {user_id})")
+        return True, f"✅ Вы присоединились как {player.character}!"
     
     def get_session(self, session_id):
         return self.active_sessions.get(session_id)
     
     def get_session_by_chat(self, chat_id):
-        for session_id, session in self.active_sessions.items():
-            if session.get("chat_id") == chat_id and session["status"] in ["waiting", "active"]:
-                return session_id, session
-        return None, None
+        session_id = self.sessions_by_chat.get(chat_id)
+        if session_id is None:
+            return None, None
+        return session_id, self.active_sessions[session_id]
+    
+    def find_idle_sessions(self, idle_seconds, limit, now=None):
+        """До limit сессий, в которых дольше idle_seconds не было активности; самые давние первыми"""
+        idle = [
+            (session.last_activity, session_id)
+            for session_id, session in self.active_sessions.items()
+            if session.idle_for(now) >= idle_seconds
+        ]
+        idle.sort()
+        return [session_id for _, session_id in idle[:limit]]
+    
+    async def _begin(self, session):
+        session.status = SessionStatus.ACTIVE
+        session.touch()
+        for user_id in session.players:
+            self.analytics.mark_present(session.id, user_id)
+        
+        initial_scene = self.story_gen.generate_scene(list(session.players.values()), session.mode)
+        session.story_arc = [initial_scene]
+        session.current_scene_index = 0
+        session.new_achievements = await self.storage.call(
+            "apply_stats_batch",
+            [(user_id, 0, 1, 0) for user_id in session.players],
+            session.chat_id
+        )
+        return initial_scene
     
     async def start_session(self, session_id):
         if session_id not in self.active_sessions:
@@ -106,74 +129,59 @@ class RoleplayManager:
         
         session = self.active_sessions[session_id]
         
-        total_players = len(session["players"])
+        total_players = len(session.players)
         
         if total_players >= ROLEPLAY_SETTINGS["min_players"]:
-            session["status"] = "active"
-            
-            initial_scene = self.story_gen.generate_scene(list(session["players"].values()), session["mode"])
-            session["current_scene"] = initial_scene
-            session["story_arc"] = [initial_scene]
-            session["current_scene_index"] = 0
-            
-            for user_id in session["players"]:
-                db_manager.update_user_stats(user_id, sessions_delta=1)
+            initial_scene = await self._begin(session)
             
             logger.info(f"🎬 Сессия запущена: {session_id} с {total_players} игроками")
             return True, initial_scene
         else:
             return False, f"Недостаточно игроков! Всего: {total_players}, нужно: {ROLEPLAY_SETTINGS['min_players']}"
 
-    def force_start_session(self, session_id):
+    async def force_start_session(self, session_id):
         if session_id not in self.active_sessions:
             return False, "Сессия не найдена!"
         
-        session = self.active_sessions[session_id]
-        session["status"] = "active"
-        
-        initial_scene = self.story_gen.generate_scene(list(session["players"].values()), session["mode"])
-        session["current_scene"] = initial_scene
-        session["story_arc"] = [initial_scene]
-        
-        for user_id in session["players"]:
-            db_manager.update_user_stats(user_id, sessions_delta=1)
+        initial_scene = await self._begin(self.active_sessions[session_id])
         
         logger.info(f"🎬 Сессия принудительно запущена: {session_id}")
         return True, initial_scene
 
-    def end_session(self, session_id):
+    async def end_session(self, session_id):
         if session_id not in self.active_sessions:
             return False, "Сессия не найдена!"
         
         session = self.active_sessions[session_id]
         
-        players_stats = []
-        total_messages = 0
-        
-        for user_id, player_data in session["players"].items():
-            messages_count = player_data.get("messages_count", 0)
-            players_stats.append({
-                "user_id": user_id,
-                "character": player_data["character"],
-                "messages_count": messages_count,
-                "username": player_data["username"],
-                "first_name": player_data["first_name"]
-            })
-            total_messages += messages_count
-            
-            db_manager.update_user_stats(user_id, messages_delta=messages_count)
+        players = list(session.players.values())
+        total_messages = sum(player.messages_count for player in players)
+        stats_deltas = [
+            (player.user_id, player.deferred_messages, 0, player.messages_count + player.deferred_messages)
+            for player in players
+        ]
+        
+        if session.status is SessionStatus.ACTIVE:
+            self.transcripts.finish_session(session, len(players), total_messages)
         
-        players_stats.sort(key=lambda x: x["messages_count"], reverse=True)
+        # Сессию убираем до ожидания хранилища, чтобы ее не завершили второй раз
+        del self.active_sessions[session_id]
+        if self.sessions_by_chat.get(session.chat_id) == session_id:
+            del self.sessions_by_chat[session.chat_id]
+        self.analytics.drop(session_id)
+        
+        new_achievements = await self.storage.call("apply_stats_batch", stats_deltas, session.chat_id)
+        
+        players.sort(key=lambda player: player.messages_count, reverse=True)
         
         stats = {
-            "total_players": len(players_stats),
+            "total_players": len(players),
             "total_messages": total_messages,
-            "top_players": players_stats[:3],
-            "session_duration": datetime.now() - datetime.fromisoformat(session["created_at"])
+            "top_players": players[:3],
+            "session_duration": session.elapsed(),
+            "new_achievements": new_achievements
         }
         
-        del self.active_sessions[session_id]
-        
         logger.info(f"🎬 Сессия завершена: {session_id}")
         return True, stats
 
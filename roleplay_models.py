@@ -0,0 +1,71 @@
+import time
+from enum import Enum
+from config import CHARACTERS
+
+# Персонажи хранятся в сессиях номерами - индекс в CHARACTERS
+CHARACTER_NAMES = tuple(CHARACTERS)
+CHARACTER_IDS = {name: character_id for character_id, name in enumerate(CHARACTER_NAMES)}
+
+class SessionStatus(Enum):
+    WAITING = "waiting"
+    ACTIVE = "active"
+
+class Player:
+    __slots__ = ("user_id", "character_id", "username", "first_name", "joined_at", "messages_count", "deferred_messages")
+    
+    def __init__(self, user_id, character_id, username="", first_name="", joined_at=None):
+        self.user_id = user_id
+        self.character_id = character_id
+        self.username = username
+        self.first_name = first_name
+        self.joined_at = time.time() if joined_at is None else joined_at
+        self.messages_count = 0
+        # Сообщения сверх лимита флуда, еще не попавшие в статистику
+        self.deferred_messages = 0
+    
+    @property
+    def character(self):
+        return CHARACTER_NAMES[self.character_id]
+
+class Session:
+    """Ролевая сессия; время - секунды epoch (time.time())"""
+    
+    __slots__ = (
+        "id", "chat_id", "creator", "theme", "mode", "players", "status",
+        "created_at", "last_activity", "story_arc", "current_scene_index", "pinned_message_id", "new_achievements",
+    )
+    
+    def __init__(self, session_id, chat_id, creator, theme="", mode="free", created_at=None):
+        self.id = session_id
+        self.chat_id = chat_id
+        self.creator = creator
+        self.theme = theme
+        self.mode = mode
+        self.players = {}
+        self.status = SessionStatus.WAITING
+        self.created_at = time.time() if created_at is None else created_at
+        self.last_activity = self.created_at
+        self.story_arc = []
+        self.current_scene_index = 0
+        self.pinned_message_id = None
+        self.new_achievements = {}
+    
+    @property
+    def current_scene(self):
+        return self.story_arc[self.current_scene_index] if self.story_arc else ""
+    
+    def elapsed(self, now=None):
+        return (time.time() if now is None else now) - self.created_at
+    
+    def touch(self, now=None):
+        self.last_activity = time.time() if now is None else now
+    
+    def idle_for(self, now=None):
+        return (time.time() if now is None else now) - self.last_activity
+    
+    def character_owner(self, character_id):
+        """ID игрока, занявшего персонажа, или None"""
+        for player in self.players.values():
+            if player.character_id == character_id:
+                return player.user_id
+        return None
@@ -0,0 +1,116 @@
+import time
+import heapq
+from array import array
+from config import ROLEPLAY_SETTINGS
+
+class MinuteRing:
+    """Кольцевой буфер счетчиков по минутам фиксированного размера"""
+    
+    __slots__ = ("counts", "stamps", "total", "last_seen")
+    
+    def __init__(self, size):
+        self.counts = array("I", [0]) * size
+        self.stamps = array("q", [-1]) * size
+        self.total = 0
+        self.last_seen = None
+    
+    def add(self, minute, now):
+        index = minute % len(self.counts)
+        if self.stamps[index] != minute:
+            self.stamps[index] = minute
+            self.counts[index] = 0
+        self.counts[index] += 1
+        self.total += 1
+        self.last_seen = now
+    
+    def recent(self, minute, minutes):
+        """Сумма за последние `minutes` минут, включая текущую"""
+        size = len(self.counts)
+        minutes = min(minutes, size)
+        result = 0
+        for current in range(minute - minutes + 1, minute + 1):
+            index = current % size
+            if self.stamps[index] == current:
+                result += self.counts[index]
+        return result
+
+class SessionActivity:
+    __slots__ = ("started_at", "session", "players")
+    
+    def __init__(self, now, size):
+        self.started_at = now
+        self.session = MinuteRing(size)
+        self.players = {}
+
+class SessionAnalytics:
+    """Живая статистика активных сессий, целиком в памяти"""
+    
+    def __init__(self, window_minutes=None):
+        self.window_minutes = window_minutes or ROLEPLAY_SETTINGS["activity_window_minutes"]
+        self._sessions = {}
+    
+    def _player_ring(self, session_id, user_id, now):
+        activity = self._sessions.get(session_id)
+        if activity is None:
+            activity = self._sessions[session_id] = SessionActivity(now, self.window_minutes)
+        
+        ring = activity.players.get(user_id)
+        if ring is None:
+            ring = activity.players[user_id] = MinuteRing(self.window_minutes)
+        return activity, ring
+    
+    def record(self, session_id, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        minute = int(now // 60)
+        
+        activity, ring = self._player_ring(session_id, user_id, now)
+        activity.session.add(minute, now)
+        ring.add(minute, now)
+    
+    def mark_present(self, session_id, user_id, now=None):
+        """Игрок в идущей сессии (старт или вход позже): молчание считается с этого момента"""
+        now = time.monotonic() if now is None else now
+        _, ring = self._player_ring(session_id, user_id, now)
+        if ring.last_seen is None:
+            ring.last_seen = now
+    
+    def snapshot(self, session_id, players, now=None):
+        """Сводка по сессии: темп сообщений, самые активные и молчащие игроки"""
+        now = time.monotonic() if now is None else now
+        minute = int(now // 60)
+        rate_minutes = ROLEPLAY_SETTINGS["activity_rate_minutes"]
+        idle_seconds = ROLEPLAY_SETTINGS["idle_player_minutes"] * 60
+        
+        activity = self._sessions.get(session_id)
+        if activity is None:
+            return {
+                "total_messages": 0,
+                "per_minute": 0.0,
+                "top_players": [],
+                "idle_players": list(players),
+            }
+        
+        elapsed_minutes = max(1, min(rate_minutes, int((now - activity.started_at) // 60) + 1))
+        recent = activity.session.recent(minute, elapsed_minutes)
+        
+        top_players = heapq.nlargest(
+            3,
+            ((ring.recent(minute, rate_minutes), ring.total, user_id) for user_id, ring in activity.players.items()),
+        )
+        
+        idle_players = [
+            user_id for user_id in players
+            if user_id not in activity.players or now - activity.players[user_id].last_seen >= idle_seconds
+        ]
+        
+        return {
+            "total_messages": activity.session.total,
+            "per_minute": recent / elapsed_minutes,
+            "top_players": [(user_id, recent_count, total) for recent_count, total, user_id in top_players],
+            "idle_players": idle_players,
+        }
+    
+    def drop(self, session_id):
+        self._sessions.pop(session_id, None)
+
+session_analytics = SessionAnalytics()
@@ -0,0 +1,217 @@
+import abc
+import asyncio
+import inspect
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from config import SHARDING_SETTINGS
+from database_manager import SQLiteDatabase
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Записи, ответ на которые воркеру не нужен: он не ждет писателя, а кладет запрос в очередь и идет дальше
+NO_REPLY_METHODS = frozenset({"add_user", "add_chat", "set_chat_allowed", "update_user_stats"})
+# Методы хранилища, которые воркер выполняет у писателя
+REMOTE_METHODS = frozenset(Storage.__abstractmethods__ - {"flush", "close", "moderators_version"})
+# Перед ними писатель применяет накопленную статистику, чтобы ответ ее уже учитывал
+STATS_METHODS = frozenset({
+    "get_user_stats", "get_user_profile", "iter_user_stats", "apply_stats_batch", "get_top_players",
+    "get_top_players_for_period", "get_chat_top_players", "compact_daily_stats",
+    "get_user_achievements", "get_achievements_count", "has_achievement", "unlock_achievement",
+})
+
+def serve_call(storage, request):
+    """Выполнить запрос воркера на стороне писателя. Возвращает (shard, ответ)"""
+    shard, call_id, method, args, kwargs = request
+    if method not in REMOTE_METHODS:
+        return shard, (call_id, False, f"метод {method} недоступен")
+    try:
+        result = getattr(storage, method)(*args, **kwargs)
+        if inspect.isgenerator(result):
+            result = [dict(row) for row in result]
+        return shard, (call_id, True, result)
+    except Exception as e:
+        logger.error(f"Error serving storage call {method}: {e}")
+        return shard, (call_id, False, str(e))
+
+class StorageWriter:
+    """Сторона писателя: выполняет запросы воркеров к хранилищу.
+    
+    Статистику за реплики воркеры присылают без ожидания ответа; писатель
+    складывает ее по (воркер, чат) и применяет одним apply_stats_batch на чат
+    за тик - так на каждую реплику не приходится по транзакции. Новые
+    достижения уходят воркеру чата уведомлением ("achievements", чат, {...}).
+    
+    Отметку дедупликации тоже ведет писатель: фронт сообщает о принятых
+    апдейтах (hold_update), воркеры - об обработанных (release_update).
+    Подтверждение воркера приходит после его статистики, и отметка пишется в
+    транзакции последней пачки, поэтому она не опережает статистику.
+    """
+    
+    def __init__(self, storage, responses, deduplicator):
+        self.storage = storage
+        self.responses = responses
+        self.deduplicator = deduplicator
+        self._stats = {}  # (shard, chat_id) -> {user_id: [responses, sessions, messages]}
+        self._released = []
+    
+    def handle(self, request):
+        shard, call_id, method, args, kwargs = request
+        if method == "hold_update":
+            self.deduplicator.hold(*args)
+            return
+        if method == "release_update":
+            self._released.append(*args)
+            return
+        if method == "update_user_stats":
+            self._add_stats(shard, *args, **kwargs)
+            return
+        if method in STATS_METHODS:
+            self.apply_stats()
+        shard, response = serve_call(self.storage, request)
+        if call_id is not None:
+            self.responses[shard].put(response)
+    
+    def _add_stats(self, shard, user_id, responses_delta=0, sessions_delta=0, messages_delta=0, chat_id=None):
+        counters = self._stats.setdefault((shard, chat_id), {}).setdefault(user_id, [0, 0, 0])
+        counters[0] += responses_delta
+        counters[1] += sessions_delta
+        counters[2] += messages_delta
+    
+    def apply_stats(self):
+        """Применить накопленную статистику. Возвращает число пачек"""
+        stats, self._stats = self._stats, {}
+        released, self._released = self._released, []
+        last = len(stats) - 1
+        for index, ((shard, chat_id), users) in enumerate(stats.items()):
+            if index == last:
+                self._release(released)
+            new_achievements = self.storage.apply_stats_batch(
+                [(user_id, *counters) for user_id, counters in users.items()],
+                chat_id
+            )
+            if new_achievements and chat_id is not None:
+                self.responses[shard].put((None, "achievements", (chat_id, new_achievements)))
+        if not stats:
+            self._release(released)
+        return len(stats)
+    
+    def _release(self, update_ids):
+        for update_id in update_ids:
+            self.deduplicator.release(update_id)
+
+class ShardStorage(SQLiteDatabase, Storage):
+    """Хранилище процесса-воркера в многопроцессном режиме (sharding.py).
+    
+    Пользователи, статистика, достижения, модераторы и чаты общие для всех
+    шардов, поэтому каждый вызов Storage уходит через очередь единственному
+    процессу-писателю - у него и кэши профилей и модераторов, которые иначе
+    расходились бы между процессами. Таблицы модулей со своей схемой
+    (стенограммы, справочник, рассылки) воркер пишет сам через conn: их строки
+    относятся к чатам его шарда.
+    
+    Ответы писателя читает отдельный поток и отдает их по call_id: обработчики
+    ждут их через await call(...), не останавливая цикл событий. Синхронные
+    методы тоже работают, но ждут ответа на месте.
+    """
+    
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._requests = self._responses = self.shard = None
+        self._call_ids = itertools.count()
+        self._waiting = {}
+        self._reader = None
+        # Вызывается из потока чтения: (chat_id, {user_id: [достижения]})
+        self.achievements_listener = None
+    
+    def connect(self, requests, responses, shard):
+        """Подключить воркер к писателю: общая очередь запросов и своя очередь ответов"""
+        self._requests, self._responses, self.shard = requests, responses, shard
+        self._reader = threading.Thread(target=self._read_responses, name=f"shard{shard}-responses", daemon=True)
+        self._reader.start()
+    
+    def _read_responses(self):
+        while True:
+            call_id, ok, result = self._responses.get()
+            if call_id is None:
+                if ok == "achievements" and self.achievements_listener is not None:
+                    self.achievements_listener(*result)
+                continue
+            # Ответа на вызов, чье ожидание уже истекло, никто не ждет
+            future = self._waiting.pop(call_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f"Ошибка писателя: {result}"))
+    
+    def _submit(self, method, args, kwargs):
+        if self._requests is None:
+            raise RuntimeError("ShardStorage не подключен к писателю - запускайте воркеры через sharding.py")
+        if method in NO_REPLY_METHODS:
+            self._requests.put((self.shard, None, method, args, kwargs))
+            return None
+        call_id = next(self._call_ids)
+        future = self._waiting[call_id] = Future()
+        self._requests.put((self.shard, call_id, method, args, kwargs))
+        return call_id, future
+    
+    def _timed_out(self, method, call_id):
+        self._waiting.pop(call_id, None)
+        return RuntimeError(f"Писатель не ответил на {method} за {SHARDING_SETTINGS['storage_timeout']} с")
+    
+    def _call(self, method, *args, **kwargs):
+        pending = self._submit(method, args, kwargs)
+        if pending is None:
+            return True
+        call_id, future = pending
+        try:
+            return future.result(timeout=SHARDING_SETTINGS["storage_timeout"])
+        except FutureTimeoutError:
+            raise self._timed_out(method, call_id) from None
+    
+    async def call(self, method, *args, **kwargs):
+        if method not in REMOTE_METHODS:
+            return getattr(self, method)(*args, **kwargs)
+        pending = self._submit(method, args, kwargs)
+        if pending is None:
+            return True
+        call_id, future = pending
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), SHARDING_SETTINGS["storage_timeout"])
+        except asyncio.TimeoutError:
+            raise self._timed_out(method, call_id) from None
+    
+    def release_update(self, update_id):
+        """Апдейт обработан: писатель может поднять отметку дедупликации"""
+        self._requests.put((self.shard, None, "release_update", (update_id,), {}))
+    
+    def moderators_version(self):
+        # Версию ведут триггеры в общей базе - воркер читает ее сам, без писателя
+        return self.conn.execute('SELECT version FROM moderators_version').fetchone()[0]
+    
+    def count_messages(self, user_id, chat_id, count=1):
+        # Реплики складывает писатель, он же присылает достижения за них
+        self.update_user_stats(user_id, responses_delta=count, messages_delta=count, chat_id=chat_id)
+    
+    def apply_message_stats(self):
+        return {}
+    
+    def check_achievements(self, user_id):
+        # Достижения за реплики писатель находит сам, применяя накопленную статистику,
+        # и присылает их воркеру чата - отдельный запрос на каждую реплику не нужен
+        return []
+
+def _remote(method):
+    def call(self, *args, **kwargs):
+        return self._call(method, *args, **kwargs)
+    call.__name__ = method
+    call.__doc__ = getattr(Storage, method).__doc__
+    return call
+
+for _method in REMOTE_METHODS:
+    setattr(ShardStorage, _method, _remote(_method))
+abc.update_abstractmethods(ShardStorage)
@@ -0,0 +1,236 @@
+"""Многопроцессный режим: апдейты делятся между воркерами по chat_id.
+
+    python sharding.py
+    python sharding.py --workers 8
+
+Фронт получает апдейты polling'ом, отбрасывает повторы и отдает каждый
+воркеру chat_id % N. Сессии ролевых живут в памяти своего воркера - все
+апдейты чата всегда приходят в один и тот же процесс. Общая статистика,
+пользователи, модераторы и чаты идут через процесс-писатель, он же
+обслуживает базу и снимает бэкапы. Рассылки ведет только воркер 0, чтобы
+лимит отправки оставался общим на весь бот.
+
+Получив апдейты, фронт подтверждает их Telegram следующим запросом, поэтому
+апдейт, который при падении еще лежал в очереди воркера, потерян: Telegram
+его больше не пришлет. Отметка дедупликации при этом не врет - писатель
+держит ее ниже самого раннего необработанного апдейта.
+"""
+import asyncio
+import logging
+import argparse
+import multiprocessing
+import config
+from config import SHARDING_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Команды, которые всегда обрабатывает воркер 0 (там же продолжаются прерванные рассылки)
+PINNED_COMMANDS = {"/broadcast"}
+
+def shard_for(chat_id, workers):
+    """Номер воркера для чата; одинаков во всех процессах и между запусками"""
+    return chat_id % workers
+
+class ShardRouter:
+    """Внешний middleware фронта: вместо обработки отправляет апдейт воркеру своего чата"""
+    
+    def __init__(self, queues, requests):
+        self.queues = queues
+        self.requests = requests
+        self.routed = [0] * len(queues)
+    
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        # Апдейты без чата (инлайн-запросы и т.п.) делятся по пользователю
+        key = chat.id if chat is not None else user.id if user is not None else 0
+        shard = 0 if self._command(event) in PINNED_COMMANDS else shard_for(key, len(self.queues))
+        # Писатель не поднимет отметку дедупликации выше апдейта, пока воркер его не обработает
+        self.requests.put((None, None, "hold_update", (event.update_id,), {}))
+        self.queues[shard].put(event.model_dump_json(by_alias=True, exclude_none=True))
+        self.routed[shard] += 1
+        return True
+    
+    def _command(self, event):
+        text = event.message.text if event.message is not None else None
+        if not text or not text.startswith("/"):
+            return None
+        return text.split(maxsplit=1)[0].split("@")[0]
+
+async def run_writer(requests, responses):
+    from database_manager import db_manager
+    from maintenance import maintenance_scheduler
+    from backups import backup_manager
+    from update_dedup import update_deduplicator
+    from shard_storage import StorageWriter
+    
+    writer = StorageWriter(db_manager, responses, update_deduplicator)
+    
+    async def apply_stats_periodically():
+        while True:
+            await asyncio.sleep(SHARDING_SETTINGS["stats_interval"])
+            writer.apply_stats()
+    
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(config.DATABASE_SETTINGS["flush_interval"])
+            db_manager.flush()
+    
+    background_tasks = [
+        asyncio.create_task(apply_stats_periodically()),
+        asyncio.create_task(flush_periodically()),
+        asyncio.create_task(maintenance_scheduler.run()),
+        asyncio.create_task(backup_manager.run_schedule()),
+    ]
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request = await loop.run_in_executor(None, requests.get)
+            if request is None:
+                break
+            # Обращения воркеров - это активность бота: обслуживание базы ждет затишья
+            maintenance_scheduler.touch()
+            writer.handle(request)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        writer.apply_stats()
+        db_manager.close()
+
+async def run_worker(shard, updates):
+    import bot as bot_module
+    from aiogram.types import Update
+    from database_manager import db_manager
+    from broadcasts import broadcast_manager
+    
+    # Повторы уже отброшены фронтом
+    bot, dp = bot_module.create_app(deduplicate=False)
+    loop = asyncio.get_running_loop()
+    
+    # Достижения за реплики находит писатель, когда применяет накопленную статистику
+    db_manager.achievements_listener = lambda chat_id, new_achievements: asyncio.run_coroutine_threadsafe(
+        bot_module.announce_chat_achievements(bot, chat_id, new_achievements), loop
+    )
+    if shard == 0:
+        resumed = broadcast_manager.resume(bot)
+        if resumed:
+            logger.info(f"📣 Продолжаем прерванные рассылки: {resumed}")
+    
+    background_tasks = [
+        asyncio.create_task(bot_module.flush_pending_writes(bot)),
+        asyncio.create_task(bot_module.reap_idle_sessions(bot)),
+    ]
+    handling = set()
+    
+    async def handle(update):
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.exception(f"Воркер {shard}: ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            db_manager.release_update(update.update_id)
+    
+    logger.info(f"⚙️ Воркер {shard} готов")
+    try:
+        while True:
+            payload = await loop.run_in_executor(None, updates.get)
+            if payload is None:
+                break
+            update = Update.model_validate_json(payload, context={"bot": bot})
+            # Как при polling: каждый апдейт своей задачей
+            task = asyncio.create_task(handle(update))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
+        if handling:
+            await asyncio.gather(*handling)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        db_manager.flush()
+        await bot.session.close()
+
+def writer_process(requests, responses):
+    logging.basicConfig(level=logging.INFO, format="writer %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run_writer(requests, responses))
+
+def worker_process(shard, updates, requests, responses):
+    # Хранилище создается при импорте database_manager, поэтому сначала настройки
+    config.DATABASE_SETTINGS["backend"] = "shard"
+    config.RECORDER_SETTINGS["enabled"] = False
+    from database_manager import db_manager
+    db_manager.connect(requests, responses, shard)
+    logging.basicConfig(level=logging.INFO, format=f"worker{shard} %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run_worker(shard, updates))
+
+async def run_front(workers):
+    from aiogram import Bot, Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    import bot as bot_module
+    from database_manager import db_manager
+    from update_dedup import update_deduplicator
+    from update_recorder import update_recorder
+    
+    # Все миграции применяет фронт до старта остальных процессов, чтобы они не делали этого наперегонки
+    tables = db_manager.list_tables()
+    logger.info(f"✅ Таблиц в базе: {len(tables)}")
+    db_manager.add_user(config.ADMIN_ID, "PicoFromTheVoid", "Главный", "Администратор")
+    db_manager.flush()
+    
+    context = multiprocessing.get_context("spawn")
+    requests = context.Queue()
+    responses = [context.Queue() for _ in range(workers)]
+    updates = [context.Queue() for _ in range(workers)]
+    writer = context.Process(target=writer_process, args=(requests, responses), name="writer")
+    processes = [
+        context.Process(target=worker_process, args=(shard, updates[shard], requests, responses[shard]), name=f"worker{shard}")
+        for shard in range(workers)
+    ]
+    writer.start()
+    for process in processes:
+        process.start()
+    
+    bot = Bot(token=config.BOT_TOKEN)
+    dp = Dispatcher(storage=MemoryStorage())
+    if config.RECORDER_SETTINGS["enabled"]:
+        dp.update.outer_middleware(update_recorder.middleware)
+    # Фронт только отбрасывает повторы, отметку по подтверждениям воркеров пишет писатель
+    update_deduplicator.saves_mark = False
+    dp.update.outer_middleware(update_deduplicator.middleware)
+    shard_router = ShardRouter(updates, requests)
+    dp.update.outer_middleware(shard_router)
+    
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(config.DATABASE_SETTINGS["flush_interval"])
+            db_manager.flush()
+            update_recorder.flush()
+    
+    await bot_module.set_bot_commands(bot)
+    flush_task = asyncio.create_task(flush_periodically())
+    logger.info(f"🚦 Фронт запущен, воркеров: {workers}")
+    try:
+        # У фронта нет обработчиков - типы апдейтов берем у роутера воркеров
+        await dp.start_polling(bot, allowed_updates=bot_module.router.resolve_used_update_types())
+    finally:
+        flush_task.cancel()
+        db_manager.flush()
+        update_recorder.close()
+        logger.info(f"📊 Апдейтов по воркерам: {shard_router.routed}")
+        # Сначала дорабатывают воркеры, потом писатель - им он еще нужен
+        for queue in updates:
+            queue.put(None)
+        for process in processes:
+            process.join()
+        requests.put(None)
+        writer.join()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=SHARDING_SETTINGS["workers"])
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="front %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run_front(args.workers))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import logging
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+class Storage(ABC):
+    """Хранилище бота: пользователи, статистика, достижения, модераторы и чаты.
+    
+    Реализации: DatabaseManager (SQLite) и MemoryStorage (словари в памяти).
+    Обе обязаны вести себя одинаково - это проверяет storage_conformance.py.
+    Строки отдаются словарями, время - строками 'YYYY-MM-DD HH:MM:SS' в UTC,
+    как CURRENT_TIMESTAMP в SQLite. Реплики из count_messages реализация
+    копит в self._message_stats (chat_id -> {user_id: реплик}).
+    """
+    
+    # Пользователи
+    
+    @abstractmethod
+    def add_user(self, user_id, username, first_name, last_name):
+        """Запомнить имя пользователя; новый пользователь появляется с нулевой статистикой"""
+    
+    @abstractmethod
+    def get_user_stats(self, user_id):
+        """username, first_name и счетчики пользователя или None"""
+    
+    @abstractmethod
+    def get_user_profile(self, user_id, recent_limit=3):
+        """Статистика, число достижений и последние разблокировки"""
+    
+    @abstractmethod
+    def iter_user_stats(self, batch_size=500):
+        """Статистика всех пользователей по возрастанию user_id"""
+    
+    # Статистика
+    
+    @abstractmethod
+    def update_user_stats(self, user_id, responses_delta=0, sessions_delta=0, messages_delta=0, chat_id=None):
+        """Добавить к счетчикам пользователя, его дневной корзине и счетчикам в чате"""
+    
+    @abstractmethod
+    def apply_stats_batch(self, deltas, chat_id=None):
+        """Применить [(user_id, responses, sessions, messages)] и выдать новые достижения {user_id: [...]}"""
+    
+    def count_messages(self, user_id, chat_id, count=1):
+        """Засчитать реплики игрока в чате без записи: они копятся до apply_message_stats"""
+        users = self._message_stats.setdefault(chat_id, {})
+        users[user_id] = users.get(user_id, 0) + count
+    
+    def apply_message_stats(self):
+        """Записать накопленные реплики одним apply_stats_batch на чат.
+        
+        Возвращает новые достижения за них: {chat_id: {user_id: [...]}}.
+        """
+        message_stats, self._message_stats = self._message_stats, {}
+        new_achievements = {}
+        for chat_id, users in message_stats.items():
+            new = self.apply_stats_batch([(user_id, count, 0, count) for user_id, count in users.items()], chat_id)
+            if new:
+                new_achievements[chat_id] = new
+        return new_achievements
+    
+    @abstractmethod
+    def get_top_players(self, limit=10):
+        pass
+    
+    @abstractmethod
+    def get_top_players_for_period(self, start_day, end_day, limit=10):
+        pass
+    
+    @abstractmethod
+    def get_chat_top_players(self, chat_id, limit=10):
+        pass
+    
+    @abstractmethod
+    def compact_daily_stats(self, retention_days):
+        """Сжать старые дневные корзины в месячные; возвращает, на сколько строк стало меньше"""
+    
+    # Достижения
+    
+    @abstractmethod
+    def unlock_achievement(self, user_id, achievement_id):
+        """True, если достижение разблокировано сейчас, а не раньше"""
+    
+    @abstractmethod
+    def has_achievement(self, user_id, achievement_id):
+        pass
+    
+    @abstractmethod
+    def get_user_achievements(self, user_id):
+        """Достижения пользователя, новые первыми"""
+    
+    @abstractmethod
+    def get_achievements_count(self, user_id):
+        pass
+    
+    def _earned_achievements(self, stats):
+        """Достижения, условия которых выполнены для данной статистики"""
+        achievements_to_check = [
+            ("first_roleplay", stats['sessions_played'] >= 1),
+            ("active_participant", stats['total_responses'] >= 10),
+            ("veteran", stats['sessions_played'] >= 5),
+            ("word_master", stats['total_messages'] >= 50),
+            ("social_butterfly", stats['sessions_played'] >= 10)
+        ]
+        return [achievement_id for achievement_id, condition in achievements_to_check if condition]
+    
+    def check_achievements(self, user_id):
+        stats = self.get_user_stats(user_id)
+        if not stats:
+            return []
+        
+        new_achievements = []
+        for achievement_id in self._earned_achievements(stats):
+            if not self.has_achievement(user_id, achievement_id):
+                if self.unlock_achievement(user_id, achievement_id):
+                    new_achievements.append(achievement_id)
+                    logger.info(f"🎉 Новое достижение {achievement_id} для пользователя {user_id}")
+        return new_achievements
+    
+    # Модераторы
+    
+    @abstractmethod
+    def add_moderator(self, user_id, username, first_name, added_by):
+        pass
+    
+    @abstractmethod
+    def remove_moderator(self, user_id):
+        """True, если модератор был"""
+    
+    @abstractmethod
+    def get_moderators(self):
+        """Модераторы в порядке назначения, с username назначившего"""
+    
+    @abstractmethod
+    def is_moderator(self, user_id):
+        pass
+    
+    @abstractmethod
+    def moderators_version(self):
+        """Номер версии списка модераторов: меняется при любом его изменении, в том числе из другого процесса"""
+    
+    # Чаты
+    
+    @abstractmethod
+    def add_chat(self, chat_id, chat_title, chat_type, added_by):
+        """Добавить (или заново разрешить) чат; added_at ставится заново"""
+    
+    @abstractmethod
+    def get_all_chats(self):
+        """Разрешенные чаты, новые первыми"""
+    
+    @abstractmethod
+    def get_chats_page(self, after=None, before=None, title_prefix=None, limit=10):
+        """Страница разрешенных чатов по ключу (added_at, chat_id); возвращает (чаты, есть_еще)"""
+    
+    @abstractmethod
+    def remove_chat(self, chat_id):
+        pass
+    
+    @abstractmethod
+    def set_chat_allowed(self, chat_id, allowed):
+        """True, если статус чата изменился"""
+    
+    @abstractmethod
+    def prune_stale_chats(self, retention_days, limit=500):
+        pass
+    
+    @abstractmethod
+    def migrate_chat(self, old_chat_id, new_chat_id):
+        """Группа стала супергруппой: перенести чат на новый ID. False, если переносить нечего
+        или новый ID уже есть - тогда старая запись просто удаляется"""
+    
+    # Жизненный цикл
+    
+    @abstractmethod
+    def flush(self):
+        """Записать отложенные изменения"""
+    
+    @abstractmethod
+    def close(self):
+        pass
+    
+    async def call(self, method, *args, **kwargs):
+        """Вызов из обработчиков бота: await storage.call("get_user_profile", user_id).
+        
+        Хранилище в своем процессе отвечает сразу; ShardStorage ждет ответа
+        писателя, не останавливая цикл событий.
+        """
+        return getattr(self, method)(*args, **kwargs)
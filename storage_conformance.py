@@ -0,0 +1,212 @@
+"""Проверка, что хранилища ведут себя одинаково: SQLite и память.
+
+    python storage_conformance.py
+    python storage_conformance.py --backend memory
+"""
+import os
+import sys
+import argparse
+import tempfile
+from datetime import datetime
+from database_manager import DatabaseManager
+from memory_storage import MemoryStorage
+
+class ConformanceError(AssertionError):
+    pass
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise ConformanceError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+def without_times(rows, *columns):
+    return [{key: value for key, value in row.items() if key not in columns} for row in rows]
+
+def check_users(storage):
+    expect(storage.get_user_stats(1), None, "неизвестный пользователь")
+    storage.add_user(1, "alice", "Алиса", None)
+    storage.add_user(2, "bob", "Боб", "Б")
+    storage.add_user(1, "alice2", "Алиса", None)
+    expect(storage.get_user_stats(1), {
+        'username': "alice2", 'first_name': "Алиса",
+        'total_responses': 0, 'sessions_played': 0, 'total_messages': 0,
+    }, "статистика после переименования")
+    expect([row['user_id'] for row in storage.iter_user_stats()], [1, 2], "порядок iter_user_stats")
+    expect(storage.get_user_profile(2)['achievements_count'], 0, "достижения нового пользователя")
+    expect(storage.get_user_profile(3), None, "профиль неизвестного пользователя")
+
+def check_stats(storage):
+    for user_id in (1, 2, 3):
+        storage.add_user(user_id, f"user{user_id}", "Игрок", None)
+    storage.update_user_stats(1, responses_delta=5, sessions_delta=1, messages_delta=5, chat_id=-100)
+    storage.update_user_stats(2, responses_delta=5, sessions_delta=1, chat_id=-100)
+    storage.update_user_stats(3, messages_delta=7, chat_id=-200)
+    # Изменения незнакомого пользователя идут только в корзины, в users он не появляется
+    storage.update_user_stats(99, responses_delta=1, chat_id=-100)
+    expect(storage.get_user_stats(99), None, "статистика незнакомого пользователя")
+    
+    top = storage.get_top_players()
+    expect([row['user_id'] for row in top], [1, 2], "порядок общего топа (равенство - по user_id)")
+    expect(top[0]['total_messages'], 5, "сообщения в топе")
+    expect([row['user_id'] for row in storage.get_chat_top_players(-100)], [1, 2, 99], "топ чата")
+    expect(storage.get_chat_top_players(-100)[2]['username'], None, "имя незнакомого в топе чата")
+    expect(storage.get_chat_top_players(-200), [], "топ чата без очков")
+    expect(storage.get_chat_top_players(-100, limit=1)[0]['user_id'], 1, "лимит топа чата")
+    
+    storage.update_user_stats(2, responses_delta=1, chat_id=-100)
+    expect([row['user_id'] for row in storage.get_chat_top_players(-100)], [2, 1, 99], "топ чата после обновления")
+    
+    today = datetime.now().strftime('%Y-%m-%d')
+    period = storage.get_top_players_for_period(today, today)
+    expect([(row['user_id'], row['total_responses']) for row in period], [(2, 6), (1, 5), (99, 1)], "топ за сегодня")
+    expect(storage.compact_daily_stats(30), 0, "сжатие свежих корзин")
+    # Отрицательный срок хранения сжимает и сегодняшние корзины в месячные
+    storage.compact_daily_stats(-40)
+    month_start = today[:8] + '01'
+    expect(storage.get_top_players_for_period(month_start, month_start), period, "корзины, сжатые в месячные")
+
+def check_message_stats(storage):
+    storage.add_user(1, "user1", "Игрок", None)
+    for _ in range(9):
+        storage.count_messages(1, -100)
+    storage.count_messages(1, -200, 2)
+    expect(storage.get_user_stats(1)['total_responses'], 0, "реплики до apply_message_stats")
+    expect(storage.apply_message_stats(), {-200: {1: ["active_participant"]}}, "достижения за накопленные реплики")
+    expect(storage.apply_message_stats(), {}, "повторный apply_message_stats")
+    stats = storage.get_user_stats(1)
+    expect((stats['total_responses'], stats['total_messages']), (11, 11), "реплики после apply_message_stats")
+    expect([row['total_messages'] for row in storage.get_chat_top_players(-200)], [2], "реплики в топе чата")
+
+def check_achievements(storage):
+    storage.add_user(1, "alice", "Алиса", None)
+    new_achievements = storage.apply_stats_batch([(1, 10, 1, 3), (2, 1, 1, 1), (3, 0, 0, 0)])
+    expect(new_achievements, {1: ["first_roleplay", "active_participant"]}, "новые достижения пачки")
+    expect(storage.apply_stats_batch([(1, 1, 0, 0)]), {}, "повторная пачка")
+    expect(storage.apply_stats_batch([]), {}, "пустая пачка")
+    
+    expect(storage.unlock_achievement(1, "veteran"), True, "ручная разблокировка")
+    expect(storage.unlock_achievement(1, "veteran"), False, "повторная разблокировка")
+    expect(storage.has_achievement(1, "veteran"), True, "has_achievement")
+    expect(storage.has_achievement(1, "word_master"), False, "has_achievement без достижения")
+    expect(storage.get_achievements_count(1), 3, "число достижений")
+    expect(
+        [row['achievement_id'] for row in storage.get_user_achievements(1)],
+        ["veteran", "active_participant", "first_roleplay"],
+        "порядок достижений"
+    )
+    
+    profile = storage.get_user_profile(1, recent_limit=2)
+    expect(profile['total_responses'], 11, "очки в профиле")
+    expect(profile['achievements_count'], 3, "достижения в профиле")
+    expect([row['achievement_id'] for row in profile['recent_achievements']], ["veteran", "active_participant"], "последние достижения")
+    
+    storage.update_user_stats(1, messages_delta=50)
+    expect(storage.check_achievements(1), ["word_master"], "check_achievements")
+    expect(storage.check_achievements(1), [], "повторный check_achievements")
+    expect(storage.check_achievements(42), [], "check_achievements без пользователя")
+    
+    top = storage.get_top_players()
+    expect(top[0]['achievements_count'], 4, "достижения в общем топе")
+
+def check_moderators(storage):
+    storage.add_user(10, "admin", "Админ", None)
+    expect(storage.is_moderator(1), False, "не модератор")
+    version = storage.moderators_version()
+    expect(storage.add_moderator(1, "alice", "Алиса", 10), True, "назначение")
+    expect(storage.moderators_version() != version, True, "версия списка после назначения")
+    expect(storage.add_moderator(2, "bob", "Боб", 11), True, "назначение")
+    expect(storage.is_moderator(1), True, "модератор")
+    expect(without_times(storage.get_moderators(), 'added_at'), [
+        {'user_id': 1, 'username': "alice", 'first_name': "Алиса", 'added_by_username': "admin"},
+        {'user_id': 2, 'username': "bob", 'first_name': "Боб", 'added_by_username': None},
+    ], "список модераторов")
+    expect(storage.remove_moderator(1), True, "снятие")
+    version = storage.moderators_version()
+    expect(storage.remove_moderator(1), False, "повторное снятие")
+    expect(storage.moderators_version(), version, "версия списка после повторного снятия")
+    expect(storage.is_moderator(1), False, "снятый модератор")
+
+def check_chats(storage):
+    titles = ["Альфа", "альтернатива", "Beta", "бета", None]
+    for index, title in enumerate(titles):
+        storage.add_chat(-100 - index, title, "group", 10)
+    expect(storage.remove_chat(-999), False, "удаление неизвестного чата")
+    expect(storage.set_chat_allowed(-104, True), False, "разрешение уже разрешенного чата")
+    expect(storage.set_chat_allowed(-103, False), True, "запрет")
+    expect(storage.set_chat_allowed(-999, False), False, "запрет неизвестного чата")
+    
+    chats = storage.get_all_chats()
+    all_chats = [chat['chat_id'] for chat in chats]
+    # Время добавления хранится с точностью до секунды, при равенстве новее чат с большим chat_id
+    newest_first = sorted(((chat['added_at'], chat['chat_id']) for chat in chats), reverse=True)
+    expect(all_chats, [chat_id for _, chat_id in newest_first], "порядок чатов")
+    expect(set(all_chats), {-100, -101, -102, -104}, "разрешенные чаты")
+    
+    first, has_next = storage.get_chats_page(limit=2)
+    expect([chat['chat_id'] for chat in first], all_chats[:2], "первая страница")
+    expect(has_next, True, "есть следующая страница")
+    second, has_next = storage.get_chats_page(after=(first[-1]['added_at'], str(first[-1]['chat_id'])), limit=2)
+    expect([chat['chat_id'] for chat in second], all_chats[2:4], "вторая страница")
+    expect(has_next, False, "последняя страница")
+    back, has_prev = storage.get_chats_page(before=(second[0]['added_at'], second[0]['chat_id']), limit=2)
+    expect(back, first, "страница назад")
+    expect(has_prev, False, "нет предыдущей страницы")
+    
+    alpha, _ = storage.get_chats_page(title_prefix="АЛЬ", limit=10)
+    expect(sorted(chat['chat_id'] for chat in alpha), [-101, -100], "поиск по началу названия без учета регистра")
+    expect(storage.get_chats_page(title_prefix="%", limit=10), ([], False), "спецсимволы LIKE в префиксе")
+    
+    expect(storage.set_chat_allowed(-103, True), True, "повторное разрешение")
+    expect(len(storage.get_all_chats()), 5, "чаты после разрешения")
+    storage.set_chat_allowed(-103, False)
+    expect(storage.prune_stale_chats(30), 0, "свежие запрещенные чаты не удаляются")
+    expect(storage.remove_chat(-100), True, "удаление чата")
+    expect(-100 in [chat['chat_id'] for chat in storage.get_all_chats()], False, "удаленный чат")
+    storage.add_chat(-101, "Альфа 2", "supergroup", 10)
+    expect(sum(chat['chat_id'] == -101 for chat in storage.get_all_chats()), 1, "повторное добавление чата")
+    
+    expect(storage.migrate_chat(-102, -1000102), True, "перенос чата на новый ID")
+    migrated = [chat for chat in storage.get_all_chats() if chat['chat_id'] in (-102, -1000102)]
+    expect([(chat['chat_id'], chat['chat_title']) for chat in migrated], [(-1000102, "Beta")], "чат после переноса")
+    expect(storage.migrate_chat(-102, -1000102), False, "повторный перенос")
+    expect(storage.migrate_chat(-104, -101), False, "перенос на уже известный ID")
+    expect(sorted(chat['chat_id'] for chat in storage.get_all_chats()), [-1000102, -101], "чаты после переносов")
+
+CHECKS = [check_users, check_stats, check_message_stats, check_achievements, check_moderators, check_chats]
+
+def open_sqlite(directory):
+    return DatabaseManager(os.path.join(directory, f"conformance_{len(os.listdir(directory))}.db"))
+
+BACKENDS = {
+    "sqlite": open_sqlite,
+    "memory": lambda directory: MemoryStorage(),
+}
+
+def run(backends):
+    """Прогнать все проверки на каждом хранилище (каждая - на чистом). Возвращает число провалов"""
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in backends:
+            for check in CHECKS:
+                storage = BACKENDS[backend](directory)
+                try:
+                    check(storage)
+                    print(f"✅ {backend}: {check.__name__}")
+                except Exception as e:
+                    failures += 1
+                    print(f"❌ {backend}: {check.__name__}: {e}")
+                finally:
+                    storage.close()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), action="append")
+    args = parser.parse_args()
+    
+    failures = run(args.backend or list(BACKENDS))
+    if failures:
+        sys.exit(f"Провалено проверок: {failures}")
+    print("Хранилища ведут себя одинаково")
+
+if __name__ == "__main__":
+    main()
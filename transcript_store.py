@@ -0,0 +1,257 @@
+import os
+import re
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from config import DATABASE_SETTINGS
+from database_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+class TranscriptStore:
+    """Журнал реплик ролевых сессий.
+    
+    Реплики копятся в памяти и дописываются в конец таблицы пачками вместе
+    с остальными отложенными записями db_manager (flush / стата сессии).
+    Полнотекстовый индекс FTS5 ведут триггеры в той же транзакции.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._pending_messages = []
+        self._pending_sessions = []
+        db.register_migration("transcripts_0001_tables", self._create_tables)
+        db.register_migration("transcripts_0002_fts", self._create_search_index)
+        db.register_migration("transcripts_0003_fts_chat", self._index_chat_ids)
+        db.register_migration("transcripts_0004_fts_triggers", self._create_search_triggers)
+        db.register_pending_writer(self._write_pending, self._reset_pending)
+    
+    def _create_tables(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS roleplay_sessions (
+                session_id TEXT PRIMARY KEY,
+                chat_id INTEGER,
+                mode TEXT,
+                theme TEXT,
+                started_at TIMESTAMP,
+                ended_at TIMESTAMP,
+                players_count INTEGER DEFAULT 0,
+                messages_count INTEGER DEFAULT 0
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transcript_messages (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER,
+                character TEXT,
+                sent_at TIMESTAMP,
+                text TEXT
+            )
+        ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transcript_session ON transcript_messages (session_id, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transcript_chat ON transcript_messages (chat_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_roleplay_sessions_chat ON roleplay_sessions (chat_id, ended_at)')
+    
+    def _create_search_index(self, cursor):
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS transcript_fts USING fts5(
+                text,
+                character,
+                content='transcript_messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        # Индекс мог появиться позже таблицы реплик - проиндексируем то, что уже есть
+        cursor.execute("INSERT INTO transcript_fts (transcript_fts) VALUES ('rebuild')")
+    
+    def _index_chat_ids(self, cursor):
+        # chat_id внутри индекса: поиск по чату пересекает списки термов в FTS,
+        # а не ранжирует совпадения всех чатов, чтобы потом отбросить чужие
+        cursor.execute('DROP TABLE IF EXISTS transcript_fts')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE transcript_fts USING fts5(
+                text,
+                character,
+                chat_id,
+                content='transcript_messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute("INSERT INTO transcript_fts (transcript_fts) VALUES ('rebuild')")
+    
+    def _create_search_triggers(self, cursor):
+        # Индекс пополняют триггеры: ровно те строки, что вставило это соединение, даже если
+        # таблицу параллельно пишут другие процессы (воркеры sharding.py)
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS transcript_messages_ai AFTER INSERT ON transcript_messages BEGIN
+                INSERT INTO transcript_fts (rowid, text, character, chat_id)
+                VALUES (new.id, new.text, new.character, new.chat_id);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS transcript_messages_ad AFTER DELETE ON transcript_messages BEGIN
+                INSERT INTO transcript_fts (transcript_fts, rowid, text, character, chat_id)
+                VALUES ('delete', old.id, old.text, old.character, old.chat_id);
+            END
+        ''')
+        # Прежний MAX(id) вне транзакции мог проиндексировать чужие строки дважды - пересобираем
+        cursor.execute("INSERT INTO transcript_fts (transcript_fts) VALUES ('rebuild')")
+    
+    def append(self, session_id, chat_id, user_id, character, text):
+        self._pending_messages.append(
+            (session_id, chat_id, user_id, character, datetime.now().isoformat(" ", "seconds"), text)
+        )
+        if len(self._pending_messages) >= DATABASE_SETTINGS["write_batch_size"]:
+            self.db.flush()
+    
+    def finish_session(self, session, players_count, messages_count):
+        """Записать итог сессии; попадет в базу той же транзакцией, что и ее статистика"""
+        self._pending_sessions.append((
+            session.id,
+            session.chat_id,
+            session.mode,
+            session.theme,
+            datetime.fromtimestamp(session.created_at).isoformat(" ", "seconds"),
+            datetime.now().isoformat(" ", "seconds"),
+            players_count,
+            messages_count
+        ))
+    
+    def _write_pending(self, cursor):
+        if self._pending_messages:
+            cursor.executemany('''
+                INSERT INTO transcript_messages (session_id, chat_id, user_id, character, sent_at, text)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', self._pending_messages)
+        
+        if self._pending_sessions:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO roleplay_sessions
+                    (session_id, chat_id, mode, theme, started_at, ended_at, players_count, messages_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', self._pending_sessions)
+    
+    def _reset_pending(self):
+        self._pending_messages.clear()
+        self._pending_sessions.clear()
+    
+    def prune_history(self, retention_days, limit=500):
+        """Удалить до limit реплик и сессий старше retention_days дней. Возвращает число удаленных строк"""
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(" ", "seconds")
+        cursor = self.db.conn.cursor()
+        try:
+            # id растут вместе со временем: старые реплики лежат в начале таблицы,
+            # поэтому смотрим только первые limit строк вместо поиска по sent_at
+            # Из полнотекстового индекса строки убирает триггер
+            cursor.execute('SELECT id, sent_at FROM transcript_messages ORDER BY id LIMIT ?', (limit,))
+            old_ids = []
+            for row in cursor.fetchall():
+                if row['sent_at'] >= cutoff:
+                    break
+                old_ids.append(row['id'])
+            if old_ids:
+                cursor.execute('DELETE FROM transcript_messages WHERE id <= ?', (old_ids[-1],))
+            deleted_count = len(old_ids)
+            
+            cursor.execute('''
+                DELETE FROM roleplay_sessions WHERE session_id IN (
+                    SELECT session_id FROM roleplay_sessions WHERE ended_at < ? LIMIT ?
+                )
+            ''', (cutoff, limit))
+            deleted_count += cursor.rowcount
+            self.db.conn.commit()
+            return deleted_count
+        except Exception as e:
+            self.db.conn.rollback()
+            logger.error(f"Error pruning transcripts: {e}")
+            return 0
+    
+    def get_recent_sessions(self, chat_id, limit=10):
+        cursor = self.db.conn.cursor()
+        cursor.execute('''
+            SELECT session_id, theme, started_at, ended_at, players_count, messages_count
+            FROM roleplay_sessions
+            WHERE chat_id = ?
+            ORDER BY ended_at DESC
+            LIMIT ?
+        ''', (chat_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def get_session(self, session_id):
+        cursor = self.db.conn.cursor()
+        cursor.execute('SELECT * FROM roleplay_sessions WHERE session_id = ?', (session_id,))
+        result = cursor.fetchone()
+        return dict(result) if result else None
+    
+    def search(self, chat_id, query, limit=5):
+        """Поиск реплик чата по словам запроса, лучшие совпадения первыми"""
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        # Каждое слово в кавычках, чтобы пользовательский ввод не ломал синтаксис FTS.
+        # Префиксом ищем только последнее слово - его могли не допечатать
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += "*"
+        # Токенизатор отбрасывает минус, так что группа -100123 и личка 100123 дают один терм;
+        # точную проверку m.chat_id делаем уже на отобранных строках
+        match = f'chat_id : "{abs(chat_id)}" AND ({" ".join(terms)})'
+        
+        cursor = self.db.conn.cursor()
+        cursor.execute('''
+            SELECT 
+                m.session_id,
+                m.character,
+                m.sent_at,
+                snippet(transcript_fts, 0, '«', '»', '…', 12) as snippet
+            FROM transcript_fts
+            JOIN transcript_messages m ON m.id = transcript_fts.rowid
+            WHERE transcript_fts MATCH ? AND m.chat_id = ?
+            ORDER BY transcript_fts.rank
+            LIMIT ?
+        ''', (match, chat_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def iter_messages(self, conn, session_id):
+        """Реплики сессии по порядку, порциями через fetchmany"""
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT character, user_id, sent_at, text
+            FROM transcript_messages
+            WHERE session_id = ?
+            ORDER BY id
+        ''', (session_id,))
+        while True:
+            rows = cursor.fetchmany(DATABASE_SETTINGS["export_fetch_size"])
+            if not rows:
+                break
+            yield from rows
+    
+    def export_to_file(self, session):
+        """Выгрузить сессию в текстовый файл; память не зависит от длины сессии.
+        
+        Открывает собственное соединение, поэтому может вызываться из рабочего потока.
+        Возвращает путь к временному файлу - удалить его должен вызывающий.
+        """
+        fd, path = tempfile.mkstemp(prefix=f"{session['session_id']}_", suffix=".txt")
+        conn = self.db.open_reader()
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as output:
+                output.write(f"{session['theme']}\n")
+                output.write(f"{session['started_at']} - {session['ended_at']}\n")
+                output.write(f"Игроков: {session['players_count']}, сообщений: {session['messages_count']}\n\n")
+                for row in self.iter_messages(conn, session['session_id']):
+                    output.write(f"[{row['sent_at']}] {row['character']}: {row['text']}\n")
+        except Exception:
+            os.remove(path)
+            raise
+        finally:
+            conn.close()
+        return path
+
+transcript_store = TranscriptStore(db_manager)
@@ -0,0 +1,120 @@
+import array
+import logging
+from config import DEDUP_SETTINGS
+from database_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+class UpdateDeduplicator:
+    """Отбрасывает апдейты, которые Telegram прислал повторно после перезапуска polling.
+    
+    Последние size ID апдейтов лежат в кольце-массиве по индексу update_id % size:
+    ID идут подряд, поэтому окно из size последних не вытесняет само себя,
+    а проверка - одно сравнение. Между запусками хранится только наибольший
+    обработанный ID; он пишется вместе с остальными отложенными записями,
+    то есть в одной транзакции со статистикой, которую успели посчитать.
+    
+    Если апдейты обрабатываются не там, где проверяются (sharding.py), отметку
+    ведет процесс-писатель через hold/release: она не поднимается выше самого
+    раннего апдейта, который еще не обработан.
+    """
+    
+    def __init__(self, db, size=None):
+        self.db = db
+        self.size = size or DEDUP_SETTINGS["window_size"]
+        self._ring = array.array('q', [-1]) * self.size
+        self._high_water_mark = None
+        self._restored_mark = None
+        self._saved_mark = None
+        self._writing_mark = None
+        self._loaded = False
+        self._held = set()
+        self._released_early = set()
+        # False - отметку за этот процесс пишет другой
+        self.saves_mark = True
+        db.register_migration("bot_state_0001_table", self._create_table)
+        db.register_pending_writer(self._write_mark, self._mark_saved)
+    
+    def _create_table(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+    
+    def _load(self):
+        self._loaded = True
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT value FROM bot_state WHERE key = 'last_update_id'")
+        row = cursor.fetchone()
+        if row is not None:
+            self._restored_mark = self._saved_mark = self._high_water_mark = row['value']
+    
+    def is_duplicate(self, update_id):
+        """Проверить апдейт и запомнить его; True - такой уже обрабатывали"""
+        if not self._loaded:
+            self._load()
+        
+        slot = update_id % self.size
+        if self._ring[slot] == update_id:
+            return True
+        # Апдейты предыдущего запуска известны только по отметке: все ID окна под ней считаем обработанными.
+        # ID намного ниже отметки - Telegram начал нумерацию заново (так бывает после недели простоя)
+        restored = self._restored_mark
+        if restored is not None and restored - self.size < update_id <= restored:
+            return True
+        
+        self._ring[slot] = update_id
+        if self._high_water_mark is None or update_id > self._high_water_mark:
+            self._high_water_mark = update_id
+        elif self._high_water_mark - update_id >= self.size:
+            logger.warning(f"⚠️ Нумерация апдейтов началась заново: {update_id} после {self._high_water_mark}")
+            self._high_water_mark = update_id
+            self._restored_mark = None
+        return False
+    
+    def hold(self, update_id):
+        """Апдейт принят в обработку: отметка не поднимется до него, пока не будет release"""
+        # Подтверждение воркера может обогнать сообщение фронта
+        if update_id in self._released_early:
+            self._released_early.discard(update_id)
+        else:
+            self._held.add(update_id)
+        if self._high_water_mark is None or update_id > self._high_water_mark:
+            self._high_water_mark = update_id
+    
+    def release(self, update_id):
+        """Апдейт обработан"""
+        if update_id in self._held:
+            self._held.discard(update_id)
+        else:
+            self._released_early.add(update_id)
+    
+    def _mark(self):
+        if self._held:
+            return min(self._held) - 1
+        return self._high_water_mark
+    
+    def _write_mark(self, cursor):
+        mark = self._mark()
+        if not self.saves_mark or mark is None or mark == self._saved_mark:
+            return
+        cursor.execute('''
+            INSERT INTO bot_state (key, value) VALUES ('last_update_id', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (mark,))
+        self._writing_mark = mark
+    
+    def _mark_saved(self):
+        if self._writing_mark is not None:
+            self._saved_mark, self._writing_mark = self._writing_mark, None
+    
+    async def middleware(self, handler, event, data):
+        """Внешний middleware: повторный апдейт не доходит до обработчиков"""
+        if self.is_duplicate(event.update_id):
+            logger.info(f"♻️ Апдейт {event.update_id} уже обработан, пропускаем")
+            return None
+        return await handler(event, data)
+
+update_deduplicator = UpdateDeduplicator(db_manager)
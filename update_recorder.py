@@ -0,0 +1,136 @@
+import os
+import gzip
+import hmac
+import json
+import time
+import hashlib
+import logging
+from datetime import datetime
+from config import ADMIN_ID, RECORDER_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# ID пользователей и чатов; message_id и прочие счетчики не трогаем
+ID_FIELDS = {"id", "user_id", "chat_id", "sender_chat_id", "migrate_to_chat_id", "migrate_from_chat_id"}
+NAME_FIELDS = {"username", "first_name", "last_name", "title", "phone_number"}
+
+def iter_capture(path):
+    """(время прихода, апдейт в виде словаря) из файла записи.
+    
+    Файл, оборванный остановкой бота, читается до последней сброшенной строки.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as capture:
+        try:
+            for line in capture:
+                if not line.endswith("\n"):
+                    break
+                record = json.loads(line)
+                yield record["t"], record["update"]
+        except EOFError:
+            logger.warning(f"Запись {path} оборвана, читаем до обрыва")
+
+class UpdateRecorder:
+    """Запись входящих апдейтов в сжатые JSONL-файлы для replay.py.
+    
+    Каждая строка - {"t": время прихода, "update": апдейт в формате Bot API}.
+    Файл закрывается, когда в него записано max_bytes несжатых данных; хранятся
+    последние keep файлов. При pseudonymize ID и имена пользователей и чатов
+    заменяются стабильными псевдонимами (HMAC с salt), кроме бота и главного
+    администратора - иначе при повторе не сработают их ветки. Текст сообщений
+    пишется как есть.
+    """
+    
+    def __init__(self, directory=None, max_bytes=None, keep=None, pseudonymize=None, salt=None):
+        self.directory = directory or RECORDER_SETTINGS["directory"]
+        self.max_bytes = max_bytes or RECORDER_SETTINGS["max_bytes"]
+        self.keep = keep or RECORDER_SETTINGS["keep"]
+        self.pseudonymize = RECORDER_SETTINGS["pseudonymize"] if pseudonymize is None else pseudonymize
+        # Без соли псевдонимы стабильны только в пределах одного запуска
+        salt = RECORDER_SETTINGS["salt"] if salt is None else salt
+        self._salt = salt.encode() if salt else os.urandom(16)
+        self._keep_ids = {ADMIN_ID}
+        self._file = None
+        self._written = 0
+    
+    async def middleware(self, handler, event, data):
+        """Внешний middleware: пишет апдейт до обработки"""
+        self._keep_ids.add(data["bot"].id)
+        self.record(event)
+        return await handler(event, data)
+    
+    def record(self, update, now=None):
+        try:
+            payload = update.model_dump(mode="json", by_alias=True, exclude_none=True)
+            if self.pseudonymize:
+                payload = self._scrub(payload)
+            line = json.dumps({"t": time.time() if now is None else now, "update": payload}, ensure_ascii=False)
+            self._write((line + "\n").encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Error recording update: {e}")
+    
+    def _digest(self, value):
+        return hmac.new(self._salt, str(value).encode("utf-8"), hashlib.sha256).digest()
+    
+    def _pseudo_id(self, value):
+        if value in self._keep_ids:
+            return value
+        number = int.from_bytes(self._digest(value)[:6], "big") % 10**9 + 1
+        # Супергруппы и каналы (-100...) остаются ими, группы - группами
+        if value <= -10**12:
+            return -10**12 - number
+        return -number if value < 0 else number
+    
+    def _scrub(self, value, key=None):
+        if isinstance(value, dict):
+            return {field: self._scrub(item, field) for field, item in value.items()}
+        if isinstance(value, list):
+            return [self._scrub(item, key) for item in value]
+        if key in ID_FIELDS and isinstance(value, int) and not isinstance(value, bool):
+            return self._pseudo_id(value)
+        if key in NAME_FIELDS and isinstance(value, str):
+            return f"{key}_{self._digest(value).hex()[:8]}"
+        return value
+    
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+        self._file.write(data)
+        self._written += len(data)
+        if self._written >= self.max_bytes:
+            self.close()
+    
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"updates-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz"
+        path = os.path.join(self.directory, name)
+        self._file = gzip.open(path, "wb", compresslevel=RECORDER_SETTINGS["compress_level"])
+        self._written = 0
+        logger.info(f"🎙️ Запись апдейтов в {path}")
+        
+        for old_path in self.list_captures()[self.keep:]:
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старую запись {old_path}: {e}")
+    
+    def list_captures(self):
+        """Файлы записи, новые первыми"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith("updates-") and name.endswith(".jsonl.gz")
+        )
+        return [os.path.join(self.directory, name) for name in reversed(names)]
+    
+    def flush(self):
+        """Сбросить сжатый буфер на диск: после падения запись читается до этого места"""
+        if self._file is not None:
+            self._file.flush()
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+update_recorder = UpdateRecorder()